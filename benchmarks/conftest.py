@@ -0,0 +1,100 @@
+import os
+
+import pytest
+from multicluster_kubespawner.spawner import MultiClusterKubeSpawner
+from traitlets.config import Config, PyFileConfigLoader
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def shipped_config() -> Config:
+    """
+    The jupyterhub_config.py shipped in the root of the repository
+    """
+    loader = PyFileConfigLoader("jupyterhub_config.py", path=os.path.dirname(HERE))
+    return loader.load_config()
+
+
+def many_patches_config(count: int = 20) -> Config:
+    """
+    count patches to the user pod, each adding a label and an env var
+    """
+    config = shipped_config()
+    config.MultiClusterKubeSpawner.patches = {
+        f"{i:02}-patch": f"""
+        kind: Pod
+        metadata:
+            name: {{{{key}}}}
+            labels:
+                patch-{i}: "true"
+        spec:
+            containers:
+            - name: notebook
+              env:
+              - name: PATCH_{i}
+                value: "{{{{username}}}}"
+        """
+        for i in range(count)
+    }
+    return config
+
+
+def many_resources_config(count: int = 50) -> Config:
+    """
+    count extra ConfigMaps per user
+    """
+    config = shipped_config()
+    config.MultiClusterKubeSpawner.resources = {
+        f"{i:02}-configmap": f"""
+        apiVersion: v1
+        kind: ConfigMap
+        metadata:
+            name: {{{{key}}}}-{i}
+        data:
+            user: {{{{username}}}}
+            server: "{{{{servername}}}}"
+        """
+        for i in range(count)
+    }
+    return config
+
+
+def many_profiles(count: int = 100) -> list:
+    return [
+        {
+            "display_name": f"Cluster {i}",
+            "description": f"Launch on cluster {i}, closest to dataset {i}",
+            "default": i == 0,
+            "spawner_override": {
+                "kubernetes_context": f"cluster-{i}",
+                "ingress_public_url": f"http://10.0.0.{i}",
+            },
+        }
+        for i in range(count)
+    ]
+
+
+CONFIGS = {
+    "shipped": shipped_config,
+    "20-patches": many_patches_config,
+    "50-resources": many_resources_config,
+}
+
+
+@pytest.fixture(params=sorted(CONFIGS))
+def spawner(request, user, hub):
+    return MultiClusterKubeSpawner(user=user, hub=hub, config=CONFIGS[request.param]())
+
+
+def pytest_benchmark_update_json(config, benchmarks, output_json):
+    """
+    Keep saved results small enough to review: summary statistics only, and
+    just the machine details that affect timings
+    """
+    for bench in output_json["benchmarks"]:
+        bench["stats"].pop("data", None)
+    cpu = output_json["machine_info"].get("cpu", {})
+    output_json["machine_info"]["cpu"] = {
+        k: cpu[k] for k in ("brand_raw", "count", "hz_advertised_friendly") if k in cpu
+    }
+    output_json["machine_info"].pop("node", None)
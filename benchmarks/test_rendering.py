@@ -0,0 +1,51 @@
+"""
+Microbenchmarks of the CPU bound parts of a spawn
+
+Run with `pytest benchmarks`, which needs pytest-benchmark installed. To record
+a new baseline after an intentional change, run
+`pytest benchmarks --benchmark-json=benchmarks/baseline.json`. Compare against
+it with `pytest-benchmark compare benchmarks/baseline.json <new results>.json`.
+Only summary statistics are saved, see conftest.py.
+"""
+import copy
+
+import pytest
+from conftest import many_profiles, shipped_config
+from multicluster_kubespawner.spawner import MultiClusterKubeSpawner, make_dns_safe
+
+
+@pytest.mark.parametrize(
+    "name", ["yuvipanda", "user@example.com", "名前-with-unicode_and.dots"]
+)
+def test_make_dns_safe(benchmark, name):
+    benchmark(make_dns_safe, name)
+
+
+def test_template_vars(benchmark, spawner):
+    benchmark(lambda: spawner.template_vars)
+
+
+def test_get_resources_spec(benchmark, spawner):
+    benchmark(spawner.get_resources_spec)
+
+
+def test_apply_patches(benchmark, spawner):
+    resources = spawner.get_resources_spec()
+    benchmark(spawner.apply_patches, resources)
+
+
+def test_augment_notebook_container(benchmark, spawner):
+    resources = spawner.apply_patches(spawner.get_resources_spec())
+    # augment_notebook_container modifies resources in place
+    benchmark.pedantic(
+        spawner.augment_notebook_container,
+        setup=lambda: ((copy.deepcopy(resources),), {}),
+        rounds=200,
+    )
+
+
+@pytest.mark.parametrize("count", [3, 100])
+def test_render_options_form(benchmark, user, hub, count):
+    spawner = MultiClusterKubeSpawner(user=user, hub=hub, config=shipped_config())
+    profiles = many_profiles(count)
+    benchmark(spawner._render_options_form, profiles)
@@ -0,0 +1,24 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+
+@pytest.fixture
+def user():
+    user = MagicMock()
+    user.name = "mock_name"
+    user.escaped_name = "mock_name"
+    user.id = "mock_id"
+    user.url = "mock_url"
+    user.proxy_spec = "/user/mock_name/"
+    return user
+
+
+@pytest.fixture
+def hub():
+    hub = MagicMock()
+    hub.public_host = "mock_public_host"
+    hub.url = "mock_url"
+    hub.base_url = "mock_base_url"
+    hub.api_url = "mock_api_url"
+    return hub
@@ -0,0 +1,537 @@
+"""
+In-process fake of the parts of the kubernetes API the spawner uses
+
+Just enough of the API is implemented to run spawns against it: discovery,
+get / list / watch, server side apply, patches, create, replace and delete.
+Pods become ready after a configurable delay, with Scheduled and Started
+events, and EndpointSlices are maintained for Services whose selector matches
+ready pods. Every request can be slowed down by a fixed latency, and a
+fraction of requests can be rejected with 429 to simulate API server
+throttling.
+
+Nothing is persisted, and no validation is done beyond what is needed for
+the spawner to work.
+"""
+import asyncio
+import copy
+import json
+import random
+import re
+import time
+import uuid
+
+from tornado import web
+from tornado.iostream import StreamClosedError
+
+from multicluster_kubespawner.patch import json_merge_patch, strategic_merge_patch
+
+# (group/version, plural) -> (kind, namespaced)
+RESOURCES = {
+    ("v1", "namespaces"): ("Namespace", False),
+    ("v1", "nodes"): ("Node", False),
+    ("v1", "pods"): ("Pod", True),
+    ("v1", "events"): ("Event", True),
+    ("v1", "services"): ("Service", True),
+    ("v1", "serviceaccounts"): ("ServiceAccount", True),
+    ("v1", "secrets"): ("Secret", True),
+    ("v1", "configmaps"): ("ConfigMap", True),
+    ("v1", "persistentvolumeclaims"): ("PersistentVolumeClaim", True),
+    ("v1", "resourcequotas"): ("ResourceQuota", True),
+    ("apps/v1", "daemonsets"): ("DaemonSet", True),
+    ("discovery.k8s.io/v1", "endpointslices"): ("EndpointSlice", True),
+    ("networking.k8s.io/v1", "ingresses"): ("Ingress", True),
+    ("networking.k8s.io/v1", "networkpolicies"): ("NetworkPolicy", True),
+    ("rbac.authorization.k8s.io/v1", "roles"): ("Role", True),
+    ("rbac.authorization.k8s.io/v1", "rolebindings"): ("RoleBinding", True),
+    ("projectcontour.io/v1", "httpproxies"): ("HTTPProxy", True),
+}
+
+PATH_RE = re.compile(
+    r"^/(?:api/(?P<core>v1)|apis/(?P<group>[^/]+/[^/]+))"
+    r"(?:/namespaces/(?P<namespace>[^/]+))?"
+    r"(?:/(?P<plural>[^/]+)(?:/(?P<name>[^/]+))?)?$"
+)
+
+
+def _split_selector(selector: str) -> list:
+    """
+    Split a selector on commas that are not inside parentheses
+    """
+    terms, depth, current = [], 0, ""
+    for char in selector:
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        if char == "," and depth == 0:
+            terms.append(current.strip())
+            current = ""
+        else:
+            current += char
+    if current.strip():
+        terms.append(current.strip())
+    return terms
+
+
+def matches_labels(labels: dict, selector: str) -> bool:
+    for term in _split_selector(selector or ""):
+        m = re.match(r"^(\S+)\s+(in|notin)\s+\((.*)\)$", term)
+        if m:
+            key, op, values = m.groups()
+            values = {v.strip() for v in values.split(",")}
+            if (labels.get(key) in values) != (op == "in"):
+                return False
+        elif "!=" in term:
+            key, value = term.split("!=", 1)
+            if labels.get(key) == value:
+                return False
+        elif "=" in term:
+            key, value = term.replace("==", "=").split("=", 1)
+            if labels.get(key) != value:
+                return False
+        elif term.startswith("!"):
+            if term[1:] in labels:
+                return False
+        elif term not in labels:
+            return False
+    return True
+
+
+def matches_fields(obj: dict, selector: str) -> bool:
+    for term in _split_selector(selector or ""):
+        negate = "!=" in term
+        path, value = re.split(r"!=|==|=", term, 1)
+        current = obj
+        for part in path.split("."):
+            current = (current or {}).get(part)
+        if (str(current) == value) == negate:
+            return False
+    return True
+
+
+def json_patch(obj: dict, operations: list) -> dict:
+    """
+    Apply a JSON patch, supporting the operations the spawner uses
+    """
+    obj = copy.deepcopy(obj)
+    for op in operations:
+        parts = [
+            p.replace("~1", "/").replace("~0", "~") for p in op["path"].split("/")[1:]
+        ]
+        parent = obj
+        for part in parts[:-1]:
+            parent = parent.setdefault(part, {})
+        last = parts[-1]
+        if op["op"] == "test":
+            if parent.get(last) != op["value"]:
+                raise ValueError(f"test failed for {op['path']}")
+        elif op["op"] in ("add", "replace"):
+            parent[last] = op["value"]
+        elif op["op"] == "remove":
+            parent.pop(last, None)
+    return obj
+
+
+class FakeCluster:
+    """
+    State of one fake cluster
+    """
+
+    def __init__(
+        self,
+        name: str,
+        latency: float = 0,
+        throttle_rate: float = 0,
+        pod_ready_delay: float = 1,
+        pod_termination_delay: float = 1,
+    ):
+        self.name = name
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.pod_ready_delay = pod_ready_delay
+        self.pod_termination_delay = pod_termination_delay
+
+        # (group/version, plural, namespace, name) -> object
+        self.objects = {}
+        self.resource_version = 0
+        # Recent events, for watches started from an older resourceVersion
+        self.history = []
+        self.watchers = set()
+        self.requests = 0
+        self.throttled = 0
+
+    def _event(self, event_type: str, key: tuple, obj: dict):
+        self.resource_version += 1
+        obj["metadata"]["resourceVersion"] = str(self.resource_version)
+        event = (self.resource_version, key[0], key[1], event_type, copy.deepcopy(obj))
+        self.history.append(event)
+        del self.history[:-10000]
+        for queue in self.watchers:
+            queue.put_nowait(event)
+
+    def store(self, key: tuple, obj: dict, event_type: str = None):
+        gv, plural, namespace, name = key
+        kind, _ = RESOURCES[(gv, plural)]
+        obj["apiVersion"] = gv
+        obj["kind"] = kind
+        metadata = obj["metadata"]
+        metadata["name"] = name
+        if namespace:
+            metadata["namespace"] = namespace
+        existing = self.objects.get(key)
+        if existing is None:
+            metadata["uid"] = str(uuid.uuid4())
+            metadata["creationTimestamp"] = time.strftime(
+                "%Y-%m-%dT%H:%M:%SZ", time.gmtime()
+            )
+            metadata["generation"] = 1
+        else:
+            for field in ("uid", "creationTimestamp", "deletionTimestamp"):
+                if field in existing["metadata"]:
+                    metadata[field] = existing["metadata"][field]
+            metadata["generation"] = existing["metadata"]["generation"]
+            if obj.get("spec") != existing.get("spec"):
+                metadata["generation"] += 1
+            if "status" not in obj and "status" in existing:
+                obj["status"] = existing["status"]
+        self.objects[key] = obj
+        self._event(
+            event_type or ("ADDED" if existing is None else "MODIFIED"), key, obj
+        )
+
+        if existing is None and kind == "Pod":
+            asyncio.ensure_future(self._start_pod(key))
+        if kind in ("Pod", "Service"):
+            self._update_endpoints(namespace)
+        return obj
+
+    def delete(self, key: tuple):
+        obj = self.objects.get(key)
+        if obj is None:
+            return None
+        if key[1] == "pods":
+            if "deletionTimestamp" not in obj["metadata"]:
+                obj["metadata"]["deletionTimestamp"] = time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime()
+                )
+                self._event("MODIFIED", key, obj)
+                asyncio.ensure_future(self._remove_later(key))
+            return obj
+        del self.objects[key]
+        self._event("DELETED", key, obj)
+        if key[1] in ("pods", "services"):
+            self._update_endpoints(key[2])
+        return obj
+
+    async def _remove_later(self, key: tuple):
+        await asyncio.sleep(self.pod_termination_delay)
+        obj = self.objects.pop(key, None)
+        if obj is not None:
+            self._event("DELETED", key, obj)
+            self._update_endpoints(key[2])
+            # Unlike a real cluster, where they expire after an hour
+            for event_key, event in list(self.objects.items()):
+                if (
+                    event_key[1] == "events"
+                    and event["involvedObject"]["uid"] == obj["metadata"]["uid"]
+                ):
+                    self.delete(event_key)
+
+    def _pod_event(self, pod: dict, reason: str, message: str):
+        metadata = pod["metadata"]
+        self.store(
+            (
+                "v1",
+                "events",
+                metadata["namespace"],
+                f"{metadata['name']}.{uuid.uuid4().hex[:16]}",
+            ),
+            {
+                "metadata": {},
+                "involvedObject": {
+                    "kind": "Pod",
+                    "name": metadata["name"],
+                    "namespace": metadata["namespace"],
+                    "uid": metadata["uid"],
+                },
+                "type": "Normal",
+                "reason": reason,
+                "message": message,
+                "count": 1,
+            },
+        )
+
+    async def _start_pod(self, key: tuple):
+        self._pod_event(
+            self.objects[key],
+            "Scheduled",
+            f"Successfully assigned {key[2]}/{key[3]} to fake-node",
+        )
+        await asyncio.sleep(self.pod_ready_delay)
+        pod = self.objects.get(key)
+        if pod is None or "deletionTimestamp" in pod["metadata"]:
+            return
+        self._pod_event(pod, "Started", "Started container notebook")
+        pod["status"] = {
+            "phase": "Running",
+            "podIP": f"10.0.{random.randint(0, 255)}.{random.randint(1, 254)}",
+            "conditions": [{"type": "Ready", "status": "True"}],
+            "containerStatuses": [
+                {"name": c["name"], "ready": True, "state": {"running": {}}}
+                for c in pod["spec"].get("containers", [])
+            ],
+        }
+        self._event("MODIFIED", key, pod)
+        self._update_endpoints(key[2])
+
+    def _update_endpoints(self, namespace: str):
+        """
+        Keep an EndpointSlice for every Service in namespace up to date
+        """
+        for key, service in list(self.objects.items()):
+            if key[1] != "services" or key[2] != namespace:
+                continue
+            selector = service.get("spec", {}).get("selector") or {}
+            endpoints = [
+                {"addresses": [pod["status"]["podIP"]], "conditions": {"ready": True}}
+                for pod_key, pod in self.objects.items()
+                if pod_key[1] == "pods"
+                and pod_key[2] == namespace
+                and selector
+                and "deletionTimestamp" not in pod["metadata"]
+                and "podIP" in pod.get("status", {})
+                and all(
+                    pod["metadata"].get("labels", {}).get(k) == v
+                    for k, v in selector.items()
+                )
+            ]
+            slice_key = ("discovery.k8s.io/v1", "endpointslices", namespace, key[3])
+            existing = self.objects.get(slice_key)
+            if existing is not None and existing.get("endpoints") == endpoints:
+                continue
+            self.store(
+                slice_key,
+                {
+                    "metadata": {
+                        "labels": {"kubernetes.io/service-name": key[3]},
+                    },
+                    "addressType": "IPv4",
+                    "endpoints": endpoints,
+                },
+            )
+
+    def select(self, gv, plural, namespace, label_selector, field_selector) -> list:
+        return [
+            obj
+            for key, obj in self.objects.items()
+            if key[:2] == (gv, plural)
+            and (namespace is None or key[2] == namespace)
+            and matches_labels(obj["metadata"].get("labels", {}), label_selector)
+            and matches_fields(obj, field_selector)
+        ]
+
+
+class APIHandler(web.RequestHandler):
+    def initialize(self, cluster: FakeCluster):
+        self.cluster = cluster
+
+    def _status(self, code: int, reason: str, message: str = ""):
+        self.set_status(code)
+        self.finish(
+            {
+                "kind": "Status",
+                "apiVersion": "v1",
+                "status": "Failure",
+                "code": code,
+                "reason": reason,
+                "message": message,
+            }
+        )
+
+    async def prepare(self):
+        self.cluster.requests += 1
+        if self.cluster.latency:
+            await asyncio.sleep(self.cluster.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.cluster.throttle_rate:
+            self.cluster.throttled += 1
+            self.set_header("Retry-After", "1")
+            self._status(429, "TooManyRequests", "throttled by fake API server")
+            return
+        m = PATH_RE.match(self.request.path)
+        if not m:
+            if not self.request.path.startswith("/api"):
+                # Stand in for the ingress controller, so readiness probes succeed
+                self.finish("ok")
+            else:
+                self._status(404, "NotFound", self.request.path)
+            return
+        self.gv = m.group("core") or m.group("group")
+        self.namespace = m.group("namespace")
+        self.plural = m.group("plural")
+        self.name = m.group("name")
+        if self.namespace and not self.plural:
+            # /api/v1/namespaces/<name> is the Namespace object itself
+            self.plural, self.name, self.namespace = "namespaces", self.namespace, None
+        if self.plural and (self.gv, self.plural) not in RESOURCES:
+            self._status(404, "NotFound", f"{self.gv} {self.plural}")
+
+    @property
+    def key(self) -> tuple:
+        namespaced = RESOURCES[(self.gv, self.plural)][1]
+        return (self.gv, self.plural, self.namespace if namespaced else None, self.name)
+
+    def _body(self):
+        return json.loads(self.request.body or b"{}")
+
+    async def get(self, *args):
+        if self.plural is None:
+            return self.finish(self._discovery())
+        if self.name:
+            obj = self.cluster.objects.get(self.key)
+            if obj is None:
+                return self._status(404, "NotFound", self.name)
+            if "PartialObjectMetadata" in self.request.headers.get("Accept", ""):
+                return self.finish(
+                    {
+                        "kind": "PartialObjectMetadata",
+                        "apiVersion": "meta.k8s.io/v1",
+                        "metadata": obj["metadata"],
+                    }
+                )
+            return self.finish(obj)
+        if self.get_argument("watch", "") in ("1", "true"):
+            return await self._watch()
+        items = self.cluster.select(
+            self.gv,
+            self.plural,
+            self.namespace,
+            self.get_argument("labelSelector", ""),
+            self.get_argument("fieldSelector", ""),
+        )
+        metadata = {"resourceVersion": str(self.cluster.resource_version)}
+        # Continue tokens are just offsets, so pages are not from one snapshot
+        limit = int(self.get_argument("limit", "0") or 0)
+        if limit:
+            start = int(self.get_argument("continue", "0") or 0)
+            if start + limit < len(items):
+                metadata["continue"] = str(start + limit)
+            items = items[start : start + limit]
+        self.finish({"kind": "List", "metadata": metadata, "items": items})
+
+    async def _watch(self):
+        label_selector = self.get_argument("labelSelector", "")
+        field_selector = self.get_argument("fieldSelector", "")
+        since = int(self.get_argument("resourceVersion", "0") or 0)
+        timeout = float(self.get_argument("timeoutSeconds", "300"))
+
+        queue = asyncio.Queue()
+        for event in self.cluster.history:
+            if event[0] > since:
+                queue.put_nowait(event)
+        self.cluster.watchers.add(queue)
+        deadline = time.monotonic() + timeout
+        try:
+            self.set_header("Content-Type", "application/json")
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    _, gv, plural, event_type, obj = await asyncio.wait_for(
+                        queue.get(), remaining
+                    )
+                except asyncio.TimeoutError:
+                    break
+                if (gv, plural) != (self.gv, self.plural):
+                    continue
+                if (
+                    self.namespace
+                    and obj["metadata"].get("namespace") != self.namespace
+                ):
+                    continue
+                if not matches_labels(
+                    obj["metadata"].get("labels", {}), label_selector
+                ) or not matches_fields(obj, field_selector):
+                    continue
+                self.write(json.dumps({"type": event_type, "object": obj}) + "\n")
+                await self.flush()
+        except (asyncio.CancelledError, StreamClosedError):
+            # The client went away, or the harness is shutting down
+            return
+        finally:
+            self.cluster.watchers.discard(queue)
+        self.finish()
+
+    def _discovery(self):
+        return {
+            "kind": "APIResourceList",
+            "groupVersion": self.gv,
+            "resources": [
+                {"name": plural, "kind": kind, "namespaced": namespaced}
+                for (gv, plural), (kind, namespaced) in RESOURCES.items()
+                if gv == self.gv
+            ],
+        }
+
+    def post(self, *args):
+        obj = self._body()
+        self.name = obj["metadata"]["name"]
+        if self.key in self.cluster.objects:
+            return self._status(409, "AlreadyExists", self.name)
+        self.set_status(201)
+        self.finish(self.cluster.store(self.key, obj))
+
+    def put(self, *args):
+        obj = self._body()
+        existing = self.cluster.objects.get(self.key)
+        if existing is None:
+            return self._status(404, "NotFound", self.name)
+        resource_version = obj["metadata"].get("resourceVersion")
+        if resource_version and (
+            resource_version != existing["metadata"]["resourceVersion"]
+        ):
+            return self._status(409, "Conflict", self.name)
+        self.finish(self.cluster.store(self.key, obj))
+
+    def patch(self, *args):
+        content_type = self.request.headers.get("Content-Type", "")
+        patch = self._body()
+        existing = self.cluster.objects.get(self.key)
+        if content_type.startswith("application/apply-patch"):
+            obj = patch
+        elif existing is None:
+            return self._status(404, "NotFound", self.name)
+        elif content_type.startswith("application/json-patch"):
+            try:
+                obj = json_patch(existing, patch)
+            except ValueError as e:
+                return self._status(422, "Invalid", str(e))
+        elif content_type.startswith("application/strategic-merge-patch"):
+            obj = strategic_merge_patch(existing, patch)
+        else:
+            obj = json_merge_patch(existing, patch)
+        self.finish(self.cluster.store(self.key, copy.deepcopy(obj)))
+
+    def delete(self, *args):
+        if self.name:
+            obj = self.cluster.delete(self.key)
+            if obj is None:
+                return self._status(404, "NotFound", self.name)
+            return self.finish(obj)
+        items = self.cluster.select(
+            self.gv,
+            self.plural,
+            self.namespace,
+            self.get_argument("labelSelector", ""),
+            self.get_argument("fieldSelector", ""),
+        )
+        for obj in items:
+            metadata = obj["metadata"]
+            self.cluster.delete(
+                (self.gv, self.plural, metadata.get("namespace"), metadata["name"])
+            )
+        self.finish({"kind": "List", "items": items})
+
+
+def make_app(cluster: FakeCluster) -> web.Application:
+    return web.Application([(r"/.*", APIHandler, {"cluster": cluster})])
@@ -0,0 +1,225 @@
+"""
+Run many concurrent spawns against fake kubernetes clusters, and report how it went
+
+Everything runs in this process, without network access: a fake API server
+is started for each simulated cluster, and a kubeconfig pointing at them is
+written to a temporary directory.
+
+    python loadtest/run.py --clusters 3 --servers 200 --concurrency 50 \\
+        --latency 0.02 --throttle-rate 0.01 --pod-ready-delay 2
+
+Each server goes through start(), poll() and stop(). Throughput, p50 / p99
+latency of each of those and the lag of the event loop are reported at the
+end.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from traitlets.config import Config
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_apiserver import FakeCluster, make_app  # noqa: E402
+from multicluster_kubespawner.spawner import MultiClusterKubeSpawner  # noqa: E402
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def start_clusters(args) -> dict:
+    """
+    Start a fake API server for each cluster, returning {context: (cluster, url)}
+    """
+    clusters = {}
+    for i in range(args.clusters):
+        cluster = FakeCluster(
+            f"fake-{i}",
+            latency=args.latency,
+            throttle_rate=args.throttle_rate,
+            pod_ready_delay=args.pod_ready_delay,
+            pod_termination_delay=args.pod_termination_delay,
+        )
+        sockets = bind_sockets(0, "127.0.0.1")
+        server = HTTPServer(make_app(cluster))
+        server.add_sockets(sockets)
+        port = sockets[0].getsockname()[1]
+        clusters[cluster.name] = (cluster, f"http://127.0.0.1:{port}")
+    return clusters
+
+
+def write_kubeconfig(clusters: dict, directory: str) -> str:
+    path = os.path.join(directory, "kubeconfig")
+    lines = ["apiVersion: v1", "kind: Config", "clusters:"]
+    for name, (_, url) in clusters.items():
+        lines += [f"- name: {name}", "  cluster:", f"    server: {url}"]
+    lines.append("contexts:")
+    for name in clusters:
+        lines += [f"- name: {name}", "  context:", f"    cluster: {name}"]
+    lines.append(f"current-context: {next(iter(clusters))}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+
+async def measure_lag(lags: list, interval: float = 0.05):
+    """
+    Record how late the event loop wakes us up, as a measure of how busy it is
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        before = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - before - interval)
+
+
+def make_spawner(i: int, context: str, url: str, config: Config):
+    name = f"user-{i}"
+    user = SimpleNamespace(
+        name=name,
+        escaped_name=name,
+        id=i,
+        url=f"/user/{name}/",
+        proxy_spec=f"/user/{name}/",
+    )
+    hub = SimpleNamespace(
+        public_host="hub.example.com",
+        url="http://hub:8081/hub/",
+        base_url="/hub/",
+        api_url="http://hub:8081/hub/api",
+    )
+    spawner = MultiClusterKubeSpawner(user=user, hub=hub, config=config)
+    spawner.kubernetes_context = context
+    spawner.ingress_public_url = url
+    spawner.api_token = f"token-{i}"
+    return spawner
+
+
+async def run_cycle(spawner, timings: dict, errors: list):
+    for operation in ("start", "poll", "stop"):
+        started = time.perf_counter()
+        try:
+            result = await getattr(spawner, operation)()
+        except Exception as e:
+            errors.append(f"{operation}: {type(e).__name__}: {e}")
+            return False
+        timings[operation].append(time.perf_counter() - started)
+        if operation == "poll" and result is not None:
+            errors.append(f"poll: server not running, got {result}")
+            return False
+    return True
+
+
+async def main(args):
+    clusters = start_clusters(args)
+    with tempfile.TemporaryDirectory() as d:
+        os.environ["KUBECONFIG"] = write_kubeconfig(clusters, d)
+
+        config = Config()
+        config.MultiClusterKubeSpawner.start_timeout = args.start_timeout
+        config.MultiClusterKubeSpawner.namespace_template = args.namespace_template
+        config.MultiClusterKubeSpawner.routing_mode = args.routing_mode
+        # The fake API servers also stand in for the ingress controller
+        config.MultiClusterKubeSpawner.ready_check_http_probe = True
+
+        contexts = list(clusters)
+        spawners = [
+            make_spawner(
+                i,
+                contexts[i % len(contexts)],
+                clusters[contexts[i % len(contexts)]][1],
+                config,
+            )
+            for i in range(args.servers)
+        ]
+
+        lags = []
+        lag_task = asyncio.ensure_future(measure_lag(lags))
+        timings = {"start": [], "poll": [], "stop": []}
+        errors = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def limited(spawner):
+            async with semaphore:
+                return await run_cycle(spawner, timings, errors)
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(s) for s in spawners))
+        elapsed = time.perf_counter() - started
+
+        # Stop reflectors and other background tasks started by the spawners
+        tasks = {t for t in asyncio.all_tasks() if t is not asyncio.current_task()}
+        while tasks:
+            # A cancellation can get lost when it races with the awaited future
+            # completing, so keep cancelling until everything is gone
+            for task in tasks:
+                task.cancel()
+            _, tasks = await asyncio.wait(tasks, timeout=1)
+
+    succeeded = sum(results)
+    print(
+        f"{succeeded}/{len(results)} start/poll/stop cycles succeeded in {elapsed:.1f}s "
+        f"({succeeded / elapsed:.1f} cycles/s) with concurrency {args.concurrency}"
+    )
+    for operation, values in timings.items():
+        print(
+            f"{operation:>6}: p50 {percentile(values, 50):.3f}s  p99 {percentile(values, 99):.3f}s  "
+            f"max {max(values, default=float('nan')):.3f}s"
+        )
+    print(
+        f"event loop lag: p50 {percentile(lags, 50) * 1000:.1f}ms  "
+        f"p99 {percentile(lags, 99) * 1000:.1f}ms  max {max(lags, default=0) * 1000:.1f}ms"
+    )
+    for name, (cluster, _) in clusters.items():
+        print(f"{name}: {cluster.requests} API requests, {cluster.throttled} throttled")
+    if errors:
+        print(f"{len(errors)} errors, first few:")
+        for error in errors[:5]:
+            print(f"  {error}")
+    return 0 if succeeded == len(results) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clusters", type=int, default=3)
+    parser.add_argument("--servers", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="Seconds per API request"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0,
+        help="Fraction of API requests rejected with 429",
+    )
+    parser.add_argument("--pod-ready-delay", type=float, default=1)
+    parser.add_argument("--pod-termination-delay", type=float, default=1)
+    parser.add_argument("--start-timeout", type=int, default=60)
+    parser.add_argument(
+        "--namespace-template",
+        default="jupyter-{{username}}",
+        help="Use a fixed name to put all servers in one namespace per cluster",
+    )
+    parser.add_argument(
+        "--routing-mode", default="ingress", choices=["ingress", "httpproxy"]
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if not args.verbose:
+        # Throttled requests are counted in the report instead
+        logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    sys.exit(asyncio.run(main(args)))
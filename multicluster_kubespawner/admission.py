@@ -0,0 +1,132 @@
+"""
+Admission control for mutating calls to the kubernetes API of a cluster
+
+When many users start their servers at the same time, every spawner sends its
+resources to the same API server at once, which then throttles all of them.
+Each client instead admits only a limited number of mutating requests at a
+time, and queues the rest. Queued requests are admitted in the order they
+arrived, or fairly between the spawns they are made for, so a spawn with many
+resources does not hold up everyone else.
+
+The spawn a request is made for is taken from `current_owner`, which spawners
+set while they start and stop, and which is inherited by tasks they create.
+"""
+import asyncio
+import contextvars
+import itertools
+import logging
+from contextlib import asynccontextmanager
+
+from .metrics import ADMISSION_WAITING
+
+log = logging.getLogger(__name__)
+
+# (owner, callback) of the spawn the current task makes requests for. The
+# callback is called with the position of its requests in the queue.
+current_owner = contextvars.ContextVar("admission_owner", default=(None, None))
+
+POLICIES = ("fifo", "fair")
+
+
+class _Waiter:
+    def __init__(self, owner, on_position, seq: int):
+        self.owner = owner
+        self.on_position = on_position
+        self.seq = seq
+        self.position = None
+        self.future = asyncio.get_event_loop().create_future()
+
+
+class AdmissionController:
+    """
+    Queue of mutating requests to the API server of one kubeconfig context
+
+    At most max_in_flight requests are admitted at a time, unlimited if 0.
+    With the `fifo` policy, queued requests are admitted in the order they
+    arrived. With `fair`, the request of the owner with the fewest admitted
+    requests goes first, so each spawn gets an equal share.
+    """
+
+    def __init__(self, context: str, max_in_flight: int = 0, policy: str = "fair"):
+        self.context = context
+        self.max_in_flight = max_in_flight
+        self.policy = policy
+        self.in_flight = 0
+        # Number of admitted requests, by owner
+        self._owners = {}
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _has_room(self) -> bool:
+        return self.max_in_flight <= 0 or self.in_flight < self.max_in_flight
+
+    def _queue(self) -> list:
+        """
+        Queued requests, in the order they will be admitted
+        """
+        if self.policy == "fair":
+            return sorted(
+                self._waiters, key=lambda w: (self._owners.get(w.owner, 0), w.seq)
+            )
+        return self._waiters
+
+    def _admit(self, owner):
+        self.in_flight += 1
+        self._owners[owner] = self._owners.get(owner, 0) + 1
+
+    def _release(self, owner):
+        self.in_flight -= 1
+        self._owners[owner] -= 1
+        if not self._owners[owner]:
+            del self._owners[owner]
+        self._update()
+
+    def _update(self):
+        """
+        Admit as many queued requests as there is room for, and report positions of the rest
+        """
+        while self._waiters and self._has_room():
+            waiter = self._queue()[0]
+            self._waiters.remove(waiter)
+            self._admit(waiter.owner)
+            waiter.future.set_result(None)
+
+        for position, waiter in enumerate(self._queue(), 1):
+            if waiter.position != position and waiter.on_position is not None:
+                try:
+                    waiter.on_position(position)
+                except Exception:
+                    log.exception("Failed to report admission queue position")
+            waiter.position = position
+        ADMISSION_WAITING.labels(context=self.context).set(len(self._waiters))
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        Wait for a mutating request to be admitted, for as long as the with block runs
+        """
+        if self.policy not in POLICIES:
+            raise ValueError(
+                f"Unknown admission policy {self.policy}. Options include: {', '.join(POLICIES)}"
+            )
+        owner, on_position = current_owner.get()
+        if not self._waiters and self._has_room():
+            self._admit(owner)
+        else:
+            waiter = _Waiter(owner, on_position, next(self._seq))
+            self._waiters.append(waiter)
+            self._update()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._update()
+                else:
+                    # Admitted just as we were cancelled
+                    self._release(owner)
+                raise
+        try:
+            yield
+        finally:
+            self._release(owner)
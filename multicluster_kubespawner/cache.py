@@ -0,0 +1,77 @@
+"""
+Cache of values that are slow to fetch, refreshed in the background
+
+Values are fresh for ttl seconds after they are fetched. After that, the stale
+value is still returned right away for up to max_stale more seconds, while a
+new one is fetched in the background. Only values older than that - or not
+fetched yet - make the caller wait. At most one fetch per key is in flight at a
+time, shared by everyone asking for it. Values too old to be returned at all
+are dropped whenever a fetch finishes, so keys nobody asks for again do not
+pile up.
+"""
+import asyncio
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RefreshingCache:
+    """
+    Values by key, with a TTL and stale-while-revalidate refresh
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        # key -> (value, fetched_at, seconds it can be used for)
+        self._values = {}
+        # key -> task fetching a new value
+        self._fetches = {}
+
+    def _fetch(self, key, fetch, lifetime: float) -> asyncio.Future:
+        """
+        Start fetching a value for key, unless that is already happening
+        """
+        if key not in self._fetches:
+            task = asyncio.ensure_future(fetch())
+            self._fetches[key] = task
+            task.add_done_callback(lambda t: self._fetched(key, t, lifetime))
+        return self._fetches[key]
+
+    def _fetched(self, key, task: asyncio.Future, lifetime: float):
+        del self._fetches[key]
+        now = time.monotonic()
+        self._evict(now)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            if key in self._values:
+                log.warning(
+                    f"Failed to refresh {self.name}, serving the stale value: {task.exception()}"
+                )
+            return
+        self._values[key] = (task.result(), now, lifetime)
+
+    def _evict(self, now: float):
+        """
+        Drop values that are too old to be returned, unless they are being refetched
+        """
+        for key, (_, fetched_at, lifetime) in list(self._values.items()):
+            if now - fetched_at >= lifetime and key not in self._fetches:
+                del self._values[key]
+
+    async def get(self, key, fetch, ttl: float, max_stale: float = 0):
+        """
+        Return the value for key, calling the async function fetch for a new one when needed
+        """
+        lifetime = ttl + max_stale
+        if key in self._values:
+            value, fetched_at, _ = self._values[key]
+            age = time.monotonic() - fetched_at
+            if age < ttl:
+                return value
+            if age < lifetime:
+                self._fetch(key, fetch, lifetime)
+                return value
+        # Shielded, so one caller giving up does not cancel the fetch for everyone
+        return await asyncio.shield(self._fetch(key, fetch, lifetime))
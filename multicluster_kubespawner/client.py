@@ -0,0 +1,970 @@
+"""
+Async client for talking to the kubernetes API of many clusters.
+
+One client is kept per kubeconfig context, and shared by all the spawners
+that target that context. Each client holds a pooled HTTP/2 connection to
+the cluster's API server, and caches the credentials used to authenticate
+to it - so spawns do not have to fork `kubectl`, re-read the kubeconfig
+file and re-run auth plugins for every single API call.
+"""
+import asyncio
+import base64
+import json
+import logging
+import os
+import random
+import ssl
+import tempfile
+import time
+from contextlib import nullcontext
+from datetime import datetime
+
+import httpx
+
+from .admission import AdmissionController
+from .metrics import API_REQUESTS, API_RETRIES, EXEC_PLUGIN_RUNS
+from .templating import load_yaml
+
+log = logging.getLogger(__name__)
+
+# Name recorded as the owner of fields we set with server side apply
+FIELD_MANAGER = "multicluster-kubespawner"
+
+PATCH_CONTENT_TYPES = {
+    "apply": "application/apply-patch+yaml",
+    "strategic": "application/strategic-merge-patch+json",
+    "merge": "application/merge-patch+json",
+    "json": "application/json-patch+json",
+}
+
+# Where a pod's service account credentials are mounted when running in-cluster
+SERVICE_ACCOUNT_DIR = "/var/run/secrets/kubernetes.io/serviceaccount"
+
+# Requests with these methods change objects, and go through admission control
+MUTATING_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+# Responses telling us to back off and try again later, with the retry reason
+RETRY_STATUS_CODES = {429: "throttled", 503: "unavailable"}
+
+
+class KubernetesAPIError(ValueError):
+    """
+    An error response from the kubernetes API
+
+    Subclasses ValueError, as that is what failed kubectl invocations used to raise.
+    """
+
+    def __init__(self, status_code: int, reason: str, message: str):
+        self.status_code = status_code
+        self.reason = reason
+        self.message = message
+        super().__init__(f"{status_code} {reason}: {message}")
+
+
+def pod_is_ready(pod: dict) -> bool:
+    """
+    Return True if the pod has the Ready condition set to True
+    """
+    for condition in pod.get("status", {}).get("conditions", []) or []:
+        if condition["type"] == "Ready":
+            return condition["status"] == "True"
+    return False
+
+
+def endpoints_are_ready(endpoint_slice: dict) -> bool:
+    """
+    Return True if an EndpointSlice has at least one ready endpoint
+    """
+    for endpoint in endpoint_slice.get("endpoints") or []:
+        # A missing ready condition should be interpreted as ready
+        if (endpoint.get("conditions") or {}).get("ready", True) is not False:
+            return True
+    return False
+
+
+def route_is_ready(route: dict) -> bool:
+    """
+    Return True if the ingress controller has accepted an Ingress or HTTPProxy
+    """
+    status = route.get("status") or {}
+    if "currentStatus" in status:
+        # HTTPProxy objects report whether contour considers them valid
+        return status["currentStatus"] == "valid"
+    return bool((status.get("loadBalancer") or {}).get("ingress"))
+
+
+def _parse_timestamp(ts: str) -> float:
+    """
+    Parse a RFC3339 timestamp, as used by kubernetes, into a unix timestamp
+    """
+    # datetime.fromisoformat only understands the 'Z' suffix from python 3.11
+    if ts.endswith("Z"):
+        ts = ts[:-1] + "+00:00"
+    return datetime.fromisoformat(ts).timestamp()
+
+
+def retry_delay(
+    response: httpx.Response, attempt: int, base: float = 0.5, cap: float = 30
+) -> float:
+    """
+    Seconds to wait before retrying a throttled request
+
+    Backs off exponentially with each attempt, but never retries sooner than
+    the Retry-After header asks for. Up to half as much again is added at
+    random, so requests throttled together do not all come back together.
+    """
+    delay = min(cap, base * 2**attempt)
+    try:
+        delay = max(delay, float(response.headers.get("Retry-After", 0)))
+    except ValueError:
+        # Retry-After can also be a HTTP date, which the API server does not send
+        pass
+    return delay * random.uniform(1, 1.5)
+
+
+def _kubeconfig_paths() -> list:
+    if "KUBECONFIG" in os.environ:
+        return [p for p in os.environ["KUBECONFIG"].split(os.pathsep) if p]
+    return [os.path.expanduser("~/.kube/config")]
+
+
+def load_kubeconfig() -> dict:
+    """
+    Load and merge all kubeconfig files, following the same rules as kubectl
+
+    The first file to set a particular cluster, user or context wins. Paths to
+    files referenced inside each kubeconfig file are made absolute, relative
+    to the file they are referenced from.
+    """
+    merged = {"clusters": {}, "users": {}, "contexts": {}, "current-context": ""}
+    for path in _kubeconfig_paths():
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            config = load_yaml(f.read()) or {}
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for section, item_key in [
+            ("clusters", "cluster"),
+            ("users", "user"),
+            ("contexts", "context"),
+        ]:
+            for entry in config.get(section) or []:
+                if entry["name"] in merged[section]:
+                    continue
+                item = dict(entry.get(item_key) or {})
+                item["_base_dir"] = base_dir
+                merged[section][entry["name"]] = item
+        if not merged["current-context"]:
+            merged["current-context"] = config.get("current-context", "")
+    return merged
+
+
+class ExecCredentials:
+    """
+    Credentials provided by an exec based kubeconfig auth plugin
+
+    The plugin (`gke-gcloud-auth-plugin`, `aws eks get-token`, etc) is run only
+    when we do not have a token, or the token we have has expired. Tokens close
+    to expiry are refreshed in the background, while requests keep using the
+    current one. The plugin is never run more than once at a time.
+    """
+
+    # Seconds before a token expires that it is refreshed in the background
+    refresh_margin = 120
+
+    # Seconds to wait after a failed background refresh before trying again
+    retry_interval = 10
+
+    def __init__(self, context: str, exec_config: dict, cluster: dict, base_dir: str):
+        self.context = context
+        self.exec_config = exec_config
+        self.cluster = cluster
+        self.base_dir = base_dir
+        self.token = None
+        self.client_cert = None
+        self.expires_at = None
+        self._refresh = None
+        self._failed_at = 0
+
+    def _is_valid(self) -> bool:
+        if self.token is None and self.client_cert is None:
+            return False
+        return self.expires_at is None or time.time() < self.expires_at
+
+    def _needs_refresh(self) -> bool:
+        return (
+            self.expires_at is not None
+            and time.time() > self.expires_at - self.refresh_margin
+            and time.time() - self._failed_at > self.retry_interval
+        )
+
+    def invalidate(self):
+        self.token = None
+        self.client_cert = None
+        self.expires_at = None
+
+    async def _run_plugin(self):
+        command = self.exec_config["command"]
+        if os.sep in command and not os.path.isabs(command):
+            command = os.path.join(self.base_dir, command)
+        cmd = [command] + list(self.exec_config.get("args") or [])
+
+        exec_info = {
+            "apiVersion": self.exec_config["apiVersion"],
+            "kind": "ExecCredential",
+            "spec": {"interactive": False},
+        }
+        if self.exec_config.get("provideClusterInfo"):
+            exec_info["spec"]["cluster"] = {
+                k: v for k, v in self.cluster.items() if not k.startswith("_")
+            }
+
+        env = os.environ.copy()
+        for e in self.exec_config.get("env") or []:
+            env[e["name"]] = e["value"]
+        env["KUBERNETES_EXEC_INFO"] = json.dumps(exec_info)
+
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        EXEC_PLUGIN_RUNS.labels(
+            context=self.context,
+            result="success" if proc.returncode == 0 else "failure",
+        ).inc()
+        if proc.returncode != 0:
+            raise ValueError(
+                f"kubeconfig exec plugin {cmd} failed with code {proc.returncode}: {stderr.decode()}"
+            )
+
+        status = json.loads(stdout)["status"]
+        self.token = status.get("token")
+        if "clientCertificateData" in status:
+            # Plugins return PEM, while kubeconfig files have it base64 encoded
+            self.client_cert = (
+                base64.b64encode(status["clientCertificateData"].encode()).decode(),
+                base64.b64encode(status["clientKeyData"].encode()).decode(),
+            )
+        if "expirationTimestamp" in status:
+            self.expires_at = _parse_timestamp(status["expirationTimestamp"])
+        else:
+            self.expires_at = None
+
+    def _start_refresh(self) -> asyncio.Future:
+        """
+        Run the plugin, unless it is already running
+        """
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._run_plugin())
+            self._refresh.add_done_callback(self._refresh_done)
+        return self._refresh
+
+    def _refresh_done(self, task: asyncio.Future):
+        self._refresh = None
+        if not task.cancelled() and task.exception() is not None:
+            self._failed_at = time.time()
+            log.warning(
+                f"Refreshing credentials for context {self.context} failed: {task.exception()}"
+            )
+
+    async def get(self):
+        """
+        Return (token, client_cert) tuple, running the plugin only if necessary
+        """
+        if not self._is_valid():
+            # Shielded, so a cancelled request does not cancel the run others wait for
+            await asyncio.shield(self._start_refresh())
+        elif self._needs_refresh():
+            self._start_refresh()
+        return self.token, self.client_cert
+
+
+# Exec credentials, shared by all contexts using the same plugin configuration
+_exec_credentials = {}
+
+
+def get_exec_credentials(
+    context: str, exec_config: dict, cluster: dict, base_dir: str
+) -> ExecCredentials:
+    """
+    Return the shared credentials for an exec plugin configuration
+
+    Contexts that run the same plugin with the same arguments (such as several
+    GKE clusters in one project) get the same token, so the plugin only runs
+    once for all of them. Plugins that are given the cluster's details are
+    shared only by contexts for that cluster.
+    """
+    key = json.dumps(
+        [
+            exec_config,
+            base_dir,
+            cluster if exec_config.get("provideClusterInfo") else None,
+        ],
+        sort_keys=True,
+    )
+    if key not in _exec_credentials:
+        _exec_credentials[key] = ExecCredentials(
+            context, exec_config, cluster, base_dir
+        )
+    return _exec_credentials[key]
+
+
+class KubernetesClient:
+    """
+    Async client for the kubernetes API of a single kubeconfig context
+    """
+
+    # Times a request is retried when the API server throttles it
+    max_retries = 6
+
+    def __init__(self, context: str, kubeconfig: dict):
+        self.context = context
+
+        self.token = None
+        self.token_file = None
+        self.exec_credentials = None
+        self.client_cert = None
+
+        if context == "" and not kubeconfig["contexts"]:
+            self._load_incluster()
+        else:
+            self._load_kubeconfig(context or kubeconfig["current-context"], kubeconfig)
+
+        self._http = None
+        self._http_client_cert = None
+        # Map of apiVersion -> {kind: (plural, namespaced)}, populated from API discovery
+        self._discovery = {}
+        # Limits set by spawners, unlimited until then
+        self.admission = AdmissionController(context)
+
+    def _load_incluster(self):
+        host = os.environ["KUBERNETES_SERVICE_HOST"]
+        port = os.environ["KUBERNETES_SERVICE_PORT"]
+        self.server = f"https://{host}:{port}"
+        self.ca = {"cafile": os.path.join(SERVICE_ACCOUNT_DIR, "ca.crt")}
+        self.insecure = False
+        self.token_file = os.path.join(SERVICE_ACCOUNT_DIR, "token")
+
+    def _load_kubeconfig(self, context_name: str, kubeconfig: dict):
+        if context_name not in kubeconfig["contexts"]:
+            raise ValueError(f"Context {context_name} not found in kubeconfig")
+        context = kubeconfig["contexts"][context_name]
+        cluster = kubeconfig["clusters"][context["cluster"]]
+        user = kubeconfig["users"].get(context.get("user"), {})
+
+        self.server = cluster["server"].rstrip("/")
+        self.insecure = cluster.get("insecure-skip-tls-verify", False)
+        if "certificate-authority-data" in cluster:
+            self.ca = {
+                "cadata": base64.b64decode(
+                    cluster["certificate-authority-data"]
+                ).decode()
+            }
+        elif "certificate-authority" in cluster:
+            self.ca = {
+                "cafile": os.path.join(
+                    cluster["_base_dir"], cluster["certificate-authority"]
+                )
+            }
+        else:
+            self.ca = {}
+
+        base_dir = user.get("_base_dir", "")
+        if "client-certificate-data" in user:
+            self.client_cert = (
+                user["client-certificate-data"],
+                user["client-key-data"],
+            )
+        elif "client-certificate" in user:
+            with open(os.path.join(base_dir, user["client-certificate"]), "rb") as f:
+                cert = base64.b64encode(f.read()).decode()
+            with open(os.path.join(base_dir, user["client-key"]), "rb") as f:
+                key = base64.b64encode(f.read()).decode()
+            self.client_cert = (cert, key)
+
+        if "token" in user:
+            self.token = user["token"]
+        elif "tokenFile" in user:
+            self.token_file = os.path.join(base_dir, user["tokenFile"])
+        elif "exec" in user:
+            self.exec_credentials = get_exec_credentials(
+                context_name, user["exec"], cluster, base_dir
+            )
+        elif "auth-provider" in user:
+            raise ValueError(
+                f"Context {context_name} uses the deprecated auth-provider mechanism, "
+                "switch to an exec based credential plugin instead"
+            )
+
+    async def _credentials(self):
+        """
+        Return (token, client_cert) to use for the next request
+        """
+        if self.exec_credentials:
+            token, client_cert = await self.exec_credentials.get()
+            return token, client_cert or self.client_cert
+        if self.token_file:
+            # Projected service account tokens are rotated on disk by the kubelet
+            with open(self.token_file) as f:
+                return f.read().strip(), self.client_cert
+        return self.token, self.client_cert
+
+    def _make_ssl_context(self, client_cert) -> ssl.SSLContext:
+        context = ssl.create_default_context(**self.ca)
+        if self.insecure:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if client_cert:
+            # ssl can only load client certificates from files
+            with tempfile.TemporaryDirectory() as d:
+                cert_path = os.path.join(d, "client.crt")
+                key_path = os.path.join(d, "client.key")
+                with open(cert_path, "wb") as f:
+                    f.write(base64.b64decode(client_cert[0]))
+                with open(key_path, "wb") as f:
+                    f.write(base64.b64decode(client_cert[1]))
+                context.load_cert_chain(cert_path, key_path)
+        return context
+
+    def _http_client(self, client_cert) -> httpx.AsyncClient:
+        """
+        Return the pooled http client to use, recreating it if our client certificate changed
+        """
+        if self._http is None or client_cert != self._http_client_cert:
+            if self._http is not None:
+                # Let in-flight requests on the old client finish before closing it
+                asyncio.ensure_future(self._close_later(self._http))
+            self._http = httpx.AsyncClient(
+                base_url=self.server,
+                verify=self._make_ssl_context(client_cert),
+                http2=True,
+                timeout=httpx.Timeout(30, connect=10),
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            )
+            self._http_client_cert = client_cert
+        return self._http
+
+    async def _close_later(self, http: httpx.AsyncClient, delay: int = 60):
+        await asyncio.sleep(delay)
+        await http.aclose()
+
+    async def _send(self, method: str, path: str, stream: bool = False, **kwargs):
+        """
+        Send a request with current credentials
+
+        Mutating requests wait to be admitted by the admission controller first.
+        Re-authenticates once on a 401, and backs off and retries when the API
+        server throttles us or is unavailable.
+        """
+        reauthenticated = False
+        retries = 0
+        while True:
+            token, client_cert = await self._credentials()
+            headers = kwargs.pop("headers", {})
+            if token:
+                headers["Authorization"] = f"Bearer {token}"
+            kwargs["headers"] = headers
+            http = self._http_client(client_cert)
+            request = http.build_request(method, path, **kwargs)
+            admission = (
+                self.admission.slot() if method in MUTATING_METHODS else nullcontext()
+            )
+            async with admission:
+                response = await http.send(request, stream=stream)
+            API_REQUESTS.labels(
+                context=self.context, method=method, code=response.status_code
+            ).inc()
+            if (
+                response.status_code == 401
+                and self.exec_credentials is not None
+                and not reauthenticated
+            ):
+                # Our cached token may have been revoked before it expired
+                API_RETRIES.labels(context=self.context, reason="unauthorized").inc()
+                await response.aclose()
+                self.exec_credentials.invalidate()
+                reauthenticated = True
+                continue
+            if (
+                response.status_code in RETRY_STATUS_CODES
+                and retries < self.max_retries
+            ):
+                reason = RETRY_STATUS_CODES[response.status_code]
+                API_RETRIES.labels(context=self.context, reason=reason).inc()
+                delay = retry_delay(response, retries)
+                await response.aclose()
+                log.debug(
+                    f"{method} {path} in context {self.context} {reason}, retrying in {delay:.1f}s"
+                )
+                retries += 1
+                # The admission slot is given up while we wait, so others can go ahead
+                await asyncio.sleep(delay)
+                continue
+            return response
+
+    def _raise_for_status(self, response: httpx.Response):
+        if response.status_code >= 400:
+            try:
+                status = response.json()
+                reason = status.get("reason", response.reason_phrase)
+                message = status.get("message", response.text)
+            except ValueError:
+                reason = response.reason_phrase
+                message = response.text
+            raise KubernetesAPIError(response.status_code, reason, message)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params: dict = None,
+        body=None,
+        content_type: str = "application/json",
+        headers: dict = None,
+    ):
+        """
+        Make a request to the kubernetes API, and return the decoded JSON response
+
+        Raises KubernetesAPIError for any error response from the API server.
+        """
+        kwargs = {"params": params, "headers": dict(headers or {})}
+        if body is not None:
+            kwargs["content"] = json.dumps(body).encode()
+            kwargs["headers"]["Content-Type"] = content_type
+        response = await self._send(method, path, **kwargs)
+        self._raise_for_status(response)
+        return response.json()
+
+    async def readyz(self):
+        """
+        Check that the API server is ready to serve requests, raising if it is not
+        """
+        response = await self._send("GET", "/readyz")
+        self._raise_for_status(response)
+
+    async def _resource_info(self, api_version: str, kind: str):
+        """
+        Return (plural, namespaced) for given kind, looking it up via API discovery
+        """
+        if kind not in self._discovery.get(api_version, {}):
+            # Re-discover, in case a CRD has been installed since we last looked
+            base = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+            resource_list = await self.request("GET", base)
+            self._discovery[api_version] = {
+                r["kind"]: (r["name"], r["namespaced"])
+                for r in resource_list["resources"]
+                # Skip subresources like pods/log
+                if "/" not in r["name"]
+            }
+            if kind not in self._discovery[api_version]:
+                raise ValueError(
+                    f"Resource kind {kind} not found in {api_version} in context {self.context}"
+                )
+        return self._discovery[api_version][kind]
+
+    async def resource_path(
+        self, api_version: str, kind: str, namespace: str = None, name: str = None
+    ) -> str:
+        """
+        Construct the API path to a resource, or a collection of resources
+        """
+        plural, namespaced = await self._resource_info(api_version, kind)
+        base = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+        if namespaced and namespace:
+            path = f"{base}/namespaces/{namespace}/{plural}"
+        elif namespaced and name:
+            raise ValueError(f"{kind} {name} requires a namespace")
+        else:
+            # Collections of namespaced kinds without a namespace span all namespaces
+            path = f"{base}/{plural}"
+        if name:
+            path = f"{path}/{name}"
+        return path
+
+    async def apply(
+        self, obj: dict, namespace: str = None, field_manager: str = FIELD_MANAGER
+    ) -> dict:
+        """
+        Create or update given object with server side apply
+
+        namespace is used if the object does not specify one itself.
+        """
+        metadata = obj["metadata"]
+        path = await self.resource_path(
+            obj["apiVersion"],
+            obj["kind"],
+            metadata.get("namespace", namespace),
+            metadata["name"],
+        )
+        return await self.request(
+            "PATCH",
+            path,
+            params={"fieldManager": field_manager, "force": "true"},
+            body=obj,
+            content_type=PATCH_CONTENT_TYPES["apply"],
+        )
+
+    async def create(self, obj: dict, namespace: str = None) -> dict:
+        """
+        Create a new object, failing if it already exists
+        """
+        path = await self.resource_path(
+            obj["apiVersion"], obj["kind"], obj["metadata"].get("namespace", namespace)
+        )
+        return await self.request(
+            "POST", path, params={"fieldManager": FIELD_MANAGER}, body=obj
+        )
+
+    async def replace(self, obj: dict, namespace: str = None) -> dict:
+        """
+        Replace an existing object
+
+        Fails with a 409 Conflict if obj has a metadata.resourceVersion, and the
+        object has been changed since it was read at that version.
+        """
+        metadata = obj["metadata"]
+        path = await self.resource_path(
+            obj["apiVersion"],
+            obj["kind"],
+            metadata.get("namespace", namespace),
+            metadata["name"],
+        )
+        return await self.request(
+            "PUT", path, params={"fieldManager": FIELD_MANAGER}, body=obj
+        )
+
+    async def patch(
+        self,
+        api_version: str,
+        kind: str,
+        name: str,
+        patch,
+        namespace: str = None,
+        patch_type: str = "strategic",
+    ) -> dict:
+        """
+        Patch an existing object. patch_type is one of strategic, merge or json
+        """
+        path = await self.resource_path(api_version, kind, namespace, name)
+        return await self.request(
+            "PATCH",
+            path,
+            body=patch,
+            content_type=PATCH_CONTENT_TYPES[patch_type],
+        )
+
+    async def get(
+        self, api_version: str, kind: str, name: str, namespace: str = None
+    ) -> dict:
+        """
+        Get an object, returning None if it does not exist
+        """
+        path = await self.resource_path(api_version, kind, namespace, name)
+        try:
+            return await self.request("GET", path)
+        except KubernetesAPIError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    async def get_metadata(
+        self, api_version: str, kind: str, name: str, namespace: str = None
+    ) -> dict:
+        """
+        Get just the metadata of an object, returning None if it does not exist
+        """
+        path = await self.resource_path(api_version, kind, namespace, name)
+        try:
+            return await self.request(
+                "GET",
+                path,
+                headers={
+                    "Accept": "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1"
+                },
+            )
+        except KubernetesAPIError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    async def list(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str = None,
+        label_selector: str = None,
+        field_selector: str = None,
+        page_size: int = 500,
+    ) -> dict:
+        """
+        List objects of a kind, in a namespace or across all namespaces
+
+        Returns the List object, so callers have access to its resourceVersion.
+        Large lists are fetched page_size objects at a time, like kubectl does, so
+        neither the API server nor we have to hold them in one response. All pages
+        come from the same snapshot.
+        """
+        _, namespaced = await self._resource_info(api_version, kind)
+        path = await self.resource_path(
+            api_version, kind, namespace if namespaced else None
+        )
+        params = {"limit": page_size}
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        result = page = await self.request("GET", path, params=params)
+        while page["metadata"].get("continue"):
+            params["continue"] = page["metadata"]["continue"]
+            page = await self.request("GET", path, params=params)
+            result["items"].extend(page["items"])
+        result["metadata"].pop("continue", None)
+        return result
+
+    async def delete(
+        self,
+        api_version: str,
+        kind: str,
+        name: str,
+        namespace: str = None,
+        propagation_policy: str = "Background",
+    ) -> dict:
+        """
+        Delete an object, returning None if it was already gone
+        """
+        path = await self.resource_path(api_version, kind, namespace, name)
+        try:
+            return await self.request(
+                "DELETE", path, params={"propagationPolicy": propagation_policy}
+            )
+        except KubernetesAPIError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    async def delete_collection(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str = None,
+        label_selector: str = None,
+        propagation_policy: str = "Background",
+    ) -> dict:
+        """
+        Delete all objects of a kind matching label_selector, in one request
+
+        Returns as soon as the API server has accepted the deletion, without
+        waiting for objects to actually go away.
+        """
+        _, namespaced = await self._resource_info(api_version, kind)
+        path = await self.resource_path(
+            api_version, kind, namespace if namespaced else None
+        )
+        params = {"propagationPolicy": propagation_policy}
+        if label_selector:
+            params["labelSelector"] = label_selector
+        return await self.request("DELETE", path, params=params)
+
+    async def watch(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str = None,
+        label_selector: str = None,
+        field_selector: str = None,
+        resource_version: str = None,
+        timeout: int = 300,
+    ):
+        """
+        Async generator yielding watch events for objects of a kind
+
+        Each event is a dict with `type` (ADDED, MODIFIED, DELETED, BOOKMARK or
+        ERROR) and `object`. The watch ends after `timeout` seconds.
+        """
+        _, namespaced = await self._resource_info(api_version, kind)
+        path = await self.resource_path(
+            api_version, kind, namespace if namespaced else None
+        )
+        params = {"watch": "1", "timeoutSeconds": str(timeout)}
+        if label_selector:
+            params["labelSelector"] = label_selector
+        if field_selector:
+            params["fieldSelector"] = field_selector
+        if resource_version:
+            params["resourceVersion"] = resource_version
+            params["allowWatchBookmarks"] = "true"
+
+        response = await self._send(
+            "GET",
+            path,
+            stream=True,
+            params=params,
+            timeout=httpx.Timeout(timeout + 10, connect=10),
+        )
+        try:
+            if response.status_code >= 400:
+                await response.aread()
+                self._raise_for_status(response)
+            async for line in response.aiter_lines():
+                if line:
+                    yield json.loads(line)
+        finally:
+            await response.aclose()
+
+    async def _wait_for_selector(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str,
+        condition,
+        timeout: float,
+        field_selector: str = None,
+        label_selector: str = None,
+        wait_for_creation: bool = False,
+    ) -> bool:
+        """
+        Wait for condition(obj) to become true for any object matching the selectors
+
+        Unless wait_for_creation is set, returns False as soon as no objects match.
+        """
+        objs = await self.list(
+            api_version,
+            kind,
+            namespace,
+            field_selector=field_selector,
+            label_selector=label_selector,
+        )
+        if not objs["items"] and not wait_for_creation:
+            return False
+        if any(condition(obj) for obj in objs["items"]):
+            return True
+
+        resource_version = objs["metadata"]["resourceVersion"]
+        remaining = {obj["metadata"]["name"] for obj in objs["items"]}
+
+        async def _wait():
+            nonlocal resource_version
+            while True:
+                async for event in self.watch(
+                    api_version,
+                    kind,
+                    namespace,
+                    field_selector=field_selector,
+                    label_selector=label_selector,
+                    resource_version=resource_version,
+                    timeout=max(int(timeout), 1),
+                ):
+                    if event["type"] == "ERROR":
+                        raise KubernetesAPIError(
+                            event["object"].get("code", 500),
+                            event["object"].get("reason", ""),
+                            event["object"].get("message", ""),
+                        )
+                    obj = event["object"]
+                    resource_version = obj["metadata"]["resourceVersion"]
+                    if event["type"] == "BOOKMARK":
+                        continue
+                    if event["type"] == "DELETED":
+                        remaining.discard(obj["metadata"]["name"])
+                        if not remaining and not wait_for_creation:
+                            return False
+                        continue
+                    remaining.add(obj["metadata"]["name"])
+                    if condition(obj):
+                        return True
+
+        try:
+            return await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+    async def wait_for(
+        self,
+        api_version: str,
+        kind: str,
+        name: str,
+        namespace: str,
+        condition,
+        timeout: float = 30,
+        wait_for_creation: bool = False,
+    ) -> bool:
+        """
+        Wait for condition(obj) to become true for a given object
+
+        Returns False if the object does not exist (unless wait_for_creation
+        is set), is deleted, or the condition is not met before timeout seconds.
+        """
+        return await self._wait_for_selector(
+            api_version,
+            kind,
+            namespace,
+            condition,
+            timeout,
+            field_selector=f"metadata.name={name}",
+            wait_for_creation=wait_for_creation,
+        )
+
+    async def wait_for_any(
+        self,
+        api_version: str,
+        kind: str,
+        namespace: str,
+        label_selector: str,
+        condition,
+        timeout: float = 30,
+    ) -> bool:
+        """
+        Wait for condition(obj) to become true for any object matching label_selector
+
+        Objects that do not exist yet are waited for. Returns False on timeout.
+        """
+        return await self._wait_for_selector(
+            api_version,
+            kind,
+            namespace,
+            condition,
+            timeout,
+            label_selector=label_selector,
+            wait_for_creation=True,
+        )
+
+    async def wait_for_deletion(
+        self,
+        api_version: str,
+        kind: str,
+        name: str,
+        namespace: str = None,
+        timeout: float = None,
+    ) -> bool:
+        """
+        Wait for an object to be fully deleted, returning False on timeout
+        """
+
+        async def _wait():
+            while await self.get(api_version, kind, name, namespace) is not None:
+                await asyncio.sleep(1)
+            return True
+
+        try:
+            return await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+
+
+# Clients for each kubeconfig context, shared across all spawners
+_clients = {}
+
+
+def get_client(context: str) -> KubernetesClient:
+    """
+    Return the shared client for a given kubeconfig context
+
+    An empty context uses the kubeconfig's current-context, or the pod's own
+    service account if we are running inside a cluster with no kubeconfig.
+    """
+    if context not in _clients:
+        _clients[context] = KubernetesClient(context, load_kubeconfig())
+    return _clients[context]
@@ -0,0 +1,97 @@
+"""
+Health of each target cluster, with a circuit breaker
+
+A prober per kubeconfig context checks that its API server is ready every few
+seconds. After a number of failed checks in a row, the circuit for the cluster
+opens: spawns onto it fail right away instead of waiting for network timeouts,
+polls of its servers are put off, and its profiles are marked as degraded in
+the options form. The circuit closes again as soon as a check succeeds.
+"""
+import asyncio
+import logging
+import random
+
+from .client import get_client
+from .metrics import CLUSTER_HEALTHY
+
+log = logging.getLogger(__name__)
+
+
+class ClusterHealth:
+    """
+    Checks the API server of a cluster in the background, tracking whether it is reachable
+    """
+
+    # Seconds a check may take before it counts as failed
+    timeout = 5
+
+    def __init__(self, context: str, interval: int = 10, failure_threshold: int = 3):
+        self.context = context
+        self.interval = interval
+        self.failure_threshold = failure_threshold
+        # Checks that failed in a row, and the error of the latest one
+        self.failures = 0
+        self.last_error = None
+        self._task = None
+
+    @property
+    def is_open(self) -> bool:
+        """
+        True if the cluster is considered unreachable
+        """
+        return self.failures >= self.failure_threshold
+
+    def start(self):
+        """
+        Start checking in the background, if not already started
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def check(self):
+        """
+        Check the API server once, updating the state of the circuit
+        """
+        try:
+            await asyncio.wait_for(get_client(self.context).readyz(), self.timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e) or type(e).__name__
+            if self.failures == self.failure_threshold:
+                log.warning(
+                    f"Cluster {self.context} failed {self.failures} health checks in a row, "
+                    f"failing spawns onto it until it recovers: {self.last_error}"
+                )
+        else:
+            if self.is_open:
+                log.info(f"Cluster {self.context} is reachable again")
+            self.failures = 0
+            self.last_error = None
+        CLUSTER_HEALTHY.labels(context=self.context).set(0 if self.is_open else 1)
+
+    async def _run(self):
+        while True:
+            await self.check()
+            # Jittered, so checks of many clusters do not line up
+            await asyncio.sleep(self.interval * random.uniform(0.9, 1.1))
+
+
+# Health of each context, shared by all spawners
+_health = {}
+
+
+def get_cluster_health(
+    context: str, interval: int = 10, failure_threshold: int = 3
+) -> ClusterHealth:
+    """
+    Return the shared, running health prober for a context
+    """
+    if context not in _health:
+        _health[context] = ClusterHealth(context, interval, failure_threshold)
+    health = _health[context]
+    health.interval = interval
+    health.failure_threshold = failure_threshold
+    health.start()
+    return health
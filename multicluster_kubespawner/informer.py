@@ -0,0 +1,263 @@
+"""
+In-memory caches of kubernetes objects, kept up to date with watches
+
+Instead of asking the kubernetes API about each user server separately, a
+single reflector per cluster lists all objects we care about once, and then
+watches for changes. Spawners can then look up the state of their objects
+locally, without any network calls.
+"""
+import asyncio
+import logging
+import random
+
+from .client import KubernetesAPIError, get_client
+from .metrics import WATCH_RESTARTS
+
+log = logging.getLogger(__name__)
+
+# Label carrying the key of the spawner that created an object
+KEY_LABEL = "mcks.hub.jupyter.org/key"
+
+
+def _uid(obj: dict):
+    return obj["metadata"].get("uid")
+
+
+def _replaces(obj: dict, other: dict) -> bool:
+    """
+    Whether obj should be cached instead of another object with the same index
+
+    Objects being deleted only replace others that are being deleted too.
+    """
+    return bool(other["metadata"].get("deletionTimestamp")) or not obj["metadata"].get(
+        "deletionTimestamp"
+    )
+
+
+class ResourceReflector:
+    """
+    Local copy of all objects of one kind matching a label selector in a cluster
+
+    Objects are indexed by (namespace, value of index_label), or by
+    (namespace, name) if index_label is None. When more than one object has
+    the same index, the one not being deleted is kept.
+    """
+
+    # How long each watch request to the API server lasts before it is renewed
+    watch_timeout = 300
+
+    def __init__(
+        self,
+        context: str,
+        api_version: str,
+        kind: str,
+        label_selector: str,
+        index_label: str = KEY_LABEL,
+    ):
+        self.context = context
+        self.api_version = api_version
+        self.kind = kind
+        self.label_selector = label_selector
+        self.index_label = index_label
+
+        self.objects = {}
+        self.resource_version = None
+        self.synced = asyncio.Event()
+
+        # Events set whenever the object with a particular index changes
+        self._changed = {}
+        self._task = None
+
+    def start(self):
+        """
+        Start listing and watching in the background, if not already started
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def _index(self, obj: dict):
+        metadata = obj["metadata"]
+        if self.index_label is None:
+            return (metadata.get("namespace"), metadata["name"])
+        return (
+            metadata.get("namespace"),
+            metadata.get("labels", {}).get(self.index_label),
+        )
+
+    def _notify(self, index):
+        if index in self._changed:
+            self._changed.pop(index).set()
+
+    def _update(self, event_type: str, obj: dict):
+        index = self._index(obj)
+        stored = self.objects.get(index)
+        if stored is not None and _uid(stored) != _uid(obj):
+            # Another object with the same index, like the pod of a restarted
+            # server while the previous one is still shutting down. Events
+            # about the one on its way out must not remove or replace it.
+            if event_type == "DELETED" or not _replaces(obj, stored):
+                return
+        if event_type == "DELETED":
+            self.objects.pop(index, None)
+        else:
+            self.objects[index] = obj
+        self._notify(index)
+
+    async def _list(self):
+        client = get_client(self.context)
+        resp = await client.list(
+            self.api_version, self.kind, label_selector=self.label_selector
+        )
+        old_indexes = set(self.objects)
+        self.objects = {}
+        for obj in resp["items"]:
+            index = self._index(obj)
+            if index not in self.objects or _replaces(obj, self.objects[index]):
+                self.objects[index] = obj
+        self.resource_version = resp["metadata"]["resourceVersion"]
+        for index in old_indexes | set(self.objects):
+            self._notify(index)
+
+    async def _watch(self):
+        client = get_client(self.context)
+        async for event in client.watch(
+            self.api_version,
+            self.kind,
+            label_selector=self.label_selector,
+            resource_version=self.resource_version,
+            timeout=self.watch_timeout,
+        ):
+            if event["type"] == "ERROR":
+                status = event["object"]
+                raise KubernetesAPIError(
+                    status.get("code", 500),
+                    status.get("reason", ""),
+                    status.get("message", ""),
+                )
+            self.resource_version = event["object"]["metadata"]["resourceVersion"]
+            if event["type"] != "BOOKMARK":
+                self._update(event["type"], event["object"])
+
+    async def _run(self):
+        backoff = 1
+        while True:
+            try:
+                if self.resource_version is None:
+                    await self._list()
+                    self.synced.set()
+                    backoff = 1
+                await self._watch()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if isinstance(e, KubernetesAPIError) and e.status_code == 410:
+                    # Our resourceVersion is too old, a fresh list is needed
+                    WATCH_RESTARTS.labels(
+                        context=self.context, kind=self.kind, reason="expired"
+                    ).inc()
+                    log.debug(f"Relisting {self.kind} in {self.context}: {e}")
+                else:
+                    WATCH_RESTARTS.labels(
+                        context=self.context, kind=self.kind, reason="error"
+                    ).inc()
+                    log.warning(
+                        f"Error watching {self.kind} in context {self.context}, retrying in {backoff}s: {e}"
+                    )
+                    await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                    backoff = min(backoff * 2, 60)
+                self.resource_version = None
+
+    def get(self, namespace: str, key: str) -> dict:
+        """
+        Return the cached object for given namespace & index label value, or None
+        """
+        return self.objects.get((namespace, key))
+
+    async def wait_for_sync(self, timeout: float = None) -> bool:
+        """
+        Wait for the initial list to complete, returning False on timeout
+        """
+        self.start()
+        try:
+            await asyncio.wait_for(self.synced.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def wait_for(
+        self,
+        namespace: str,
+        key: str,
+        condition,
+        timeout: float = 30,
+        wait_for_creation: bool = False,
+    ) -> bool:
+        """
+        Wait for condition(obj) to become true for the cached object
+
+        Returns False immediately if the object does not exist (unless
+        wait_for_creation is set), or when it is deleted, or when condition
+        is not met before timeout seconds.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        index = (namespace, key)
+        while True:
+            obj = self.objects.get(index)
+            if obj is None:
+                if not wait_for_creation:
+                    return False
+            elif condition(obj):
+                return True
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            changed = self._changed.setdefault(index, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+
+    async def wait_for_deletion(
+        self, namespace: str, key: str, timeout: float = 30
+    ) -> bool:
+        """
+        Wait for the cached object to be gone, returning False on timeout
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        index = (namespace, key)
+        while index in self.objects:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            changed = self._changed.setdefault(index, asyncio.Event())
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+# Reflectors shared by all spawners, keyed by context, apiVersion, kind & label selector
+_reflectors = {}
+
+
+def get_reflector(
+    context: str,
+    api_version: str,
+    kind: str,
+    label_selector: str = KEY_LABEL,
+    index_label: str = KEY_LABEL,
+) -> ResourceReflector:
+    """
+    Return the shared, running reflector for given kind of objects in a context
+    """
+    reflector_key = (context, api_version, kind, label_selector)
+    if reflector_key not in _reflectors:
+        _reflectors[reflector_key] = ResourceReflector(
+            context, api_version, kind, label_selector, index_label
+        )
+    reflector = _reflectors[reflector_key]
+    reflector.start()
+    return reflector
@@ -0,0 +1,97 @@
+"""
+Prometheus metrics about the spawner and the clusters it targets
+
+Metrics are registered on the default prometheus_client registry, which
+JupyterHub serves at /hub/metrics.
+"""
+import time
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+PHASE_DURATION = Histogram(
+    "mcks_phase_duration_seconds",
+    "Time spent in each phase of starting, stopping and polling servers",
+    ["operation", "phase", "context", "profile"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float("inf")),
+)
+
+PHASE_FAILURES = Counter(
+    "mcks_phase_failures",
+    "Phases of starting, stopping and polling servers that raised an exception",
+    ["operation", "phase", "context", "profile"],
+)
+
+API_REQUESTS = Counter(
+    "mcks_api_requests",
+    "Requests made to kubernetes API servers, by HTTP status code",
+    ["context", "method", "code"],
+)
+
+API_RETRIES = Counter(
+    "mcks_api_retries",
+    "Requests to kubernetes API servers that were retried",
+    ["context", "reason"],
+)
+
+ROUTE_PROBE_RETRIES = Counter(
+    "mcks_route_probe_retries",
+    "Requests to user servers via the ingress controller that were retried",
+    ["context"],
+)
+
+EXEC_PLUGIN_RUNS = Counter(
+    "mcks_exec_plugin_runs",
+    "Runs of kubeconfig exec credential plugins",
+    ["context", "result"],
+)
+
+ADMISSION_WAITING = Gauge(
+    "mcks_api_admission_waiting",
+    "Mutating requests to kubernetes API servers waiting to be admitted",
+    ["context"],
+)
+
+WATCH_RESTARTS = Counter(
+    "mcks_watch_restarts",
+    "Watches of the kubernetes API that were restarted after an error",
+    ["context", "kind", "reason"],
+)
+
+CLUSTER_HEALTHY = Gauge(
+    "mcks_cluster_healthy",
+    "1 if the API server of a cluster passes health checks, 0 if its circuit is open",
+    ["context"],
+)
+
+PREPULLER_NODES = Gauge(
+    "mcks_prepuller_nodes",
+    "Nodes the image pre-puller DaemonSet should run on (desired) and has pulled all images on (ready)",
+    ["context", "state"],
+)
+
+PREPULLER_IMAGES = Gauge(
+    "mcks_prepuller_images",
+    "Number of images the image pre-puller pulls onto each node",
+    ["context"],
+)
+
+
+@contextmanager
+def time_phase(operation: str, phase: str, labels):
+    """
+    Record how long the with block takes, and whether it fails
+
+    labels is called when the block ends to get the context and profile, as
+    they might be decided while the block runs.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        PHASE_FAILURES.labels(operation=operation, phase=phase, **labels()).inc()
+        raise
+    finally:
+        PHASE_DURATION.labels(operation=operation, phase=phase, **labels()).observe(
+            time.perf_counter() - start
+        )
@@ -0,0 +1,290 @@
+"""
+Pure python implementation of kubernetes strategic merge patch
+
+Follows the semantics of `kubectl patch --type=strategic --local`, so patches
+can be applied to rendered resources without spawning a kubectl process for
+each of them. The patch strategy and merge key of each list field is not read
+from the OpenAPI schema of the cluster, but from a table of the well known list
+fields of the built-in kubernetes types below.
+
+https://github.com/kubernetes/community/blob/master/contributors/devel/sig-api-machinery/strategic-merge-patch.md
+"""
+import copy
+
+# API groups of built-in kubernetes types, that support strategic merge patch.
+# Objects from other API groups (custom resources) can only be patched with
+# JSON merge patch semantics.
+BUILTIN_API_GROUPS = {
+    "",
+    "apps",
+    "autoscaling",
+    "batch",
+    "discovery.k8s.io",
+    "networking.k8s.io",
+    "node.k8s.io",
+    "policy",
+    "rbac.authorization.k8s.io",
+    "scheduling.k8s.io",
+    "storage.k8s.io",
+}
+
+# Merge key for list fields with patchStrategy=merge, by field name.
+# An empty string means a list of primitives that is merged as a set.
+# Lists not listed here are replaced entirely by the patch.
+MERGE_KEYS = {
+    "conditions": "type",
+    "containers": "name",
+    "env": "name",
+    "ephemeralContainers": "name",
+    "finalizers": "",
+    "hostAliases": "ip",
+    "imagePullSecrets": "name",
+    "initContainers": "name",
+    "ownerReferences": "uid",
+    "resourceClaims": "name",
+    "schedulingGates": "name",
+    "topologySpreadConstraints": "topologyKey",
+    "volumeDevices": "devicePath",
+    "volumeMounts": "mountPath",
+    "volumes": "name",
+}
+
+CONTAINER_FIELDS = {"containers", "initContainers", "ephemeralContainers"}
+
+DIRECTIVE = "$patch"
+RETAIN_KEYS = "$retainKeys"
+DELETE_FROM_PRIMITIVE_LIST = "$deleteFromPrimitiveList/"
+SET_ELEMENT_ORDER = "$setElementOrder/"
+
+# Returned when a map patch has `$patch: delete`
+_DELETE = object()
+
+
+def _merge_key(path: tuple, kind: str):
+    """
+    Return merge key for list at given path, or None if the list is not merged
+    """
+    field = path[-1]
+    if field == "ports":
+        if len(path) > 1 and path[-2] in CONTAINER_FIELDS:
+            return "containerPort"
+        if kind == "Service" and path == ("spec", "ports"):
+            return "port"
+        return None
+    return MERGE_KEYS.get(field)
+
+
+def _index(items: list, item, merge_key: str) -> int:
+    """
+    Find position of item in items, comparing by merge_key if set
+    """
+    for i, candidate in enumerate(items):
+        if merge_key:
+            if isinstance(candidate, dict) and candidate.get(merge_key) == item.get(
+                merge_key
+            ):
+                return i
+        elif candidate == item:
+            return i
+    return -1
+
+
+def _normalize_order(
+    patch_items: list,
+    server_only: list,
+    patch_order: list,
+    server_order: list,
+    merge_key: str,
+) -> list:
+    """
+    Order merged list items the same way the kubernetes apiserver does
+
+    Items from the patch keep their order relative to each other, as do items
+    present only in the original. The two are then interleaved based on their
+    position in the original list.
+    """
+    patch_items = sorted(
+        patch_items, key=lambda item: _index(patch_order, item, merge_key)
+    )
+    server_only = sorted(
+        server_only, key=lambda item: _index(server_order, item, merge_key)
+    )
+
+    merged = []
+    i = j = 0
+    while i < len(server_only) or j < len(patch_items):
+        if i >= len(server_only):
+            merged.append(patch_items[j])
+            j += 1
+        elif j >= len(patch_items):
+            merged.append(server_only[i])
+            i += 1
+        else:
+            li = _index(server_order, server_only[i], merge_key)
+            ri = _index(server_order, patch_items[j], merge_key)
+            if li >= 0 and ri >= 0:
+                take_left = li < ri
+            else:
+                # Items not in the original go after those that are
+                take_left = li > ri
+            if take_left:
+                merged.append(server_only[i])
+                i += 1
+            else:
+                merged.append(patch_items[j])
+                j += 1
+    return merged
+
+
+def _merge_list(
+    original: list, patch: list, path: tuple, kind: str, element_order: list = None
+) -> list:
+    merge_key = _merge_key(path, kind)
+    if merge_key is None:
+        # No patch strategy, so the patch replaces the list entirely
+        return copy.deepcopy(patch)
+
+    if merge_key == "":
+        # List of primitives, merged as a set
+        merged = list(original) + [v for v in patch if v not in original]
+        patch_items = [v for v in merged if v in patch]
+        server_only = [v for v in merged if v not in patch]
+        return _normalize_order(
+            patch_items, server_only, element_order or patch, original, merge_key
+        )
+
+    for item in patch:
+        if not isinstance(item, dict):
+            raise ValueError(
+                f"Patch for {'.'.join(path)} must be a list of objects, got {item!r}"
+            )
+        if item.get(DIRECTIVE) == "replace":
+            return [
+                _merge_map({}, i, path, kind)
+                for i in patch
+                if i.get(DIRECTIVE) != "replace"
+            ]
+
+    merged = list(original)
+    patch_order = []
+    for item in patch:
+        if merge_key not in item:
+            raise ValueError(
+                f"Patch item {item!r} for {'.'.join(path)} does not contain merge key {merge_key}"
+            )
+        index = _index(merged, item, merge_key)
+        if item.get(DIRECTIVE) == "delete":
+            merged = [m for m in merged if m.get(merge_key) != item.get(merge_key)]
+            continue
+        patch_order.append(item)
+        if index >= 0:
+            merged[index] = _merge_map(merged[index], item, path, kind)
+        else:
+            merged.append(_merge_map({}, item, path, kind))
+
+    patch_items = [m for m in merged if _index(patch_order, m, merge_key) >= 0]
+    server_only = [m for m in merged if _index(patch_order, m, merge_key) < 0]
+    return _normalize_order(
+        patch_items, server_only, element_order or patch_order, original, merge_key
+    )
+
+
+def _merge_map(original: dict, patch: dict, path: tuple, kind: str):
+    directive = patch.get(DIRECTIVE)
+    if directive == "replace":
+        return {
+            k: copy.deepcopy(v)
+            for k, v in patch.items()
+            if k != DIRECTIVE and v is not None
+        }
+    if directive == "delete":
+        return _DELETE
+
+    result = dict(original)
+
+    # Deletions from primitive lists are processed before merging anything else
+    for k, v in patch.items():
+        if k.startswith(DELETE_FROM_PRIMITIVE_LIST):
+            field = k[len(DELETE_FROM_PRIMITIVE_LIST) :]
+            if field in result:
+                result[field] = [i for i in result[field] if i not in v]
+
+    for k, v in patch.items():
+        if k in (DIRECTIVE, RETAIN_KEYS) or k.startswith(DELETE_FROM_PRIMITIVE_LIST):
+            continue
+        if k.startswith(SET_ELEMENT_ORDER):
+            field = k[len(SET_ELEMENT_ORDER) :]
+            if field not in patch and isinstance(result.get(field), list):
+                # Only the order of an existing list is being changed
+                result[field] = _merge_list(
+                    result[field], [], path + (field,), kind, element_order=v
+                )
+            continue
+
+        if v is None:
+            result.pop(k, None)
+        elif isinstance(v, dict):
+            existing = result.get(k)
+            merged = _merge_map(
+                existing if isinstance(existing, dict) else {}, v, path + (k,), kind
+            )
+            if merged is _DELETE:
+                result.pop(k, None)
+            else:
+                result[k] = merged
+        elif isinstance(v, list):
+            existing = result.get(k)
+            result[k] = _merge_list(
+                existing if isinstance(existing, list) else [],
+                v,
+                path + (k,),
+                kind,
+                element_order=patch.get(f"{SET_ELEMENT_ORDER}{k}"),
+            )
+        else:
+            result[k] = v
+
+    if RETAIN_KEYS in patch:
+        result = {k: v for k, v in result.items() if k in patch[RETAIN_KEYS]}
+
+    return result
+
+
+def json_merge_patch(original, patch):
+    """
+    Apply a JSON merge patch (RFC 7386) to original, returning the result
+    """
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+    result = dict(original) if isinstance(original, dict) else {}
+    for k, v in patch.items():
+        if v is None:
+            result.pop(k, None)
+        else:
+            result[k] = json_merge_patch(result.get(k), v)
+    return result
+
+
+def strategic_merge_patch(original: dict, patch: dict, copy_original=True) -> dict:
+    """
+    Apply a strategic merge patch to a kubernetes object, returning the result
+
+    original is not modified. Objects that are not built-in kubernetes types
+    fall back to JSON merge patch semantics, as there is no information about
+    how their lists should be merged.
+
+    If copy_original is False, the parts of original that the patch does not
+    touch are shared with the result instead of copied. Only use it when
+    original is thrown away afterwards.
+    """
+    if copy_original:
+        original = copy.deepcopy(original)
+    api_version = original.get("apiVersion", "v1")
+    group = api_version.rpartition("/")[0]
+    if group not in BUILTIN_API_GROUPS:
+        return json_merge_patch(original, patch)
+
+    merged = _merge_map(original, patch, (), original.get("kind"))
+    if merged is _DELETE:
+        raise ValueError("Patches can not delete entire resources")
+    return merged
@@ -0,0 +1,312 @@
+"""
+Capacity-aware placement of user servers onto one of many clusters
+
+Each candidate cluster's free capacity is computed from its nodes and the
+resource requests of the pods running on them. The view is cached and
+refreshed in the background, so placing a server only waits for the cluster
+to be listed the first time.
+"""
+import asyncio
+import logging
+import time
+
+from .client import get_client
+
+log = logging.getLogger(__name__)
+
+_QUANTITY_SUFFIXES = {
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+}
+
+
+def parse_quantity(quantity) -> float:
+    """
+    Parse a kubernetes resource quantity, like 500m or 4Gi, into a number
+    """
+    quantity = str(quantity)
+    for suffix in (
+        "Ki",
+        "Mi",
+        "Gi",
+        "Ti",
+        "Pi",
+        "Ei",
+        "m",
+        "k",
+        "M",
+        "G",
+        "T",
+        "P",
+        "E",
+    ):
+        if quantity.endswith(suffix):
+            return float(quantity[: -len(suffix)]) * _QUANTITY_SUFFIXES[suffix]
+    return float(quantity)
+
+
+def pod_requests(pod: dict) -> tuple:
+    """
+    Return the (cpu, memory) requested by a pod, the way the scheduler counts it
+    """
+    spec = pod["spec"]
+
+    def total(containers, resource):
+        return [
+            parse_quantity(c.get("resources", {}).get("requests", {}).get(resource, 0))
+            for c in containers
+        ]
+
+    requests = []
+    for resource in ("cpu", "memory"):
+        # Init containers run one at a time, before the other containers
+        requests.append(
+            max(
+                [sum(total(spec["containers"], resource))]
+                + total(spec.get("initContainers", []), resource)
+            )
+        )
+    return tuple(requests)
+
+
+def _node_is_schedulable(node: dict) -> bool:
+    if node["spec"].get("unschedulable"):
+        return False
+    return any(
+        c["type"] == "Ready" and c["status"] == "True"
+        for c in node.get("status", {}).get("conditions", [])
+    )
+
+
+class ClusterCapacity:
+    """
+    Allocatable and requested CPU & memory of the schedulable nodes in a cluster
+    """
+
+    def __init__(self, context: str):
+        self.context = context
+        # [allocatable cpu, allocatable memory, requested cpu, requested memory] by node name
+        self.nodes = {}
+        self.updated_at = 0
+        # (time, node name, cpu, memory) of pods placed here since the last refresh
+        self._reserved = []
+        self._lock = asyncio.Lock()
+        self._refreshing = None
+
+    @property
+    def allocatable(self) -> tuple:
+        return (
+            sum(n[0] for n in self.nodes.values()),
+            sum(n[1] for n in self.nodes.values()),
+        )
+
+    @property
+    def requested(self) -> tuple:
+        return (
+            sum(n[2] for n in self.nodes.values()),
+            sum(n[3] for n in self.nodes.values()),
+        )
+
+    async def refresh(self):
+        started = time.time()
+        client = get_client(self.context)
+        nodes, pods = await asyncio.gather(
+            client.list("v1", "Node"),
+            client.list(
+                "v1",
+                "Pod",
+                field_selector="status.phase!=Succeeded,status.phase!=Failed",
+            ),
+        )
+        capacity = {}
+        for node in nodes["items"]:
+            if not _node_is_schedulable(node):
+                continue
+            allocatable = node["status"].get("allocatable", {})
+            capacity[node["metadata"]["name"]] = [
+                parse_quantity(allocatable.get("cpu", 0)),
+                parse_quantity(allocatable.get("memory", 0)),
+                0,
+                0,
+            ]
+        for pod in pods["items"]:
+            node = capacity.get(pod["spec"].get("nodeName"))
+            if node is None:
+                continue
+            cpu, memory = pod_requests(pod)
+            node[2] += cpu
+            node[3] += memory
+        # Pods placed while we were listing might not be in the list yet
+        self._reserved = [r for r in self._reserved if r[0] >= started]
+        for _, name, cpu, memory in self._reserved:
+            if name in capacity:
+                capacity[name][2] += cpu
+                capacity[name][3] += memory
+        self.nodes = capacity
+        self.updated_at = time.time()
+
+    async def _refresh_in_background(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            log.warning(f"Failed to refresh capacity of context {self.context}: {e}")
+
+    async def get(self, max_age: float) -> "ClusterCapacity":
+        """
+        Return self, starting a background refresh if older than max_age seconds
+
+        Only the very first call waits for the cluster to be listed.
+        """
+        if not self.updated_at:
+            async with self._lock:
+                if not self.updated_at:
+                    await self.refresh()
+        elif time.time() - self.updated_at > max_age and (
+            self._refreshing is None or self._refreshing.done()
+        ):
+            self._refreshing = asyncio.ensure_future(self._refresh_in_background())
+        return self
+
+    def reserve(self, cpu: float, memory: float):
+        """
+        Count a pod that was just placed here as requested, until a refresh lists it
+
+        Without this, every placement until the next refresh would see the
+        same free capacity, and a burst of spawns would all go to one cluster.
+        The pod is counted on the node with the most free CPU it fits onto.
+        """
+        fitting = [
+            name
+            for name, n in self.nodes.items()
+            if n[0] - n[2] >= cpu and n[1] - n[3] >= memory
+        ]
+        name = max(
+            fitting or self.nodes,
+            key=lambda name: self.nodes[name][0] - self.nodes[name][2],
+            default=None,
+        )
+        if name is None:
+            return
+        self._reserved.append((time.time(), name, cpu, memory))
+        self.nodes[name][2] += cpu
+        self.nodes[name][3] += memory
+
+    def fits(self, cpu: float, memory: float) -> bool:
+        """
+        True if a pod with given requests fits onto any node right now
+        """
+        return any(
+            n[0] - n[2] >= cpu and n[1] - n[3] >= memory for n in self.nodes.values()
+        )
+
+    def utilization(self, cpu: float = 0, memory: float = 0) -> float:
+        """
+        Fraction of the scarcer of CPU & memory that is requested, after adding a pod
+        """
+        allocatable_cpu, allocatable_memory = self.allocatable
+        requested_cpu, requested_memory = self.requested
+        if not allocatable_cpu or not allocatable_memory:
+            return 1.0
+        return max(
+            (requested_cpu + cpu) / allocatable_cpu,
+            (requested_memory + memory) / allocatable_memory,
+        )
+
+
+def bin_pack(capacity: ClusterCapacity, target: dict, cpu: float, memory: float):
+    """
+    Prefer the fullest cluster, so idle clusters can scale down
+    """
+    return capacity.utilization(cpu, memory)
+
+
+def spread(capacity: ClusterCapacity, target: dict, cpu: float, memory: float):
+    """
+    Prefer the emptiest cluster
+    """
+    return -capacity.utilization(cpu, memory)
+
+
+def cheapest(capacity: ClusterCapacity, target: dict, cpu: float, memory: float):
+    """
+    Prefer the cluster with the lowest `cost`
+    """
+    return -target.get("cost", 0)
+
+
+SCORERS = {
+    "bin-pack": bin_pack,
+    "spread": spread,
+    "cheapest": cheapest,
+}
+
+# Exponentially weighted moving average of spawn duration, by context
+_spawn_latency = {}
+
+
+def record_spawn_latency(context: str, seconds: float):
+    previous = _spawn_latency.get(context, seconds)
+    _spawn_latency[context] = 0.8 * previous + 0.2 * seconds
+
+
+def spawn_latency(context: str) -> float:
+    return _spawn_latency.get(context, 0)
+
+
+_capacities = {}
+
+
+def get_capacity(context: str) -> ClusterCapacity:
+    if context not in _capacities:
+        _capacities[context] = ClusterCapacity(context)
+    return _capacities[context]
+
+
+async def choose_target(
+    targets: list, cpu: float, memory: float, scorer, max_age: float
+) -> dict:
+    """
+    Pick the target a pod with given requests should be placed on
+
+    Targets the pod fits onto are preferred, and among those the one scored
+    highest by scorer(capacity, target, cpu, memory). Recent spawn latency
+    breaks ties. Targets whose capacity can not be determined are skipped,
+    unless that is true for all of them. The pod is counted against the
+    capacity of the chosen target right away.
+    """
+    capacities = await asyncio.gather(
+        *(get_capacity(t["kubernetes_context"]).get(max_age) for t in targets),
+        return_exceptions=True,
+    )
+    candidates = []
+    for target, capacity in zip(targets, capacities):
+        if isinstance(capacity, Exception):
+            log.warning(
+                f"Could not determine capacity of context {target['kubernetes_context']}: {capacity}"
+            )
+            continue
+        candidates.append(
+            (
+                capacity.fits(cpu, memory),
+                scorer(capacity, target, cpu, memory),
+                -spawn_latency(target["kubernetes_context"]),
+                target,
+                capacity,
+            )
+        )
+    if not candidates:
+        return targets[0]
+    *_, target, capacity = max(candidates, key=lambda c: c[:3])
+    capacity.reserve(cpu, memory)
+    return target
@@ -0,0 +1,187 @@
+"""
+Image pre-puller DaemonSets, one per target cluster
+
+Pulling a large image onto a node for the first time can take minutes. To
+keep users from waiting for that, a DaemonSet with one init container per
+image is kept up to date in each cluster, so every node pulls all images
+users could be spawned with as soon as it joins.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+
+from .client import get_client
+from .informer import get_reflector
+from .metrics import PREPULLER_IMAGES, PREPULLER_NODES
+
+log = logging.getLogger(__name__)
+
+PREPULLER_LABEL = "mcks.hub.jupyter.org/prepuller"
+
+
+def prepuller_status(daemonset: dict) -> tuple:
+    """
+    Return (desired, ready) node counts of a pre-puller DaemonSet
+
+    Nodes still running a previous version of the DaemonSet are not ready, as
+    they have not pulled the current set of images.
+    """
+    status = daemonset.get("status", {})
+    desired = status.get("desiredNumberScheduled", 0)
+    if status.get("observedGeneration") != daemonset["metadata"].get("generation"):
+        return desired, 0
+    ready = min(status.get("numberReady", 0), status.get("updatedNumberScheduled", 0))
+    return desired, ready
+
+
+class ImagePrepuller:
+    """
+    Pre-puller DaemonSet in one cluster, and reporting of its progress
+
+    The DaemonSet is applied again when it changes, and when someone else
+    deletes it or changes its spec.
+    """
+
+    # Seconds between checks that the DaemonSet is still as we applied it, if
+    # no change to it shows up sooner
+    recheck_interval = 60
+
+    def __init__(self, context: str, namespace: str):
+        self.context = context
+        self.namespace = namespace
+        self.images = None
+        self.name = None
+        self.daemonset = None
+        # Hash of the namespace and DaemonSet last applied
+        self.applied = None
+        # uid & generation of the DaemonSet as we last applied it
+        self.uid = None
+        self.generation = None
+        self._task = None
+
+    @property
+    def reflector(self):
+        return get_reflector(
+            self.context,
+            "apps/v1",
+            "DaemonSet",
+            label_selector=PREPULLER_LABEL,
+            index_label=None,
+        )
+
+    def _drifted(self) -> bool:
+        """
+        Whether the DaemonSet was deleted or its spec changed since we applied it
+        """
+        if self.name is None or not self.reflector.synced.is_set():
+            return False
+        live = self.reflector.get(self.namespace, self.name)
+        return (
+            live is None
+            or live["metadata"].get("uid") != self.uid
+            or live["metadata"].get("generation", 0) > self.generation
+        )
+
+    async def _apply(self):
+        result = await get_client(self.context).apply(
+            self.daemonset, namespace=self.namespace
+        )
+        self.uid = result["metadata"].get("uid")
+        self.generation = result["metadata"].get("generation", 0)
+
+    async def update(self, daemonset: dict, images: list, namespace: str = None):
+        """
+        Apply daemonset if it, the namespace it goes in or the one in the cluster changed
+
+        A DaemonSet applied before under another name or namespace is deleted.
+        """
+        namespace = namespace or self.namespace
+        applied = hashlib.sha256(
+            json.dumps(
+                [namespace, daemonset], sort_keys=True, separators=(",", ":")
+            ).encode()
+        ).hexdigest()
+        if applied == self.applied and not self._drifted():
+            return
+        log.info(
+            f"Updating image pre-puller in context {self.context} to pull {' '.join(images)}"
+        )
+        old_name, old_namespace = self.name, self.namespace
+        self.daemonset = daemonset
+        self.name = daemonset["metadata"]["name"]
+        self.namespace = namespace
+        await self._apply()
+        if old_name is not None and (old_name, old_namespace) != (
+            self.name,
+            namespace,
+        ):
+            await get_client(self.context).delete(
+                "apps/v1", "DaemonSet", old_name, namespace=old_namespace
+            )
+        self.applied = applied
+        self.images = images
+        PREPULLER_IMAGES.labels(context=self.context).set(len(images))
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._report())
+
+    async def _report(self):
+        """
+        Log and export changes in how many nodes have pulled all images
+
+        Also applies the DaemonSet again if someone else deleted or changed it.
+        """
+        reflector = self.reflector
+        reported = None
+        while True:
+            try:
+                await reflector.wait_for_sync()
+                await reflector.wait_for(
+                    self.namespace,
+                    self.name,
+                    lambda ds: prepuller_status(ds) != reported or self._drifted(),
+                    timeout=self.recheck_interval,
+                    wait_for_creation=True,
+                )
+                if self._drifted():
+                    log.warning(
+                        f"Image pre-puller {self.name} in context {self.context} was deleted or changed, applying it again"
+                    )
+                    await self._apply()
+                    continue
+                daemonset = reflector.get(self.namespace, self.name)
+                if daemonset is None or prepuller_status(daemonset) == reported:
+                    continue
+                reported = desired, ready = prepuller_status(daemonset)
+                PREPULLER_NODES.labels(context=self.context, state="desired").set(
+                    desired
+                )
+                PREPULLER_NODES.labels(context=self.context, state="ready").set(ready)
+                if ready < desired:
+                    log.info(
+                        f"Image pre-puller in context {self.context}: {ready}/{desired} nodes have pulled all images"
+                    )
+                else:
+                    log.info(
+                        f"Image pre-puller in context {self.context}: all {desired} nodes have pulled all images"
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(
+                    f"Failed to check image pre-puller in context {self.context}: {e}"
+                )
+                await asyncio.sleep(10)
+
+
+# Pre-pullers by context
+_prepullers = {}
+
+
+def get_prepuller(context: str, namespace: str) -> ImagePrepuller:
+    """
+    Return the shared pre-puller for a context
+    """
+    if context not in _prepullers:
+        _prepullers[context] = ImagePrepuller(context, namespace)
+    return _prepullers[context]
@@ -0,0 +1,177 @@
+"""
+One root HTTPProxy per cluster, including the routes of all user servers
+
+With an Ingress per server, every server adds a separate object the ingress
+controller has to find and fold into its configuration, and starting many
+servers at once means many separate changes for it to work through. In the
+`httpproxy` routing mode, each server instead gets a small contour HTTPProxy
+without a virtual host, which contour only serves once it is included from a
+root HTTPProxy. One root per cluster includes them all, by the path prefix of
+each server.
+
+Changes to the root are batched: servers starting or stopping within
+batch_delay seconds of each other are added to or removed from it with one
+update. Updates replace the whole object at the resourceVersion it was read
+at, so a concurrent change by someone else makes the update fail with a
+conflict instead of being lost. It is then read again and retried. As the
+root lists every server in the cluster, each update writes an object whose
+size grows with the number of servers running, however few of them changed.
+"""
+import asyncio
+import logging
+
+from .client import KubernetesAPIError, get_client
+
+log = logging.getLogger(__name__)
+
+API_VERSION = "projectcontour.io/v1"
+
+
+def _prefix(include: dict):
+    """
+    Path prefix an include of the root HTTPProxy is for, if any
+    """
+    for condition in include.get("conditions", []):
+        if "prefix" in condition:
+            return condition["prefix"]
+    return None
+
+
+class RouteTable:
+    """
+    Root HTTPProxy of a cluster, with the routes to user servers added and removed in batches
+    """
+
+    # Seconds to collect changes for before writing them in one update
+    batch_delay = 0.1
+    # Times to read the root again and retry after a conflicting change
+    max_attempts = 5
+
+    def __init__(self, context: str, namespace: str, name: str, fqdn: str):
+        self.context = context
+        self.namespace = namespace
+        self.name = name
+        self.fqdn = fqdn
+        # Root as last written, so it only has to be read again after a conflict
+        self._root = None
+        # prefix -> include to add, or None to remove it. Not written yet
+        self._pending = {}
+        # Futures of callers waiting for the pending changes to be written
+        self._waiters = []
+        self._task = None
+
+    async def add(self, prefix: str, namespace: str, name: str):
+        """
+        Route requests for paths starting with prefix to the HTTPProxy name in namespace
+
+        Returns once the root HTTPProxy has been updated.
+        """
+        include = {
+            "name": name,
+            "namespace": namespace,
+            "conditions": [{"prefix": prefix}],
+        }
+        await self._change(prefix, include)
+
+    async def remove(self, prefix: str):
+        """
+        Stop routing requests for paths starting with prefix
+
+        Returns once the root HTTPProxy has been updated.
+        """
+        await self._change(prefix, None)
+
+    async def _change(self, prefix: str, include: dict):
+        self._pending[prefix] = include
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        await waiter
+
+    async def _run(self):
+        try:
+            while self._pending:
+                await asyncio.sleep(self.batch_delay)
+                changes, self._pending = self._pending, {}
+                waiters, self._waiters = self._waiters, []
+                try:
+                    await self._write(changes)
+                except Exception as e:
+                    log.error(
+                        f"Failed to update routes in HTTPProxy {self.namespace}/{self.name} "
+                        f"in context {self.context}: {e}"
+                    )
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                else:
+                    for waiter in waiters:
+                        if not waiter.done():
+                            waiter.set_result(None)
+        finally:
+            self._task = None
+
+    def _new_root(self) -> dict:
+        return {
+            "apiVersion": API_VERSION,
+            "kind": "HTTPProxy",
+            "metadata": {
+                "name": self.name,
+                "namespace": self.namespace,
+                "labels": {"mcks.hub.jupyter.org/routes": "true"},
+            },
+            "spec": {"virtualhost": {"fqdn": self.fqdn}, "includes": []},
+        }
+
+    async def _write(self, changes: dict):
+        """
+        Apply changes to the includes of the root HTTPProxy, creating it if needed
+        """
+        client = get_client(self.context)
+        for attempt in range(self.max_attempts):
+            if self._root is None:
+                self._root = await client.get(
+                    API_VERSION, "HTTPProxy", self.name, self.namespace
+                )
+            root = self._root or self._new_root()
+            includes = [
+                include
+                for include in root["spec"].get("includes", [])
+                if _prefix(include) not in changes
+            ]
+            includes += [include for include in changes.values() if include]
+            root["spec"]["includes"] = includes
+            try:
+                if self._root is None:
+                    self._root = await client.create(root)
+                else:
+                    self._root = await client.replace(root)
+            except KubernetesAPIError as e:
+                if e.status_code != 409:
+                    self._root = None
+                    raise
+                # Changed, or created, by someone else since we last read it
+                log.debug(
+                    f"HTTPProxy {self.namespace}/{self.name} changed while updating it, retrying"
+                )
+                self._root = None
+            else:
+                return
+        raise RuntimeError(
+            f"HTTPProxy {self.namespace}/{self.name} kept changing while updating it"
+        )
+
+
+# Route table of each (context, namespace, name), shared by all spawners
+_route_tables = {}
+
+
+def get_route_table(context: str, namespace: str, name: str, fqdn: str) -> RouteTable:
+    """
+    Return the shared route table for the root HTTPProxy name in namespace of a context
+    """
+    key = (context, namespace, name)
+    if key not in _route_tables:
+        _route_tables[key] = RouteTable(context, namespace, name, fqdn)
+    return _route_tables[key]
@@ -0,0 +1,415 @@
+"""
+Pre-parsed skeletons of YAML templates, filled in for each spawn
+
+Rendering resource templates and parsing the YAML they produce is the most
+expensive part of preparing a spawn, yet most of every resource is the same
+for all users. So each template is rendered and parsed once with placeholders
+instead of the strings it is given - the key, image, environment variables,
+etc - and each spawn only copies the parsed skeleton with the placeholders
+replaced by its own values.
+
+Only templates that insert values as they are, like `{{ key }}`,
+`{{ spawner.cmd | tojson }}` and for loops over them, get a skeleton. Anything
+that looks at values (if, filters, comparisons) could render differently for
+different values, so those templates are always rendered in full. Values that
+YAML could read differently than the placeholder - strings that look like
+numbers, or have YAML syntax in them - also make a template be rendered in
+full. The result is always the same as rendering and parsing the template.
+"""
+import re
+import secrets
+from textwrap import dedent
+
+from jinja2 import meta, nodes, pass_eval_context
+from ruamel.yaml.nodes import MappingNode, ScalarNode, SequenceNode
+
+from .templating import environment, get_template, load_yaml, yaml
+
+_TOKEN = f"mcks{secrets.token_hex(4)}"
+# Placeholders are inserted raw (r) or JSON encoded by tojson (j)
+PLACEHOLDER_RE = re.compile(_TOKEN + r"([rj])(\d+)x")
+
+# Strings that read the same when inserted in the middle of YAML, as long as
+# the scalar they end up in is quoted or still resolves to a string
+SAFE_RAW_RE = re.compile(r"(?:-?[A-Za-z0-9/][A-Za-z0-9._/:@+=-]*)?")
+
+YAML_STR_TAG = "tag:yaml.org,2002:str"
+
+# Variants of a skeleton to keep per template, for values that change its
+# structure - like a different number of environment variables
+MAX_VARIANTS = 16
+
+
+class _Unsupported(Exception):
+    """
+    The template or the values it is given can not be rendered from a skeleton
+    """
+
+
+# Marks values that were missing when looked up, so they have to be missing for
+# a skeleton to be used
+_MISSING = object()
+
+
+class _Placeholder(str):
+    """
+    Placeholder for a string, which refuses to be looked into
+    """
+
+    def __getattribute__(self, name):
+        if name.startswith("_"):
+            return super().__getattribute__(name)
+        raise _Unsupported(f"Template calls .{name} on a string")
+
+    def __getitem__(self, key):
+        raise _Unsupported("Template indexes into a string")
+
+    def __iter__(self):
+        raise _Unsupported("Template iterates over a string")
+
+
+def _shape(value, strings: list):
+    """
+    Describe the structure of a value, collecting the strings in it
+
+    Two values with the same shape render the same skeleton.
+    """
+    if isinstance(value, str):
+        strings.append(value)
+        return str
+    if value is None or isinstance(value, (bool, int, float)):
+        return (type(value), value)
+    if isinstance(value, dict):
+        return (dict,) + tuple((k, _shape(v, strings)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return (type(value),) + tuple(_shape(v, strings) for v in value)
+    raise _Unsupported(f"Template uses {type(value).__name__} inside a container")
+
+
+def _is_plain(value) -> bool:
+    return isinstance(value, (str, bool, int, float, dict, list, tuple)) or (
+        value is None
+    )
+
+
+class _Recorder:
+    """
+    Hands out placeholders for the values a template looks up, recording the lookups
+    """
+
+    def __init__(self):
+        # (path, shape) of each value looked up, in order
+        self.lookups = []
+        self.count = 0
+
+    def _placeholders(self, value):
+        if isinstance(value, str):
+            placeholder = _Placeholder(f"{_TOKEN}r{self.count}x")
+            self.count += 1
+            return placeholder
+        if isinstance(value, dict):
+            return {k: self._placeholders(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._placeholders(v) for v in value)
+        return value
+
+    def wrap(self, value, path: tuple):
+        if not _is_plain(value):
+            return _Proxy(value, path, self)
+        self.lookups.append((path, _shape(value, [])))
+        return self._placeholders(value)
+
+    def missing(self, path: tuple):
+        self.lookups.append((path, _MISSING))
+
+
+class _Proxy:
+    """
+    Stand-in for an object like the spawner, recording what the template looks up on it
+    """
+
+    def __init__(self, obj, path: tuple, recorder: _Recorder):
+        self._obj = obj
+        self._path = path
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        path = self._path + (("attr", name),)
+        try:
+            value = getattr(self._obj, name)
+        except AttributeError:
+            self._recorder.missing(path)
+            raise
+        return self._recorder.wrap(value, path)
+
+    def __getitem__(self, key):
+        path = self._path + (("item", key),)
+        try:
+            value = self._obj[key]
+        except (LookupError, TypeError):
+            self._recorder.missing(path)
+            raise
+        return self._recorder.wrap(value, path)
+
+    def __call__(self, *args, **kwargs):
+        if args or kwargs:
+            raise _Unsupported("Template calls a method with arguments")
+        return self._recorder.wrap(self._obj(), self._path + (("call",),))
+
+    def __str__(self):
+        raise _Unsupported(f"Template outputs a {type(self._obj).__name__}")
+
+    def __iter__(self):
+        raise _Unsupported(f"Template iterates over a {type(self._obj).__name__}")
+
+
+def _lookup(params: dict, path: tuple):
+    value = params[path[0]]
+    try:
+        for op in path[1:]:
+            if op[0] == "attr":
+                value = getattr(value, op[1])
+            elif op[0] == "item":
+                value = value[op[1]]
+            else:
+                value = value()
+    except (AttributeError, LookupError, TypeError):
+        return _MISSING
+    return value
+
+
+_original_tojson = environment.filters["tojson"]
+
+
+@pass_eval_context
+def _tojson(eval_ctx, value, indent=None):
+    """
+    tojson, marking placeholders in its output as JSON encoded
+    """
+    encoded = _original_tojson(eval_ctx, value, indent)
+    return encoded.replace(f"{_TOKEN}r", f"{_TOKEN}j")
+
+
+_skeleton_environment = environment.overlay()
+# Overlays share their filters with the environment they are created from
+_skeleton_environment.filters = dict(environment.filters, tojson=_tojson)
+
+
+def _is_simple(ast: nodes.Template) -> bool:
+    """
+    Check that a template only inserts values and loops over them
+    """
+    allowed = (
+        nodes.Output,
+        nodes.TemplateData,
+        nodes.Name,
+        nodes.Const,
+        nodes.Getattr,
+        nodes.Getitem,
+        nodes.Tuple,
+        nodes.For,
+        nodes.Call,
+        nodes.Filter,
+    )
+    for node in ast.find_all(nodes.Node):
+        if not isinstance(node, allowed):
+            return False
+        if isinstance(node, (nodes.Call, nodes.Filter)) and (
+            node.args or node.kwargs or node.dyn_args or node.dyn_kwargs
+        ):
+            return False
+        if isinstance(node, nodes.Filter) and node.name != "tojson":
+            return False
+        if isinstance(node, nodes.For) and (node.test or node.else_ or node.recursive):
+            return False
+        if isinstance(node, nodes.Getitem) and not isinstance(node.arg, nodes.Const):
+            return False
+    return True
+
+
+def _plain_scalars(node, found: set) -> set:
+    """
+    Collect the unquoted scalars with placeholders in them from a YAML node tree
+    """
+    if isinstance(node, ScalarNode):
+        if not node.style and _TOKEN in node.value:
+            found.add(node.value)
+    elif isinstance(node, MappingNode):
+        for key, value in node.value:
+            _plain_scalars(key, found)
+            _plain_scalars(value, found)
+    elif isinstance(node, SequenceNode):
+        for item in node.value:
+            _plain_scalars(item, found)
+    return found
+
+
+def _flow_placeholders(node, found: set, flow: bool = False) -> set:
+    """
+    Collect the raw placeholders in unquoted scalars inside flow collections
+
+    Unlike block context, flow context does not allow `:` in plain scalars.
+    """
+    if isinstance(node, ScalarNode):
+        if flow and not node.style:
+            found.update(
+                int(index)
+                for kind, index in PLACEHOLDER_RE.findall(node.value)
+                if kind == "r"
+            )
+    elif isinstance(node, MappingNode):
+        for key, value in node.value:
+            _flow_placeholders(key, found, flow or node.flow_style)
+            _flow_placeholders(value, found, flow or node.flow_style)
+    elif isinstance(node, SequenceNode):
+        for item in node.value:
+            _flow_placeholders(item, found, flow or node.flow_style)
+    return found
+
+
+class _Variant:
+    """
+    Parsed skeleton of a template, for values of one shape
+    """
+
+    def __init__(self, parsed, text: str):
+        self.parsed = parsed
+        # Only unquoted scalars can be read as something other than a string
+        composed = yaml.compose(text)
+        self.plain = _plain_scalars(composed, set())
+        self.flow = _flow_placeholders(composed, set())
+        self.raw = set()
+        self.json = set()
+        for kind, index in PLACEHOLDER_RE.findall(text):
+            (self.raw if kind == "r" else self.json).add(int(index))
+
+    def _fill_string(self, s: str, strings: list) -> str:
+        if _TOKEN not in s:
+            return s
+        raw = False
+
+        def replace(match):
+            nonlocal raw
+            raw = raw or match[1] == "r"
+            return strings[int(match[2])]
+
+        filled = PLACEHOLDER_RE.sub(replace, s)
+        # Without quotes around it, the filled in text could be read as a number, etc
+        if (
+            raw
+            and s in self.plain
+            and str(yaml.resolver.resolve(ScalarNode, filled, (True, False)))
+            != (YAML_STR_TAG)
+        ):
+            raise _Unsupported(f"{filled!r} might not be read as a string")
+        return filled
+
+    def _fill(self, node, strings: list):
+        if isinstance(node, str):
+            return self._fill_string(node, strings)
+        if isinstance(node, dict):
+            filled = {
+                self._fill(k, strings): self._fill(v, strings) for k, v in node.items()
+            }
+            if len(filled) != len(node):
+                raise _Unsupported("Filled in keys are duplicates")
+            return filled
+        if isinstance(node, list):
+            return [self._fill(v, strings) for v in node]
+        return node
+
+    def fill(self, strings: list):
+        for i in self.raw:
+            if not SAFE_RAW_RE.fullmatch(strings[i]) or strings[i].endswith(":"):
+                raise _Unsupported(f"{strings[i]!r} could change the YAML around it")
+            if i in self.flow and ":" in strings[i]:
+                raise _Unsupported(f"{strings[i]!r} can not be inside [] or {{}}")
+        for i in self.json:
+            # YAML does not join surrogate pairs from JSON escapes back together
+            if any(ord(c) > 0xFFFF for c in strings[i]):
+                raise _Unsupported(f"{strings[i]!r} can not be JSON encoded for YAML")
+        return self._fill(self.parsed, strings)
+
+
+class Skeleton:
+    """
+    Skeletons of a YAML template, by the shape of the values it is rendered with
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        ast = environment.parse(source)
+        self.simple = _is_simple(ast)
+        self.names = sorted(meta.find_undeclared_variables(ast))
+        self.template = (
+            _skeleton_environment.from_string(source) if self.simple else None
+        )
+        # Paths of values looked up by the template, recorded when first rendered
+        self.lookups = None
+        self.variants = {}
+
+    def _build(self, params: dict) -> tuple:
+        recorder = _Recorder()
+        placeholders = {
+            name: recorder.wrap(params[name], (name,))
+            for name in self.names
+            if name in params
+        }
+        text = self.template.render(**placeholders)
+        variant = _Variant(load_yaml(text), text)
+        return recorder.lookups, variant
+
+    def fill(self, params: dict):
+        """
+        Return the parsed template rendered with params, raising _Unsupported if a skeleton can not be used
+        """
+        if not self.simple:
+            raise _Unsupported("Template does more than insert values")
+        if self.lookups is None:
+            try:
+                self.lookups, variant = self._build(params)
+            except Exception as e:
+                self.simple = False
+                raise _Unsupported(f"Could not build skeleton: {e}") from e
+            self.variants[tuple(shape for _, shape in self.lookups)] = variant
+
+        strings = []
+        shape = tuple(
+            _MISSING if value is _MISSING else _shape(value, strings)
+            for value in (_lookup(params, path) for path, _ in self.lookups)
+        )
+        variant = self.variants.get(shape)
+        if variant is None:
+            if len(self.variants) >= MAX_VARIANTS:
+                raise _Unsupported("Too many variants of template")
+            try:
+                lookups, variant = self._build(params)
+            except Exception as e:
+                raise _Unsupported(f"Could not build skeleton: {e}") from e
+            if lookups != [(path, s) for (path, _), s in zip(self.lookups, shape)]:
+                # The template looked up different values this time around
+                self.simple = False
+                raise _Unsupported("Template looks up different values")
+            self.variants[shape] = variant
+        return variant.fill(strings)
+
+
+_skeletons = {}
+
+
+def render_yaml(source: str, params: dict, dedent_source: bool = False):
+    """
+    Render a YAML template with params, and parse it
+
+    Uses the template's skeleton when possible, which is much faster than
+    rendering and parsing it each time.
+    """
+    cache_key = (source, dedent_source)
+    if cache_key not in _skeletons:
+        _skeletons[cache_key] = Skeleton(dedent(source) if dedent_source else source)
+    try:
+        return _skeletons[cache_key].fill(params)
+    except _Unsupported:
+        return load_yaml(
+            get_template(source, dedent_source=dedent_source).render(**params)
+        )
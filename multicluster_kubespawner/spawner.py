@@ -1,19 +1,38 @@
 import asyncio
-from tornado import gen
-from io import StringIO
-from jinja2 import Template
-from textwrap import dedent
-import tempfile
+import hashlib
+import random
+import time
+import httpx
+import json
 import string
 import escapism
-from ruamel.yaml import YAML
-import json
-
-yaml = YAML(typ="safe")
+from urllib.parse import urlparse
 
 from jupyterhub.spawner import Spawner
+from jupyterhub.utils import maybe_future
+from .admission import current_owner
+from .cache import RefreshingCache
+from .client import (
+    KubernetesAPIError,
+    KubernetesClient,
+    endpoints_are_ready,
+    get_client,
+    pod_is_ready,
+    route_is_ready,
+)
+from .health import get_cluster_health
+from .informer import ResourceReflector, get_reflector
+from .metrics import ROUTE_PROBE_RETRIES, time_phase
+from .patch import strategic_merge_patch
+from .placement import SCORERS, choose_target, pod_requests, record_spawn_latency
+from .prepuller import get_prepuller
+from .routes import RouteTable, get_route_table
+from .skeleton import render_yaml
+from .sweeper import get_orphan_sweeper
+from .templating import get_template, load_yaml
+from .warmpool import get_warm_pool, make_pool_template
 from traitlets.config import Unicode, Dict, List
-from traitlets import default, Union, Callable, Integer, Bool
+from traitlets import default, Union, Callable, Integer, Bool, CaselessStrEnum
 
 
 def make_dns_safe(s: str) -> str:
@@ -27,6 +46,123 @@ def make_dns_safe(s: str) -> str:
     return escapism.escape(s, safe=safe_chars, escape_char="-").lower()
 
 
+# Annotation recording the hash of the manifest an object was last applied from
+CONTENT_HASH_ANNOTATION = "mcks.hub.jupyter.org/content-hash"
+
+
+def content_hash(resource: dict) -> str:
+    """
+    Stable hash of the contents of a kubernetes manifest
+    """
+    canonical = json.dumps(resource, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def stamp_content_hash(resource: dict) -> str:
+    """
+    Set the content hash annotation on resource, and return the hash
+    """
+    annotations = resource.setdefault("metadata", {}).setdefault("annotations", {})
+    annotations.pop(CONTENT_HASH_ANNOTATION, None)
+    if not annotations:
+        del resource["metadata"]["annotations"]
+    h = content_hash(resource)
+    resource["metadata"].setdefault("annotations", {})[CONTENT_HASH_ANNOTATION] = h
+    return h
+
+
+DELETE_ON_STOP_LABEL = "mcks.hub.jupyter.org/delete-on-stop"
+
+
+def is_deleted_on_stop(resource: dict) -> bool:
+    """
+    Check if a resource is deleted when the server stops
+
+    Only a delete-on-stop label of "true", in any case, or no label at all
+    means it is.
+    """
+    labels = resource["metadata"].get("labels") or {}
+    return str(labels.get(DELETE_ON_STOP_LABEL, "true")).lower() == "true"
+
+
+def normalize_delete_on_stop(resource: dict):
+    """
+    Set the delete-on-stop label of a resource to exactly "true" or "false"
+
+    Objects are deleted by label selector when the server stops, and label
+    selectors can not match values case insensitively.
+    """
+    labels = resource["metadata"].get("labels") or {}
+    if DELETE_ON_STOP_LABEL in labels:
+        labels[DELETE_ON_STOP_LABEL] = (
+            "true" if is_deleted_on_stop(resource) else "false"
+        )
+
+
+def resource_from_ref(ref: dict) -> dict:
+    """
+    Minimal manifest of a resource saved in our state by reference
+
+    Has just enough in it to find the object in the cluster again, and to
+    know if it is deleted when the server stops.
+    """
+    resource = {
+        "apiVersion": ref["apiVersion"],
+        "kind": ref["kind"],
+        "metadata": {"name": ref["name"], "namespace": ref["namespace"]},
+    }
+    if ref.get("keep_on_stop"):
+        resource["metadata"]["labels"] = {DELETE_ON_STOP_LABEL: "false"}
+    return resource
+
+
+# Hashes of namespace_resources applied to each (context, namespace), and when
+# they were last checked
+_namespace_resources_applied = {}
+_namespace_resources_locks = {}
+# Seconds after which namespaces nobody started a server in are forgotten, so
+# the above do not grow with every namespace ever used
+NAMESPACE_RESOURCES_FORGET_AFTER = 3600
+
+
+def _forget_idle_namespaces(max_age: float):
+    """
+    Drop what we know about namespaces whose resources were last checked max_age seconds ago
+    """
+    now = time.time()
+    for key, applied in list(_namespace_resources_applied.items()):
+        if now - applied["checked_at"] >= max_age:
+            del _namespace_resources_applied[key]
+    for key, lock in list(_namespace_resources_locks.items()):
+        # Locks are released right after their namespace is marked as checked
+        if not lock.locked() and key not in _namespace_resources_applied:
+            del _namespace_resources_locks[key]
+
+
+# Progress shown when the user pod gets events with these reasons. Other
+# events are shown without changing it
+POD_EVENT_PROGRESS = {"Scheduled": 40, "Pulling": 50, "Pulled": 60, "Started": 70}
+
+# Template configurations that have already been validated in this process
+_validated_templates = set()
+# Whether the templates of all profiles have been checked in this process
+_templates_checked = {"done": False}
+
+# When the image pre-pullers were last checked against profile_list
+_prepullers_checked = {"at": 0}
+
+# Tasks started in the background by spawners, until they are done. The event
+# loop only keeps weak references to tasks
+_background_tasks = set()
+
+# When the kinds used by profile_list were last given to the orphan sweeper
+_orphan_targets_checked = {"at": 0}
+
+# Results of a callable profile_list and the options form rendered from them, by
+# profile_list_cache_key
+_profile_lists = RefreshingCache("profile_list")
+
+
 class MultiClusterKubeSpawner(Spawner):
 
     port = Integer(
@@ -58,8 +194,7 @@ class MultiClusterKubeSpawner(Spawner):
     env_keep = []
 
     # Namespace to create when we are creating a namespace per user
-    namespace_resource_template = Template(
-        """
+    namespace_resource_template = """
         apiVersion: v1
         kind: Namespace
         metadata:
@@ -69,7 +204,6 @@ class MultiClusterKubeSpawner(Spawner):
                 name: {{spawner.namespace}}
             name: {{spawner.namespace}}
         """
-    )
 
     # Default set of kubernetes resources created for each user
     default_resources = {
@@ -156,6 +290,22 @@ class MultiClusterKubeSpawner(Spawner):
         """,
     }
 
+    # Replaces the Ingress in default_resources when routing_mode is httpproxy.
+    # Without a virtualhost, contour only serves it where the root HTTPProxy
+    # includes it, see routes.py
+    default_httpproxy_route = """
+        apiVersion: projectcontour.io/v1
+        kind: HTTPProxy
+        metadata:
+            name: {{key}}
+        spec:
+            routes:
+            - enableWebsockets: true
+              services:
+              - name: {{key}}
+                port: 8888
+    """
+
     resources = Dict(
         Unicode,
         default={},
@@ -189,6 +339,68 @@ class MultiClusterKubeSpawner(Spawner):
         config=True,
     )
 
+    namespace_resources = Dict(
+        Unicode,
+        default={},
+        help="""
+        Jinja2 Template to generate kubernetes resources shared by all servers in a namespace.
+
+        Useful for things like ResourceQuotas, NetworkPolicies or Roles that apply
+        to all of a user's servers. These are created before the first server in a
+        namespace is started, and are not deleted when servers are stopped. They are
+        applied at most once per namespace, and only re-checked every
+        `namespace_resources_recheck_interval` seconds, so starting more named
+        servers for a user does not repeat this work. Since they are shared, these
+        templates should not refer to `key` or the server name.
+
+        If `create_namespace` is set, the namespace itself is part of these resources.
+
+        Resources are sorted by key before they are evaluated.
+        """,
+        config=True,
+    )
+
+    namespace_resources_recheck_interval = Integer(
+        300,
+        help="""
+        Seconds after which the existence of `namespace_resources` is checked again.
+
+        Until then, a namespace whose resources have been applied by this JupyterHub
+        process is assumed to still have them.
+        """,
+        config=True,
+    )
+
+    warm_pool_size = Integer(
+        0,
+        help="""
+        Number of pre-started user pods to keep waiting for each profile in each cluster.
+
+        When a user starts a server, a running pod from the pool is claimed instead of
+        creating a new one, and the pool is refilled in the background. This saves the
+        time spent scheduling the pod and pulling its image. Pool pods are created from
+        the user's pod with the environment variables and args of the notebook container
+        removed - they are handed to the pod when it is claimed. The pod spec must
+        otherwise be the same for every user, so it can not use a service account of
+        the user's own, and the image must provide `/bin/sh`. `namespace_template`
+        must put all users in the same namespace, or no pool is used.
+
+        Usually set per profile, via `spawner_override`. Disabled when 0.
+        """,
+        config=True,
+    )
+
+    warm_pool_idle_timeout = Integer(
+        3600,
+        help="""
+        Seconds after which a warm pool that no spawn has used deletes its pods.
+
+        The pool is created again the next time a server is started with its profile.
+        Pools are kept forever when 0.
+        """,
+        config=True,
+    )
+
     patches = Dict(
         Unicode,
         {},
@@ -212,10 +424,99 @@ class MultiClusterKubeSpawner(Spawner):
         config=True,
     )
 
+    routing_mode = CaselessStrEnum(
+        ["ingress", "httpproxy"],
+        default_value="ingress",
+        help="""
+        How the ingress controller in the target cluster is told to route to each server.
+
+        - `ingress`: an Ingress object for each server
+        - `httpproxy`: a contour HTTPProxy for each server, all included from one root
+          HTTPProxy per cluster (see `routing_root_name`). Routes are added to and removed
+          from the root in batches. Every batch rewrites the whole root, which lists all
+          servers in the cluster, so each write grows with the number of servers running.
+        """,
+        config=True,
+    )
+
+    routing_root_name = Unicode(
+        "jupyterhub-users",
+        help="""
+        Name of the root HTTPProxy including the routes of all servers, when `routing_mode` is `httpproxy`.
+
+        It is created if it does not exist yet, and must not be modified by anyone else
+        except to change its `virtualhost`.
+        """,
+        config=True,
+    )
+
+    routing_root_namespace = Unicode(
+        "default",
+        help="""
+        Namespace of the root HTTPProxy, in each target cluster.
+
+        Contour must be allowed to serve root HTTPProxies from it, see the
+        `--root-namespaces` option of contour.
+        """,
+        config=True,
+    )
+
+    routing_root_fqdn = Unicode(
+        "",
+        help="""
+        Host name the root HTTPProxy serves, when it has to be created.
+
+        Defaults to the host of `ingress_public_url`.
+        """,
+        config=True,
+    )
+
     kubernetes_context = Unicode(
         "",
         help="""
         Kubernetes context to use for connecting to the kubernetes cluster.
+
+        Set to `auto` to pick one of `placement_targets` for each server, based on
+        their free capacity.
+        """,
+        config=True,
+    )
+
+    placement_targets = List(
+        trait=Dict(),
+        help="""
+        Clusters to choose from when `kubernetes_context` is `auto`.
+
+        Each item is a dictionary of spawner settings to apply when the target is
+        chosen, and must contain at least `kubernetes_context` and
+        `ingress_public_url`. An optional `cost` is used by the `cheapest`
+        placement strategy, and is not applied as a setting.
+        """,
+        config=True,
+    )
+
+    placement_strategy = Union(
+        trait_types=[Unicode(), Callable()],
+        default_value="spread",
+        help="""
+        How to choose between `placement_targets` the user pod fits onto.
+
+        - `spread`: the cluster with the lowest fraction of CPU or memory requested
+        - `bin-pack`: the cluster with the highest fraction of CPU or memory requested,
+          so others can scale down
+        - `cheapest`: the cluster with the lowest `cost`
+
+        Can also be a callable taking a `ClusterCapacity`, the target dictionary, and
+        the CPU & memory requested by the user pod, returning a score. The target with
+        the highest score is picked. Recent spawn latency breaks ties.
+        """,
+        config=True,
+    )
+
+    placement_refresh_interval = Integer(
+        60,
+        help="""
+        Seconds after which the capacity of placement targets is refreshed in the background.
         """,
         config=True,
     )
@@ -248,6 +549,218 @@ class MultiClusterKubeSpawner(Spawner):
         """,
     )
 
+    ready_check_route_status = Bool(
+        False,
+        help="""
+        Wait for the ingress controller to report the user's Ingress or HTTPProxy as accepted.
+
+        Only enable this if the ingress controller in all target clusters writes status to
+        the objects it serves - contour does this for HTTPProxy objects, and for Ingress
+        objects when it knows the address of its envoy service. Otherwise, spawns will
+        wait until they time out.
+        """,
+        config=True,
+    )
+
+    ready_check_http_probe = Bool(
+        False,
+        help="""
+        Make requests to the user server via `ingress_public_url` before reporting it as started.
+
+        The ingress controller in the target cluster takes a little while to pick up
+        new routes, and responds with 404 or 503 until it does. With this enabled, the
+        spawn is complete as soon as the route responds, instead of sending the user to
+        a URL that does not work yet. The hub must be able to reach `ingress_public_url`.
+        """,
+        config=True,
+    )
+
+    ready_check_http_probe_verify = Union(
+        trait_types=[Bool(), Unicode()],
+        default_value=True,
+        help="""
+        Verify the TLS certificate of `ingress_public_url` when probing it.
+
+        Set to the path of a CA bundle to verify against that, or to False to not
+        verify certificates - for example when `ingress_public_url` is an IP address.
+        """,
+        config=True,
+    )
+
+    max_concurrent_mutations = Integer(
+        20,
+        help="""
+        Maximum number of requests that create, change or delete objects in flight to each cluster.
+
+        Shared by all servers targeting the same `kubernetes_context`. Further
+        requests are queued, and their position in the queue is shown to the user
+        while their server starts. Requests the API server throttles are retried
+        with exponential backoff, honouring its `Retry-After` header. Unlimited
+        when 0.
+        """,
+        config=True,
+    )
+
+    admission_policy = CaselessStrEnum(
+        ["fair", "fifo"],
+        default_value="fair",
+        help="""
+        Order in which queued requests to a cluster are sent, once `max_concurrent_mutations` is reached.
+
+        - `fair`: requests of the server with the fewest requests in flight go first,
+          so servers with many resources do not hold up everyone else
+        - `fifo`: requests are sent in the order they were made
+        """,
+        config=True,
+    )
+
+    restore_recheck_window = Integer(
+        60,
+        help="""
+        Seconds over which to spread second checks of servers whose status is unknown after the hub restarts.
+
+        When JupyterHub starts, it polls every server that was running. Their status
+        is read from a single list of all user pods per cluster. If that list can not
+        be made, the servers are assumed to still be running instead of being marked
+        as stopped, and each is polled again at a random time within this window.
+        """,
+        config=True,
+    )
+
+    health_check_interval = Integer(
+        0,
+        help="""
+        Seconds between health checks of the API server of each cluster servers are started on.
+
+        After `health_check_failure_threshold` failed checks in a row, the cluster is
+        considered unreachable until a check succeeds again. Meanwhile, spawns onto it
+        fail right away with a message saying so, polls of its servers report them as
+        still running instead of waiting to time out, and its profiles are marked as
+        unreachable in the options form. Disabled when 0, the default. 10 is a good
+        value to start with.
+        """,
+        config=True,
+    )
+
+    health_check_failure_threshold = Integer(
+        3,
+        help="""
+        Number of failed health checks in a row after which a cluster is considered unreachable.
+        """,
+        config=True,
+    )
+
+    orphan_sweep_interval = Integer(
+        0,
+        help="""
+        Seconds between sweeps for objects left behind by servers that are not running.
+
+        Objects can be left behind in target clusters when the hub crashes while a
+        server is starting, or when stopping a server fails. When set, every target
+        cluster is regularly checked for objects labelled with
+        `mcks.hub.jupyter.org/key` - one list request per kind per cluster - and the
+        ones not belonging to a running or starting server are deleted. Objects
+        labelled `mcks.hub.jupyter.org/delete-on-stop: "false"` are left alone.
+
+        Disabled when 0.
+        """,
+        config=True,
+    )
+
+    orphan_grace_period = Integer(
+        900,
+        help="""
+        Seconds an object must have existed, and been seen as orphaned, before it is deleted.
+        """,
+        config=True,
+    )
+
+    orphan_sweep_dry_run = Bool(
+        False,
+        help="""
+        Only log which orphaned objects would be deleted, without deleting them.
+        """,
+        config=True,
+    )
+
+    prepull_images = Bool(
+        False,
+        help="""
+        Pull the images used by all profiles onto every node of each target cluster.
+
+        A DaemonSet (see `prepuller_template`) is kept up to date in each
+        `kubernetes_context` used by `profile_list`, listing every image used by the
+        pods of profiles in that cluster after patches are applied. New nodes then
+        start pulling images as soon as they join, rather than when the first user
+        is spawned onto them. Progress is logged, and exported as the
+        `mcks_prepuller_nodes` metric.
+        """,
+        config=True,
+    )
+
+    prepuller_namespace = Unicode(
+        "default",
+        help="""
+        Namespace the image pre-puller DaemonSet is created in, in each target cluster.
+        """,
+        config=True,
+    )
+
+    prepuller_recheck_interval = Integer(
+        300,
+        help="""
+        Seconds after which the images used by profiles are collected again.
+
+        Pre-puller DaemonSets are only updated when the rendered DaemonSet or
+        `prepuller_namespace` changes, or when someone else deleted or changed the
+        DaemonSet in the cluster. The latter is also checked every minute.
+        """,
+        config=True,
+    )
+
+    prepuller_template = Unicode(
+        """
+        apiVersion: apps/v1
+        kind: DaemonSet
+        metadata:
+            name: mcks-image-prepuller
+            labels:
+                mcks.hub.jupyter.org/prepuller: "true"
+        spec:
+            selector:
+                matchLabels:
+                    mcks.hub.jupyter.org/prepuller: "true"
+            updateStrategy:
+                type: RollingUpdate
+                rollingUpdate:
+                    maxUnavailable: 100%
+            template:
+                metadata:
+                    labels:
+                        mcks.hub.jupyter.org/prepuller: "true"
+                spec:
+                    terminationGracePeriodSeconds: 0
+                    tolerations:
+                    - operator: Exists
+                    initContainers:
+                    {% for image in images %}
+                    - name: image-{{ loop.index }}
+                      image: {{ image }}
+                      command: ["/bin/sh", "-c", "exit 0"]
+                    {% endfor %}
+                    containers:
+                    - name: pause
+                      image: registry.k8s.io/pause:3.9
+        """,
+        help="""
+        Jinja2 template for the image pre-puller DaemonSet.
+
+        `images` is the sorted list of images to pull. The DaemonSet must carry the
+        `mcks.hub.jupyter.org/prepuller` label, so its progress can be reported.
+        """,
+        config=True,
+    )
+
     profile_list = Union(
         trait_types=[List(trait=Dict()), Callable()],
         config=True,
@@ -273,6 +786,50 @@ class MultiClusterKubeSpawner(Spawner):
         or MultiClusterKubeSpawner upgrades to break.
         """,
     )
+
+    profile_list_cache_ttl = Integer(
+        0,
+        help="""
+        Seconds to reuse the result of a callable `profile_list`, and the options form rendered from it.
+
+        By default, the callable is called every time a user opens the spawn page.
+        Set this if it is slow - for example because it asks another service - so
+        the page loads quickly. Results are shared by all servers with the same
+        `profile_list_cache_key`.
+        """,
+        config=True,
+    )
+
+    profile_list_cache_max_stale = Integer(
+        3600,
+        help="""
+        Seconds after `profile_list_cache_ttl` runs out that the old result is still used.
+
+        A new result is fetched in the background meanwhile, so users never wait for
+        the callable once a result has been cached. If fetching it fails, the old
+        result keeps being used until this runs out too.
+        """,
+        config=True,
+    )
+
+    profile_list_cache_key = Callable(
+        None,
+        allow_none=True,
+        help="""
+        Callable that takes the spawner and returns the key to cache `profile_list` results by.
+
+        Servers whose keys are equal share the same cached result, so the key must
+        include everything the callable `profile_list` looks at. For example, if it
+        only looks at the groups of the user::
+
+            c.MultiClusterKubeSpawner.profile_list_cache_key = lambda spawner: tuple(
+                sorted(g.name for g in spawner.user.groups)
+            )
+
+        May be async. Defaults to the name of the user.
+        """,
+        config=True,
+    )
     profile_form_template = Unicode(
         """
         <style>
@@ -290,6 +847,9 @@ class MultiClusterKubeSpawner(Spawner):
             </div>
             <div class='col-md-11'>
                 <strong>{{ profile.display_name }}</strong>
+                {% if profile.slug in degraded_profiles %}
+                <span class='label label-warning'>Cluster unreachable</span>
+                {% endif %}
                 {% if profile.description %}
                 <p>{{ profile.description }}</p>
                 {% endif %}
@@ -304,8 +864,9 @@ class MultiClusterKubeSpawner(Spawner):
 
         Used when `profile_list` is set.
 
-        The contents of `profile_list` are passed in to the template.
-        This should be used to construct the contents of a HTML form. When
+        The contents of `profile_list` are passed in to the template, along with
+        `degraded_profiles` - the slugs of profiles whose cluster is failing health
+        checks. This should be used to construct the contents of a HTML form. When
         posted, this form is expected to have an item with name `profile` and
         the value the index of the profile in `profile_list`.
         """,
@@ -314,11 +875,101 @@ class MultiClusterKubeSpawner(Spawner):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # Key depends on other params here, so do it last
-        self.key = Template(self.key_template).render(**self.template_vars).rstrip("-")
-        self.namespace = Template(self.namespace_template).render(**self.template_vars)
+        self.key = (
+            get_template(self.key_template).render(**self.template_vars).rstrip("-")
+        )
+        self.namespace = get_template(self.namespace_template).render(
+            **self.template_vars
+        )
 
         # Store a list of resources we created so we can clean them up
         self.created_resources = []
+        # Content hash of each resource we last applied, by resource_id
+        self.resource_hashes = {}
+        # uid of each object we applied or found unchanged, by resource_id
+        self.resource_uids = {}
+        # Set by load_state, until the first poll after the hub restarted
+        self._restored = False
+        # Events reported to the user while the server starts, see progress()
+        self._progress_events = []
+        self._reported_queue_position = None
+        self._progress_updated = asyncio.Event()
+        # Set by stop() when it deletes the pod, until a start saw it go away
+        self._deleted_pod = False
+
+    def validate_templates(self):
+        """
+        Compile and test render all resource and patch templates
+
+        Called by load_user_options once the profile is applied, so a broken
+        template fails the start with a clear message instead of half way
+        through creating resources. Stopping and polling servers never render
+        templates, so they are not affected. Done once per process for each
+        distinct set of templates, and for all of them up front by
+        check_templates.
+        """
+        all_resources = self.get_resource_templates()
+        fingerprint = (
+            tuple(sorted(all_resources.items())),
+            tuple(sorted(self.patches.items())),
+            tuple(sorted(self.namespace_resources.items())),
+            self.namespace_resource_template,
+        )
+        if fingerprint in _validated_templates:
+            return
+
+        try:
+            resources = self.get_resources_spec()
+        except Exception as e:
+            raise ValueError(f"Invalid resource template: {e}") from e
+        for resource in resources:
+            if not isinstance(resource, dict) or "name" not in resource.get(
+                "metadata", {}
+            ):
+                raise ValueError(
+                    f"Resource template rendered to {resource!r}, which has no metadata.name"
+                )
+        try:
+            self.apply_patches(resources)
+        except Exception as e:
+            raise ValueError(f"Invalid patch template: {e}") from e
+        try:
+            self.get_namespace_resources_spec()
+        except Exception as e:
+            raise ValueError(f"Invalid namespace resource template: {e}") from e
+
+        _validated_templates.add(fingerprint)
+
+    def check_templates(self):
+        """
+        Validate the base templates and those of every profile in a static profile_list
+
+        Done once per process, when the hub loads its first spawner - while it
+        starts up and restores its servers, or when the first user logs in -
+        so broken templates show up in the hub's log before anyone tries to
+        start a server with them. Errors are logged rather than raised, as
+        raising would keep servers that are already running from being polled
+        and stopped. Starting a server with broken templates still fails, see
+        validate_templates.
+        """
+        if _templates_checked["done"]:
+            return
+        _templates_checked["done"] = True
+        profiles = [None]
+        if isinstance(self.profile_list, list):
+            profiles += self._init_profile_list(self.profile_list)
+        for profile in profiles:
+            name = "base config"
+            try:
+                spawner = self.__class__(
+                    user=self.user, hub=self.hub, config=self.config
+                )
+                if profile is not None:
+                    name = f"profile {profile['display_name']}"
+                    spawner._apply_profile(profile)
+                spawner.validate_templates()
+            except Exception as e:
+                self.log.error(f"Invalid templates in {name}: {e}")
 
     @property
     def template_vars(self) -> dict:
@@ -338,58 +989,58 @@ class MultiClusterKubeSpawner(Spawner):
 
         return params
 
-    def get_labels(self) -> dict:
+    @property
+    def resource_template_vars(self) -> dict:
         """
-        Default labels added on to all resources generated by this spawner
+        Variables available to resource and patch templates
         """
-        return {
-            "mcks.hub.jupyter.org/key": self.key,
-        }
-
-    async def apply_patches(self, resources: List) -> List:
         params = self.template_vars.copy()
         params["key"] = self.key
 
-        named_resources = {f"{o['kind']}/{o['metadata']['name']}": o for o in resources}
-
-        patches = [
-            yaml.load(Template(p).render(**params))
-            for k, p in sorted(self.patches.items())
-        ]
-
+        resources = {"limits": {}, "requests": {}}
+        if self.mem_guarantee:
+            resources["requests"]["memory"] = str(self.mem_guarantee)
+        if self.mem_limit:
+            resources["limits"]["memory"] = str(self.mem_limit)
+        if self.cpu_guarantee:
+            resources["requests"]["cpu"] = str(self.cpu_guarantee)
+        if self.cpu_limit:
+            resources["limits"]["cpu"] = str(self.cpu_limit)
+
+        params["resources"] = resources
+        return params
+
+    def get_labels(self) -> dict:
+        """
+        Default labels added on to all resources generated by this spawner
+        """
+        return {
+            "mcks.hub.jupyter.org/key": self.key,
+        }
+
+    def apply_patches(self, resources: list) -> list:
+        """
+        Apply all patches in self.patches to the generated resources
+
+        Patches are applied in-process with strategic merge patch semantics,
+        the same as `kubectl patch`. The returned resources share objects with
+        the ones passed in, which should not be used afterwards.
+        """
+        params = self.resource_template_vars
+
+        named_resources = {f"{o['kind']}/{o['metadata']['name']}": o for o in resources}
+
+        patches = [render_yaml(p, params) for k, p in sorted(self.patches.items())]
+
         for patch in patches:
             patch_name = f"{patch['kind']}/{patch['metadata']['name']}"
-            with tempfile.NamedTemporaryFile(mode="w") as f:
-                yaml.dump(named_resources[patch_name], f)
-                f.flush()
-                cmd = [
-                    "kubectl",
-                    "patch",
-                    "-n",
-                    self.namespace,
-                    "--local",
-                    "-f",
-                    f.name,
-                    "--patch",
-                    json.dumps(patch),
-                    "-o",
-                    "yaml",
-                ]
-                if self.kubernetes_context:
-                    cmd.append(f"--context={self.kubernetes_context}")
-
-                proc = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
+            if patch_name not in named_resources:
+                raise ValueError(
+                    f"Patch for {patch_name} does not match any generated resource"
                 )
-
-                stdout, stderr = await proc.communicate()
-                if await proc.wait() != 0:
-                    raise ValueError(
-                        f"kubectl patch failed for {patch_name}: {stdout}, {stderr}"
-                    )
-                named_resources[patch_name] = yaml.load(stdout.decode())
+            named_resources[patch_name] = strategic_merge_patch(
+                named_resources[patch_name], patch, copy_original=False
+            )
 
         return list(named_resources.values())
 
@@ -469,36 +1120,32 @@ class MultiClusterKubeSpawner(Spawner):
 
                         return resources
 
-    def get_resources_spec(self) -> list:
+    def get_resource_templates(self) -> dict:
         """
-        Render the templated YAML
+        Templates of the resources created for each server, by key
         """
-        params = self.template_vars.copy()
-        params["key"] = self.key
+        all_resources = self.default_resources.copy()
+        if self.routing_mode == "httpproxy":
+            all_resources["04-ingress"] = self.default_httpproxy_route
+        all_resources.update(self.resources)
+        return all_resources
 
-        resources = {"limits": {}, "requests": {}}
-        if self.mem_guarantee:
-            resources["requests"]["memory"] = str(self.mem_guarantee)
-        if self.mem_limit:
-            resources["limits"]["memory"] = str(self.mem_limit)
-        if self.cpu_guarantee:
-            resources["requests"]["cpu"] = str(self.cpu_guarantee)
-        if self.cpu_limit:
-            resources["limits"]["cpu"] = str(self.cpu_limit)
+    def get_resources_spec(self) -> list:
+        """
+        Render the templated YAML
 
-        params["resources"] = resources
+        Templates are filled in from a skeleton parsed once per process where
+        possible, see skeleton.py.
+        """
+        params = self.resource_template_vars
 
-        all_resources = self.default_resources.copy()
-        all_resources.update(self.resources)
+        all_resources = self.get_resource_templates()
 
-        rendered = [
-            Template(dedent(o)).render(**params)
+        # FIXME: report YAML parse errors clearly
+        parsed = [
+            render_yaml(o, params, dedent_source=True)
             for k, o in sorted(all_resources.items())
         ]
-        parsed = []
-        for r in rendered:
-            # FIXME: report YAML parse errors clearly
-            parsed.append(yaml.load(r))
 
         for p in parsed:
             # Inject metadata into every resource
@@ -510,172 +1157,943 @@ class MultiClusterKubeSpawner(Spawner):
     def get_state(self) -> dict:
         """
         Save state required to reinstate this user's pod from scratch
+
+        Resources we created are saved as references, not full manifests, so
+        the state stays small and does not contain secrets like the API token.
         """
         state = super().get_state()
         state["key"] = self.key
         state["kubernetes_context"] = self.kubernetes_context
-        state["ingress_public_url "] = self.ingress_public_url
-        state["created_resources"] = self.created_resources
+        state["namespace"] = self.namespace
+        state["ingress_public_url"] = self.ingress_public_url
+        state["resources"] = [self.resource_ref(r) for r in self.created_resources]
         return state
 
     def load_state(self, state: dict):
         """
         Load state from storage required to reinstate this user's pod
+
+        State saved by older versions, with full manifests in created_resources,
+        is read too. It is saved in the compact format the next time around.
         """
+        self.check_templates()
+        if self.prepull_images:
+            # So images are pulled from when the hub starts, not the first spawn
+            self.run_in_background(self.ensure_prepullers(), "update image pre-pullers")
         if "key" in state:
             self.key = state["key"]
-        if "ingress_public_url" in state:
-            self.ingress_public_url = state["ingress_public_url"]
+        # Older versions saved this with a trailing space in the key
+        for key in ("ingress_public_url", "ingress_public_url "):
+            if key in state:
+                self.ingress_public_url = state[key]
+                break
         if "kubernetes_context" in state:
             self.kubernetes_context = state["kubernetes_context"]
+        if "namespace" in state:
+            self.namespace = state["namespace"]
+        refs = state.get("resources", [])
         if "created_resources" in state:
-            self.created_resources = state["created_resources"]
+            hashes = state.get("resource_hashes", {})
+            refs = [
+                dict(self.resource_ref(r), hash=hashes.get(self.resource_id(r)))
+                for r in state["created_resources"]
+            ]
+        self.created_resources = [resource_from_ref(ref) for ref in refs]
+        self._restored = bool(refs)
+        for ref, resource in zip(refs, self.created_resources):
+            rid = self.resource_id(resource)
+            if ref.get("hash"):
+                self.resource_hashes[rid] = ref["hash"]
+            if ref.get("uid"):
+                self.resource_uids[rid] = ref["uid"]
 
-    async def kubectl_apply(self, spec: list):
-        cmd = [
-            "kubectl",
-            "apply",
-            "-n",
-            self.namespace,
-            "--wait",  # Wait for resources to be 'ready' before returning
-            "-f",
-            "-",
-            "-o",
-            "yaml",
+    @property
+    def client(self) -> KubernetesClient:
+        """
+        Kubernetes API client for the cluster this spawner is targeting
+        """
+        return get_client(self.kubernetes_context)
+
+    def resource_id(self, resource: dict) -> str:
+        """
+        Identifier of a resource, unique within a cluster
+        """
+        metadata = resource["metadata"]
+        namespace = metadata.get("namespace", self.namespace)
+        return f"{resource['apiVersion']}/{resource['kind']}/{namespace}/{metadata['name']}"
+
+    def resource_ref(self, resource: dict) -> dict:
+        """
+        Reference to a resource we created, with the uid and hash it was applied with
+        """
+        metadata = resource["metadata"]
+        rid = self.resource_id(resource)
+        ref = {
+            "apiVersion": resource["apiVersion"],
+            "kind": resource["kind"],
+            "name": metadata["name"],
+            "namespace": metadata.get("namespace", self.namespace),
+            "uid": self.resource_uids.get(rid),
+            "hash": self.resource_hashes.get(rid),
+        }
+        if not is_deleted_on_stop(resource):
+            ref["keep_on_stop"] = True
+        return ref
+
+    async def _is_unchanged(self, resource: dict, applied_uids: dict) -> bool:
+        """
+        Check if the live object still has the content hash stamped on resource
+        """
+        metadata = await self.client.get_metadata(
+            resource["apiVersion"],
+            resource["kind"],
+            resource["metadata"]["name"],
+            resource["metadata"].get("namespace", self.namespace),
+        )
+        if metadata is None:
+            return False
+        # Skipped objects are not applied, so this is where we learn their uid
+        applied_uids[self.resource_id(resource)] = metadata["metadata"].get("uid")
+        annotations = metadata["metadata"].get("annotations", {})
+        expected = resource["metadata"]["annotations"][CONTENT_HASH_ANNOTATION]
+        return annotations.get(CONTENT_HASH_ANNOTATION) == expected
+
+    async def apply_resources(
+        self, spec: list, applied_hashes: dict = None, applied_uids: dict = None
+    ):
+        """
+        Create or update given resources, in order, with server side apply
+
+        Each resource is stamped with a hash of its contents. Resources whose
+        hash matches what we last applied - and that still exist with that
+        hash in the cluster - are not sent again. applied_hashes and
+        applied_uids default to the hashes and uids of this spawner's own
+        resources, and are updated in place.
+        """
+        if applied_hashes is None:
+            applied_hashes = self.resource_hashes
+        if applied_uids is None:
+            applied_uids = self.resource_uids
+
+        for resource in spec:
+            stamp_content_hash(resource)
+
+        candidates = [
+            r
+            for r in spec
+            if applied_hashes.get(self.resource_id(r))
+            == r["metadata"]["annotations"][CONTENT_HASH_ANNOTATION]
         ]
-        if self.kubernetes_context:
-            cmd.append(f"--context={self.kubernetes_context}")
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+        unchanged = await asyncio.gather(
+            *(self._is_unchanged(r, applied_uids) for r in candidates)
+        )
+        skip = {
+            self.resource_id(r)
+            for r, is_unchanged in zip(candidates, unchanged)
+            if is_unchanged
+        }
+
+        for resource in spec:
+            rid = self.resource_id(resource)
+            if rid in skip:
+                self.log.debug(f"Skipping unchanged {rid}")
+                continue
+            self.log.debug(f"Applying {rid}")
+            applied = await self.client.apply(resource, namespace=self.namespace)
+            applied_uids[rid] = applied["metadata"].get("uid")
+            applied_hashes[rid] = resource["metadata"]["annotations"][
+                CONTENT_HASH_ANNOTATION
+            ]
+
+    async def wait_for_pod_ready(self, timeout=30) -> bool:
+        """
+        Wait for the user pod to exist and become ready, returning False on timeout
+        """
+        return await self.pod_reflector.wait_for(
+            self.namespace, self.key, pod_is_ready, timeout, wait_for_creation=True
         )
 
-        with StringIO() as s:
-            yaml.dump_all(spec, s)
-            s.seek(0)
-            objs = s.read()
-        self.log.debug(f"kubectl applying {objs}")
-        stdout, stderr = await proc.communicate(objs.encode())
+    async def probe_route(self, timeout: float) -> bool:
+        """
+        Make requests to the user server via the ingress until it responds
 
-        if (await proc.wait()) != 0:
-            raise ValueError(f"kubectl apply failed: {stdout}, {stderr}")
+        Returns False if the server is not reachable before timeout seconds.
+        """
+        url = self.ingress_public_url.rstrip("/") + self.proxy_spec
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        delay = 0.1
+        # We only check that requests are routed to the server, so redirects
+        # are not followed
+        async with httpx.AsyncClient(
+            verify=self.ready_check_http_probe_verify, timeout=5
+        ) as http:
+            while loop.time() < deadline:
+                try:
+                    resp = await http.get(url)
+                    # The ingress controller returns 404 until it has picked up the
+                    # route, and 5xx while it has no healthy endpoints for it
+                    if resp.status_code not in (404, 502, 503, 504):
+                        return True
+                except httpx.HTTPError as e:
+                    self.log.debug(f"Probing {url} failed: {e}")
+                ROUTE_PROBE_RETRIES.labels(context=self.kubernetes_context).inc()
+                await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+                delay = min(delay * 2, 1)
+        return False
+
+    async def wait_for_ready(self, timeout: float):
+        """
+        Wait for the user server to be reachable via the ingress controller
 
-    async def kubectl_wait(self, timeout=30):
-        cmd = [
-            "kubectl",
-            "-n",
+        Waits for the pod to be ready, the endpoints of its services to be
+        ready, and optionally for the ingress controller to report the
+        route as accepted and for the route to actually respond. Raises
+        TimeoutError if any of these does not happen within timeout seconds.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+
+        def remaining():
+            return max(deadline - loop.time(), 0)
+
+        with self.time_phase("start", "wait_for_pod"):
+            ready = await self.wait_for_pod_ready(remaining())
+        if not ready:
+            raise TimeoutError(f"Pod {self.key} did not become ready in {timeout}s")
+        self.report_progress("Server is running", 80)
+
+        for r in self.created_resources:
+            name = r["metadata"]["name"]
+            if r["kind"] == "Service":
+                with self.time_phase("start", "wait_for_endpoints"):
+                    ready = await self.client.wait_for_any(
+                        "discovery.k8s.io/v1",
+                        "EndpointSlice",
+                        self.namespace,
+                        f"kubernetes.io/service-name={name}",
+                        endpoints_are_ready,
+                        remaining(),
+                    )
+            elif self.ready_check_route_status and r["kind"] in (
+                "Ingress",
+                "HTTPProxy",
+            ):
+                with self.time_phase("start", "wait_for_route"):
+                    ready = await self.client.wait_for(
+                        r["apiVersion"],
+                        r["kind"],
+                        name,
+                        self.namespace,
+                        route_is_ready,
+                        remaining(),
+                    )
+            else:
+                continue
+            if not ready:
+                raise TimeoutError(
+                    f"{r['kind']}/{name} did not become ready in {timeout}s"
+                )
+            if r["kind"] != "Service":
+                self.report_progress(
+                    f"{r['kind']}/{name} was accepted by the ingress controller", 90
+                )
+
+        if not self.ready_check_http_probe:
+            return
+        with self.time_phase("start", "probe_route"):
+            ready = await self.probe_route(remaining())
+        if not ready:
+            raise TimeoutError(
+                f"{self.ingress_public_url}{self.proxy_spec} did not respond in {timeout}s"
+            )
+        self.report_progress("Server is reachable via the ingress controller", 95)
+
+    def get_namespace_resources_spec(self) -> list:
+        """
+        Render the templated YAML for resources shared by the whole namespace
+        """
+        params = self.resource_template_vars
+
+        templates = []
+        if self.create_namespace:
+            templates.append(self.namespace_resource_template)
+        templates += [o for k, o in sorted(self.namespace_resources.items())]
+
+        return [render_yaml(o, params, dedent_source=True) for o in templates]
+
+    async def ensure_namespace_resources(self):
+        """
+        Make sure the resources shared by the namespace exist
+
+        These are applied at most once per (context, namespace) by this process,
+        until namespace_resources_recheck_interval has passed.
+        """
+        spec = self.get_namespace_resources_spec()
+        if not spec:
+            return
+        hashes = {self.resource_id(r): stamp_content_hash(r) for r in spec}
+
+        _forget_idle_namespaces(
+            max(
+                NAMESPACE_RESOURCES_FORGET_AFTER,
+                self.namespace_resources_recheck_interval,
+            )
+        )
+        cache_key = (self.kubernetes_context, self.namespace)
+        lock = _namespace_resources_locks.setdefault(cache_key, asyncio.Lock())
+        async with lock:
+            applied = _namespace_resources_applied.get(cache_key)
+            if (
+                applied is not None
+                and applied["hashes"] == hashes
+                and time.time() - applied["checked_at"]
+                < self.namespace_resources_recheck_interval
+            ):
+                return
+            applied_hashes = dict(applied["hashes"]) if applied else {}
+            self.log.info(
+                f"Ensuring namespace resources {' '.join(hashes)} exist in context {self.kubernetes_context}"
+            )
+            # Their uids are not ours to save in our state
+            await self.apply_resources(spec, applied_hashes, applied_uids={})
+            _namespace_resources_applied[cache_key] = {
+                "hashes": hashes,
+                "checked_at": time.time(),
+            }
+
+    async def adopt_warm_pod(self, resources: list) -> list:
+        """
+        Claim a pod from the warm pool instead of creating the user's pod
+
+        Returns the resources that still need to be applied. If a pod was
+        claimed, created_resources is updated to refer to it.
+        """
+        pod = next(
+            r
+            for r in resources
+            if r["kind"] == "Pod" and r["metadata"]["name"] == self.key
+        )
+        if not self._namespace_is_shared():
+            self.log.warning(
+                f"Not using a warm pool for {self.key}, as namespace_template gives each user a namespace of their own"
+            )
+            return resources
+        try:
+            template, env, args = make_pool_template(pod)
+        except ValueError as e:
+            self.log.warning(f"Not using a warm pool for {self.key}: {e}")
+            return resources
+        pool = get_warm_pool(
+            self.kubernetes_context,
             self.namespace,
-            "wait",
-            "--for=condition=Ready",
-            f"pod/{self.key}",
-            f"--timeout={timeout}s",
-        ]
-        if self.kubernetes_context:
-            cmd.append(f"--context={self.kubernetes_context}")
-        proc = await asyncio.create_subprocess_exec(*cmd)
-        stdout, stderr = await proc.communicate()
-        return await proc.wait()
+            self._profile_slug,
+            content_hash(template)[:16],
+            template,
+            self.warm_pool_size,
+            self.warm_pool_idle_timeout,
+        )
+        claimed = await pool.claim(self.get_labels(), env, args)
+        if claimed is None:
+            self.log.info(
+                f"No warm pod available for {self.key} in context {self.kubernetes_context}, creating one"
+            )
+            return resources
+
+        name, secret = claimed
+        self.log.info(f"Adopted warm pod {name} for {self.key}")
+        remaining = [r for r in resources if r is not pod]
+        claimed_pod = {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {"name": name, "labels": self.get_labels()},
+        }
+        self.created_resources = remaining + [claimed_pod, secret]
+        return remaining
+
+    def _namespace_is_shared(self) -> bool:
+        """
+        Whether namespace_template puts the servers of all users in the same namespace
+        """
+        template = get_template(self.namespace_template)
+        namespaces = {
+            template.render(
+                **dict(
+                    self.template_vars,
+                    userid=userid,
+                    username=f"mcks-user-{userid}",
+                    unescaped_username=f"mcks-user-{userid}",
+                    servername=f"mcks-server-{userid}",
+                    unescaped_servername=f"mcks-server-{userid}",
+                )
+            )
+            for userid in (1, 2)
+        }
+        return len(namespaces) == 1
+
+    async def get_profile_resources(self) -> dict:
+        """
+        Resources of every profile after patches are applied, by kubernetes context
+        """
+        await self._ensure_profile_list()
+        profiles = self._profile_list or [None]
+        resources = {}
+        for profile in profiles:
+            spawner = self.__class__(user=self.user, hub=self.hub, config=self.config)
+            if profile is not None:
+                spawner._profile_list = self._profile_list
+                await spawner._load_profile(profile["slug"])
+            contexts = [spawner.kubernetes_context]
+            if spawner.kubernetes_context == "auto":
+                contexts = [t["kubernetes_context"] for t in self.placement_targets]
+            for context in contexts:
+                resources.setdefault(context, []).extend(
+                    spawner.apply_patches(spawner.get_resources_spec())
+                )
+        return resources
+
+    async def get_prepull_images(self) -> dict:
+        """
+        Images used by the pods of each profile, by kubernetes context
+        """
+        images = {}
+        for context, resources in (await self.get_profile_resources()).items():
+            context_images = images.setdefault(context, set())
+            for r in resources:
+                if r["kind"] != "Pod":
+                    continue
+                for c in r["spec"].get("initContainers", []) + r["spec"]["containers"]:
+                    context_images.add(c["image"])
+        return {context: sorted(i) for context, i in images.items()}
+
+    async def ensure_prepullers(self):
+        """
+        Keep the image pre-puller of every target cluster up to date with profile_list
+
+        Runs at most once every prepuller_recheck_interval seconds per process.
+        """
+        if time.time() - _prepullers_checked["at"] < self.prepuller_recheck_interval:
+            return
+        _prepullers_checked["at"] = time.time()
+        try:
+            for context, images in (await self.get_prepull_images()).items():
+                daemonset = load_yaml(
+                    get_template(self.prepuller_template, dedent_source=True).render(
+                        images=images
+                    )
+                )
+                await get_prepuller(context, self.prepuller_namespace).update(
+                    daemonset, images, self.prepuller_namespace
+                )
+        except Exception as e:
+            self.log.warning(f"Failed to update image pre-pullers: {e}")
+
+    async def ensure_orphan_sweeper(self):
+        """
+        Start the orphan sweeper, and tell it about the kinds of objects we create
+
+        The contexts and kinds used by all profiles are collected at most once every
+        orphan_sweep_interval seconds per process.
+        """
+        sweeper = get_orphan_sweeper(get_active_keys)
+        sweeper.interval = self.orphan_sweep_interval
+        sweeper.grace_period = self.orphan_grace_period
+        sweeper.dry_run = self.orphan_sweep_dry_run
+        sweeper.targets.setdefault(self.kubernetes_context, set()).update(
+            (r["apiVersion"], r["kind"]) for r in self.created_resources
+        )
+        if time.time() - _orphan_targets_checked["at"] >= self.orphan_sweep_interval:
+            _orphan_targets_checked["at"] = time.time()
+            try:
+                for context, resources in (await self.get_profile_resources()).items():
+                    sweeper.targets.setdefault(context, set()).update(
+                        (r["apiVersion"], r["kind"]) for r in resources
+                    )
+            except Exception as e:
+                self.log.warning(f"Failed to collect kinds for orphan sweeper: {e}")
+        sweeper.start()
+
+    def time_phase(self, operation: str, phase: str):
+        """
+        Record duration and failures of a phase of start, stop or poll as metrics
+        """
+        return time_phase(
+            operation,
+            phase,
+            lambda: {"context": self.kubernetes_context, "profile": self._profile_slug},
+        )
+
+    def report_progress(self, message: str, progress: int = None):
+        """
+        Add an event to be shown to the user while their server starts
+        """
+        event = {"message": message}
+        if progress is not None:
+            event["progress"] = progress
+        self._progress_events.append(event)
+        # Wake up everyone waiting in progress(), and make later calls wait again
+        updated, self._progress_updated = self._progress_updated, asyncio.Event()
+        updated.set()
+
+    def _report_queue_position(self, position: int):
+        """
+        Report the position in the admission queue, when it has at least halved
+
+        With a deep queue, the position changes with every request sent, which
+        would bury the rest of the progress messages.
+        """
+        reported = self._reported_queue_position
+        if reported is not None and position > reported // 2:
+            return
+        self._reported_queue_position = position
+        self.report_progress(
+            f"Waiting to send requests to cluster {self.kubernetes_context or 'default'}: "
+            f"{position} in queue"
+        )
+
+    async def _report_pod_events(self):
+        """
+        Report the events of the user pod as progress, until cancelled
+
+        Events do not have the labels of the pod they are about, so they are
+        selected by the uid of the pod instead - which also leaves out events
+        of an earlier pod with the same name. This is a single watch, filtered
+        by the API server, so nothing is polled. The Pulled event includes the
+        size of the image, on kubernetes versions that report it.
+        """
+        pod = next((r for r in self.created_resources if r["kind"] == "Pod"), None)
+        if pod is None:
+            return
+        uid = self.resource_uids.get(self.resource_id(pod))
+        if uid is None:
+            # Pods adopted from the warm pool are not applied by us. The
+            # reflector finds pods by the key label, which the claim just added
+            name = pod["metadata"]["name"]
+            if not await self.pod_reflector.wait_for_sync(
+                self.start_timeout
+            ) or not await self.pod_reflector.wait_for(
+                self.namespace,
+                self.key,
+                lambda p: p["metadata"]["name"] == name,
+                self.start_timeout,
+                wait_for_creation=True,
+            ):
+                return
+            uid = self.pod_reflector.get(self.namespace, self.key)["metadata"]["uid"]
+
+        seen = set()
+        try:
+            async for event in self.client.watch(
+                "v1",
+                "Event",
+                self.namespace,
+                field_selector=f"involvedObject.uid={uid}",
+                timeout=self.start_timeout,
+            ):
+                if event["type"] not in ("ADDED", "MODIFIED"):
+                    continue
+                obj = event["object"]
+                # Repeats of an event are the same object with a higher count
+                seen_key = (obj["metadata"]["name"], obj.get("count"))
+                if seen_key in seen:
+                    continue
+                seen.add(seen_key)
+                self.report_progress(
+                    f"[{obj.get('type', 'Normal')}] {obj.get('message', obj.get('reason', ''))}",
+                    POD_EVENT_PROGRESS.get(obj.get("reason")),
+                )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Progress is nice to have, the spawn goes on without it
+            self.log.debug(f"Stopped watching events of pod {self.key}: {e}")
+
+    async def progress(self):
+        """
+        Yield events reported while the server starts, as they happen
+
+        JupyterHub stops iterating when the spawn is complete.
+        """
+        seen = 0
+        while True:
+            updated = self._progress_updated
+            while seen < len(self._progress_events):
+                yield self._progress_events[seen]
+                seen += 1
+            await updated.wait()
 
     async def start(self):
+        self._progress_events = []
+        self._reported_queue_position = None
+        # Requests made while starting, including by tasks started from here, are
+        # queued as ours by admission control
+        token = current_owner.set((self.key, self._report_queue_position))
+        try:
+            with self.time_phase("start", "total"):
+                return await self._start()
+        finally:
+            current_owner.reset(token)
+
+    async def _start(self):
         # load user options (including profile)
-        await self.load_user_options()
+        with self.time_phase("start", "load_user_options"):
+            await self.load_user_options()
+
+        admission = self.client.admission
+        admission.max_in_flight = self.max_concurrent_mutations
+        admission.policy = self.admission_policy
+
+        if self.health_check_interval:
+            health = self.cluster_health(self.kubernetes_context)
+            if health.is_open:
+                raise RuntimeError(
+                    f"Cluster {self.kubernetes_context or 'default'} can not be reached right now "
+                    f"({health.last_error}). Please try again later, or choose another option."
+                )
+
+        if self.prepull_images:
+            self.run_in_background(self.ensure_prepullers(), "update image pre-pullers")
+        if self.orphan_sweep_interval:
+            self.run_in_background(
+                self.ensure_orphan_sweeper(), "start the orphan sweeper"
+            )
 
         # Generate YAML spec to be applied by rendering our resource templates (self.resources),
         # applying any patches defined in self.patches, and finally augmenting the notebook
         # container specifically with things that will be too cumborsome to do in jinja2 or
         # depend on properties that could be changed by any of the patches
-        self.created_resources = self.augment_notebook_container(
-            await self.apply_patches(self.get_resources_spec())
-        )
-
-        if self.create_namespace:
-            params = self.template_vars.copy()
-            params["key"] = self.key
-            template_resource = yaml.load(
-                self.namespace_resource_template.render(**params)
+        with self.time_phase("start", "render"):
+            self.created_resources = self.augment_notebook_container(
+                self.apply_patches(self.get_resources_spec())
             )
-            self.created_resources.insert(0, template_resource)
+            for r in self.created_resources:
+                normalize_delete_on_stop(r)
+        self.report_progress("Prepared resources for your server", 10)
+
+        with self.time_phase("start", "namespace_resources"):
+            await self.ensure_namespace_resources()
+
+        with self.time_phase("start", "wait_for_old_pod"):
+            await self.wait_for_old_pod(self.start_timeout)
+
+        to_apply = self.created_resources
+        if self.warm_pool_size > 0:
+            with self.time_phase("start", "claim_warm_pod"):
+                to_apply = await self.adopt_warm_pod(to_apply)
 
         created_resource_names = " ".join(
-            f"{r['kind']}/{r['metadata']['name']}" for r in self.created_resources
+            f"{r['kind']}/{r['metadata']['name']}" for r in to_apply
         )
         self.log.info(
             f"Creating resources for user {self.user.name}: {created_resource_names} in namespace {self.namespace}"
         )
-        await self.kubectl_apply(self.created_resources)
-        await self.kubectl_wait(self.start_timeout)
-
-        # We aren't waiting long enough for the ingress resource to be fully
-        # picked up by the controllers.
-        # FIXME: Wait for ingress to become ready instead
-        await asyncio.sleep(1)
+        started_at = time.time()
+        with self.time_phase("start", "apply"):
+            await self.apply_resources(to_apply)
+        self.report_progress(
+            f"Created {created_resource_names} in namespace {self.namespace}", 30
+        )
+        pod_events = asyncio.ensure_future(self._report_pod_events())
+        try:
+            if self.routing_mode == "httpproxy":
+                with self.time_phase("start", "add_route"):
+                    await self.route_table.add(
+                        self.proxy_spec, self.namespace, self.key
+                    )
+                self.report_progress(
+                    f"Added route for {self.proxy_spec} to HTTPProxy "
+                    f"{self.routing_root_namespace}/{self.routing_root_name}"
+                )
+            await self.wait_for_ready(self.start_timeout)
+        finally:
+            pod_events.cancel()
+        record_spawn_latency(self.kubernetes_context, time.time() - started_at)
 
         # We always just return the public URL of the ingress provider, as both
         # our proxy and the ingress controller on the target cluster keep the
         # url path intact, and route to the correct pod
         return self.ingress_public_url
 
-    async def stop(self):
-        # delete all doesn't seem to delete ingresses, lol?!
-        # https://github.com/kubernetes/kubectl/issues/7
-        cmd = ["kubectl", "delete", "-n", self.namespace, "-f", "-", "--wait"]
-        if self.kubernetes_context:
-            cmd.append(f"--context={self.kubernetes_context}")
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+    async def _delete_kind(
+        self, api_version: str, kind: str, label_selector: str, resources: list
+    ):
+        """
+        Delete all of this server's objects of a kind with one request
 
-        # Delete everything that doesn't have a special label telling us to not do that
-        resources_to_delete = [
-            r
-            for r in self.created_resources
-            if r.get("metadata", {})
-            .get("labels", {})
-            .get("mcks.hub.jupyter.org/delete-on-stop", "true")
-            .lower()
-            == "true"
-        ]
-        deleted_resource_names = " ".join(
-            f"{r['kind']}/{r['metadata']['name']}" for r in resources_to_delete
+        Falls back to deleting those of resources one by one, for kinds that
+        can not be deleted by label.
+        """
+        try:
+            await self.client.delete_collection(
+                api_version, kind, self.namespace, label_selector
+            )
+        except KubernetesAPIError as e:
+            if e.status_code != 405:
+                raise
+            # Some custom resources do not support deleting collections
+            for r in resources:
+                if (r["apiVersion"], r["kind"]) == (api_version, kind):
+                    await self.client.delete(
+                        api_version, kind, r["metadata"]["name"], self.namespace
+                    )
+
+    async def _wait_for_stopped(self):
+        """
+        Log when the pod of a stopped server has finished terminating
+        """
+        # Longer than the grace period pods get by default, plus time to pull
+        # down volumes
+        timeout = 300
+        if not await self.pod_reflector.wait_for_sync(30):
+            return
+        if await self.pod_reflector.wait_for_deletion(
+            self.namespace, self.key, timeout
+        ):
+            self.log.debug(f"Pod {self.key} in namespace {self.namespace} is gone")
+        else:
+            self.log.warning(
+                f"Pod {self.key} in namespace {self.namespace} still exists {timeout}s after stopping"
+            )
+
+    async def wait_for_old_pod(self, timeout: float):
+        """
+        Wait for the pod of a previous server with the same key to finish terminating
+
+        Right after stop() deletes it, the reflector might not have seen the
+        pod's deletionTimestamp yet, so a pod stop() deleted is waited for
+        either way.
+        """
+        if not await self.pod_reflector.wait_for_sync(timeout):
+            return
+        pod = self.pod_reflector.get(self.namespace, self.key)
+        if pod is None or not (
+            self._deleted_pod or pod["metadata"].get("deletionTimestamp")
+        ):
+            self._deleted_pod = False
+            return
+        self.log.info(f"Waiting for previous pod {self.key} to terminate")
+        if not await self.pod_reflector.wait_for_deletion(
+            self.namespace, self.key, timeout
+        ):
+            raise TimeoutError(
+                f"Previous pod {self.key} in namespace {self.namespace} did not terminate in {timeout}s"
+            )
+        self._deleted_pod = False
+
+    async def stop(self):
+        token = current_owner.set((self.key, None))
+        try:
+            await self._stop()
+        finally:
+            current_owner.reset(token)
+
+    async def _stop(self):
+        # Delete everything that doesn't have a special label telling us to not do that.
+        # Objects are deleted by label, one request per kind, so objects missing from
+        # created_resources are cleaned up too. We do not wait for pods to finish
+        # terminating - starting the server again waits for that instead.
+        # The label is normalized to true or false when objects are applied
+        label_selector = (
+            f"mcks.hub.jupyter.org/key={self.key},{DELETE_ON_STOP_LABEL}!=false"
         )
+        deleted = [r for r in self.created_resources if is_deleted_on_stop(r)]
+        kinds = sorted({(r["apiVersion"], r["kind"]) for r in deleted})
         self.log.info(
-            f"Deleting resources for user {self.user.name}: {deleted_resource_names} in namespace {self.namespace}"
+            f"Deleting {' '.join(k for _, k in kinds)} for user {self.user.name} with {label_selector} in namespace {self.namespace}"
+        )
+        if self.routing_mode == "httpproxy":
+            # Before its HTTPProxy is gone, so the root never includes a missing one
+            with self.time_phase("stop", "remove_route"):
+                await self.route_table.remove(self.proxy_spec)
+        with self.time_phase("stop", "delete"):
+            await asyncio.gather(
+                *(
+                    self._delete_kind(api_version, kind, label_selector, deleted)
+                    for api_version, kind in kinds
+                )
+            )
+        # Objects that are kept are still as we applied them
+        for r in deleted:
+            self.resource_hashes.pop(self.resource_id(r), None)
+            self.resource_uids.pop(self.resource_id(r), None)
+        if any(kind == "Pod" for _, kind in kinds):
+            # Until it is gone, starting again has to wait for the old pod
+            self._deleted_pod = True
+        self.run_in_background(
+            self._wait_for_stopped(), f"wait for pod {self.key} to terminate"
         )
-        with StringIO() as s:
-            yaml.dump_all(resources_to_delete, s)
-            s.seek(0)
-            resources_yaml = s.read()
-        stdout, stderr = await proc.communicate(resources_yaml.encode())
 
-        ret = await proc.wait()
+    def run_in_background(self, coro, what: str) -> asyncio.Task:
+        """
+        Run coro in a task that is not waited for, logging it if it fails
 
-        if ret != 0:
-            raise ValueError(
-                f"kubectl delete failed with code {ret}: {stdout}, {stderr}"
-            )
+        The task is referenced until it is done, so it is not garbage collected
+        while it runs.
+        """
+        task = asyncio.ensure_future(coro)
+        _background_tasks.add(task)
+
+        def done(task):
+            _background_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                self.log.error(f"Failed to {what}", exc_info=task.exception())
+
+        task.add_done_callback(done)
+        return task
+
+    def cluster_health(self, context: str):
+        """
+        Shared health prober of the cluster for a kubeconfig context
+        """
+        return get_cluster_health(
+            context, self.health_check_interval, self.health_check_failure_threshold
+        )
+
+    @property
+    def route_table(self) -> RouteTable:
+        """
+        Shared root HTTPProxy of the cluster this spawner targets, when routing_mode is httpproxy
+        """
+        return get_route_table(
+            self.kubernetes_context,
+            self.routing_root_namespace,
+            self.routing_root_name,
+            self.routing_root_fqdn or urlparse(self.ingress_public_url).hostname,
+        )
+
+    @property
+    def pod_reflector(self) -> ResourceReflector:
+        """
+        Shared local cache of all user pods in the cluster this spawner targets
+        """
+        return get_reflector(self.kubernetes_context, "v1", "Pod")
 
     async def poll(self):
-        ret = await self.kubectl_wait()
-        if ret == 0:
+        with self.time_phase("poll", "total"):
+            return await self._poll()
+
+    async def _poll(self):
+        if self.orphan_sweep_interval:
+            self.run_in_background(
+                self.ensure_orphan_sweeper(), "start the orphan sweeper"
+            )
+        # Answered right away from the shared pod cache, without any API calls.
+        # The cache is filled by one list of all user pods per cluster, which
+        # also answers the polls of every server after the hub restarts. Only
+        # that first list is waited for.
+        timeout = 30
+        restored, self._restored = self._restored, False
+        if (
+            self.health_check_interval
+            and self.cluster_health(self.kubernetes_context).is_open
+        ):
+            # Asking the cluster would only time out. We find out what happened to
+            # the server once it is reachable again
+            self.log.debug(
+                f"Not polling {self.key}, cluster {self.kubernetes_context} is unreachable"
+            )
+            return None
+        if not await self.pod_reflector.wait_for_sync(timeout):
+            # Not being able to list pods says nothing about this server, so
+            # don't have jupyterhub stop it
+            self.log.warning(
+                f"Could not list pods in context {self.kubernetes_context} to poll {self.key}, assuming it is still running"
+            )
+            if restored:
+                self.run_in_background(
+                    self._recheck_restored(), f"poll {self.key} again"
+                )
+            return None
+        pod = self.pod_reflector.get(self.namespace, self.key)
+        if pod is None or pod["metadata"].get("deletionTimestamp"):
+            return 1
+        if pod_is_ready(pod) or pod.get("status", {}).get("phase") == "Pending":
+            # Still being scheduled, pulling its image or starting up
             return None
-        return ret
+        return 1
+
+    async def _recheck_restored(self):
+        """
+        Poll again at a random time within restore_recheck_window
+
+        Tells jupyterhub if the server turns out to be gone, the same as its own
+        periodic polls do.
+        """
+        await asyncio.sleep(random.uniform(0, self.restore_recheck_window))
+        await self.poll_and_notify()
 
     _profile_list = None
+    _profile_slug = ""
 
-    def _render_options_form(self, profile_list: list):
+    def _render_options_form(
+        self, profile_list: list, forms: dict = None, degraded_profiles: tuple = ()
+    ):
+        """
+        Render the options form, marking the profiles in degraded_profiles
+
+        forms caches forms already rendered from the same profile_list, by the
+        profiles marked in them.
+        """
         self._profile_list = self._init_profile_list(profile_list)
-        profile_form_template = Template(self.profile_form_template)
-        return profile_form_template.render(profile_list=self._profile_list)
+        if forms is None:
+            forms = {}
+        if degraded_profiles not in forms:
+            forms[degraded_profiles] = get_template(self.profile_form_template).render(
+                profile_list=self._profile_list, degraded_profiles=degraded_profiles
+            )
+        return forms[degraded_profiles]
+
+    def _degraded_profiles(self, profile_list: list) -> tuple:
+        """
+        Slugs of the profiles whose cluster is failing health checks
+        """
+        if not self.health_check_interval:
+            return ()
+        degraded = []
+        for profile in profile_list:
+            context = profile.get("spawner_override", {}).get(
+                "kubernetes_context", self.kubernetes_context
+            )
+            # Contexts picked by a callable or by placement are not known up front
+            if not isinstance(context, str) or context == "auto":
+                continue
+            if self.cluster_health(context).is_open:
+                degraded.append(profile["slug"])
+        return tuple(degraded)
+
+    async def _fetch_profile_list(self) -> tuple:
+        """
+        Call profile_list, returning the profiles and a dict for the forms rendered from them
+        """
+        profile_list = await maybe_future(self.profile_list(self))
+        return self._init_profile_list(profile_list), {}
+
+    async def _get_profile_list(self) -> tuple:
+        """
+        Result of _fetch_profile_list, cached according to profile_list_cache_ttl
+        """
+        if not self.profile_list_cache_ttl:
+            return await self._fetch_profile_list()
+        if self.profile_list_cache_key is None:
+            key = self.user.name
+        else:
+            key = await maybe_future(self.profile_list_cache_key(self))
+        return await _profile_lists.get(
+            (self.profile_list, self.profile_form_template, key),
+            self._fetch_profile_list,
+            self.profile_list_cache_ttl,
+            self.profile_list_cache_max_stale,
+        )
 
     async def _render_options_form_dynamically(self, current_spawner):
-        profile_list = await gen.maybe_future(self.profile_list(current_spawner))
-        profile_list = self._init_profile_list(profile_list)
-        return self._render_options_form(profile_list)
+        if callable(self.profile_list):
+            profile_list, forms = await self._get_profile_list()
+        else:
+            profile_list = self._init_profile_list(self.profile_list)
+            forms = None
+        return self._render_options_form(
+            profile_list, forms, self._degraded_profiles(profile_list)
+        )
 
     @default("options_form")
     def _options_form_default(self):
@@ -688,7 +2106,8 @@ class MultiClusterKubeSpawner(Spawner):
         """
         if not self.profile_list:
             return ""
-        if callable(self.profile_list):
+        if callable(self.profile_list) or self.health_check_interval:
+            # Rendered every time, to show which clusters are unreachable
             return self._render_options_form_dynamically
         else:
             return self._render_options_form(self.profile_list)
@@ -749,6 +2168,13 @@ class MultiClusterKubeSpawner(Spawner):
                 # no name specified, use the default
                 profile = default_profile
 
+        self._apply_profile(profile)
+
+    def _apply_profile(self, profile: dict):
+        """
+        Set the traits a profile overrides on this spawner
+        """
+        self._profile_slug = profile["slug"]
         self.log.debug(
             "Applying Spawner override for profile '%s'", profile["display_name"]
         )
@@ -777,6 +2203,56 @@ class MultiClusterKubeSpawner(Spawner):
 
         return profile_list
 
+    async def choose_placement(self):
+        """
+        Pick the cluster to place this server on from placement_targets
+        """
+        if not self.placement_targets:
+            raise ValueError("kubernetes_context is auto, but no placement_targets set")
+        cpu = memory = 0
+        for r in self.apply_patches(self.get_resources_spec()):
+            if r["kind"] == "Pod":
+                pod_cpu, pod_memory = pod_requests(r)
+                cpu += pod_cpu
+                memory += pod_memory
+
+        scorer = self.placement_strategy
+        if not callable(scorer):
+            if scorer not in SCORERS:
+                raise ValueError(
+                    f"Unknown placement_strategy {scorer}. Options include: {', '.join(SCORERS)}"
+                )
+            scorer = SCORERS[scorer]
+        targets = self.placement_targets
+        if self.health_check_interval:
+            # Skip unreachable clusters. If none are reachable, the spawn fails
+            # fast on whichever one is picked
+            targets = [
+                t
+                for t in targets
+                if not self.cluster_health(t["kubernetes_context"]).is_open
+            ] or targets
+        target = await choose_target(
+            targets,
+            cpu,
+            memory,
+            scorer,
+            self.placement_refresh_interval,
+        )
+        self.log.info(
+            f"Placing {self.key} requesting {cpu} CPU and {memory} bytes of memory in context {target['kubernetes_context']}"
+        )
+        for k, v in target.items():
+            if k != "cost":
+                setattr(self, k, v)
+
+    async def _ensure_profile_list(self):
+        if self._profile_list is None:
+            if callable(self.profile_list):
+                self._profile_list, _ = await self._get_profile_list()
+            else:
+                self._profile_list = self._init_profile_list(self.profile_list)
+
     async def load_user_options(self):
         """Load user options from self.user_options dict
 
@@ -786,13 +2262,7 @@ class MultiClusterKubeSpawner(Spawner):
         Override in subclasses to support other options.
         """
 
-        if self._profile_list is None:
-            if callable(self.profile_list):
-                profile_list = await gen.maybe_future(self.profile_list(self))
-            else:
-                profile_list = self.profile_list
-
-            self._profile_list = self._init_profile_list(profile_list)
+        await self._ensure_profile_list()
 
         selected_profile = self.user_options.get("profile", None)
         if self._profile_list:
@@ -802,6 +2272,15 @@ class MultiClusterKubeSpawner(Spawner):
                 "Profile %r requested, but profiles are not enabled", selected_profile
             )
 
+        if self.kubernetes_context == "auto":
+            await self.choose_placement()
+
+        # Profiles and placement targets can override namespace_template
+        self.namespace = get_template(self.namespace_template).render(
+            **self.template_vars
+        )
+        self.validate_templates()
+
         # help debugging by logging any option fields that are not recognized
         option_keys = set(self.user_options)
         unrecognized_keys = option_keys.difference(self._user_option_keys)
@@ -810,3 +2289,23 @@ class MultiClusterKubeSpawner(Spawner):
                 "Ignoring unrecognized Spawner user_options: %s",
                 ", ".join(map(str, sorted(unrecognized_keys))),
             )
+
+
+def get_active_keys() -> set:
+    """
+    (context, key) of every server the hub considers running or starting
+
+    Returns None when the hub is not running in this process.
+    """
+    # Imported here, as importing the hub application is slow and only needed
+    # when running inside it
+    from jupyterhub.app import JupyterHub
+
+    if not JupyterHub.initialized():
+        return None
+    keys = set()
+    for user in JupyterHub.instance().users.values():
+        for spawner in user.spawners.values():
+            if isinstance(spawner, MultiClusterKubeSpawner) and spawner.active:
+                keys.add((spawner.kubernetes_context, spawner.key))
+    return keys
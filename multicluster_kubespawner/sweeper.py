@@ -0,0 +1,138 @@
+"""
+Garbage collection of objects left behind by servers that are no longer running
+
+If the hub crashes while a server is starting, or stopping a server fails,
+objects labelled with the server's key stay behind in the target cluster.
+The sweeper periodically lists labelled objects in every target cluster - one
+request per kind per cluster - and deletes the ones that do not belong to a
+server the hub knows about.
+"""
+import asyncio
+import logging
+import random
+import time
+
+from .client import _parse_timestamp, get_client
+from .informer import KEY_LABEL
+
+log = logging.getLogger(__name__)
+
+
+class OrphanSweeper:
+    """
+    Periodically delete labelled objects whose server is not running
+
+    active_keys is called to get the set of (context, key) of all servers that
+    are running or starting, and may return None if that is not known yet.
+    """
+
+    def __init__(self, active_keys):
+        self.active_keys = active_keys
+        # Kinds to sweep, as a set of (apiVersion, kind) for each context
+        self.targets = {}
+        self.interval = 600
+        self.grace_period = 900
+        self.dry_run = False
+
+        # When each orphan was first seen, by (context, apiVersion, kind, namespace, name)
+        self._first_seen = {}
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _list(self, context: str, api_version: str, kind: str) -> list:
+        try:
+            resp = await get_client(context).list(
+                api_version, kind, label_selector=KEY_LABEL
+            )
+        except Exception as e:
+            log.warning(f"Failed to list {kind} in context {context}: {e}")
+            return []
+        return resp["items"]
+
+    async def sweep(self):
+        """
+        Delete objects that have been orphaned for longer than the grace period
+        """
+        now = time.time()
+        seen = set()
+        for context, kinds in list(self.targets.items()):
+            kinds = sorted(kinds)
+            lists = await asyncio.gather(
+                *(self._list(context, api_version, kind) for api_version, kind in kinds)
+            )
+            # Servers started after this can not have their objects listed
+            # above, unless they are younger than the grace period
+            active = self.active_keys()
+            if active is None:
+                return
+            for (api_version, kind), items in zip(kinds, lists):
+                for obj in items:
+                    metadata = obj["metadata"]
+                    labels = metadata.get("labels", {})
+                    if (context, labels[KEY_LABEL]) in active:
+                        continue
+                    if (
+                        labels.get(
+                            "mcks.hub.jupyter.org/delete-on-stop", "true"
+                        ).lower()
+                        != "true"
+                    ):
+                        continue
+                    if metadata.get("deletionTimestamp"):
+                        continue
+                    oid = (
+                        context,
+                        api_version,
+                        kind,
+                        metadata.get("namespace"),
+                        metadata["name"],
+                    )
+                    seen.add(oid)
+                    first_seen = self._first_seen.setdefault(oid, now)
+                    age = now - _parse_timestamp(metadata["creationTimestamp"])
+                    if min(now - first_seen, age) < self.grace_period:
+                        continue
+                    name = f"{kind}/{metadata['name']} in namespace {metadata.get('namespace')} of context {context}"
+                    if self.dry_run:
+                        log.info(f"Would delete orphaned {name}")
+                        continue
+                    log.info(f"Deleting orphaned {name}")
+                    try:
+                        await get_client(context).delete(
+                            api_version,
+                            kind,
+                            metadata["name"],
+                            metadata.get("namespace"),
+                        )
+                    except Exception as e:
+                        log.warning(f"Failed to delete orphaned {name}: {e}")
+        self._first_seen = {
+            oid: t for oid, t in self._first_seen.items() if oid in seen
+        }
+
+    async def _run(self):
+        while True:
+            # Jitter, so multiple hubs do not all sweep at the same time
+            await asyncio.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                await self.sweep()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f"Failed to sweep orphaned objects: {e}")
+
+
+_sweeper = None
+
+
+def get_orphan_sweeper(active_keys) -> OrphanSweeper:
+    """
+    Return the sweeper shared by all spawners
+    """
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = OrphanSweeper(active_keys)
+    return _sweeper
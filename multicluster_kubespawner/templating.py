@@ -0,0 +1,52 @@
+"""
+Shared jinja2 environment, with a cache of compiled templates
+
+All templates the spawner renders - resources, patches, key & namespace names
+and the profile form - are compiled once per process and cached by their source
+text, so spawns only pay for rendering them. The YAML they produce is parsed
+with load_yaml.
+"""
+import re
+from functools import lru_cache
+from textwrap import dedent
+
+from jinja2 import Environment, Template
+from ruamel.yaml import YAML
+
+environment = Environment()
+
+# Uses the libyaml based parser from ruamel.yaml.clib when it is installed,
+# which is many times faster than the pure python one. Scalars are resolved by
+# ruamel.yaml either way, so both read documents as YAML 1.2.
+yaml = YAML(typ="safe")
+_pure_yaml = YAML(typ="safe", pure=True)
+
+# Escaped UTF-16 surrogates, as tojson writes characters outside the BMP
+_ESCAPED_SURROGATE_RE = re.compile(r"\\u[dD][89a-fA-F]")
+
+
+@lru_cache(maxsize=1024)
+def get_template(source: str, dedent_source: bool = False) -> Template:
+    """
+    Return compiled template for given source text
+
+    If dedent_source is set, common leading whitespace is removed from the
+    source before it is compiled.
+    """
+    if dedent_source:
+        source = dedent(source)
+    return environment.from_string(source)
+
+
+def load_yaml(text: str):
+    """
+    Parse a YAML document, the same way ruamel.yaml's pure python parser would
+
+    libyaml rejects escaped surrogate pairs - which jinja2's tojson produces for
+    characters outside the BMP - and ignores %YAML directives, so only those
+    documents are parsed by the pure python parser instead. Any other error
+    libyaml finds is raised.
+    """
+    if "%YAML" in text or _ESCAPED_SURROGATE_RE.search(text):
+        return _pure_yaml.load(text)
+    return yaml.load(text)
@@ -0,0 +1,385 @@
+"""
+Pools of pre-started user pods that spawns can adopt
+
+A warm pool keeps a number of generic user pods running in a namespace, so
+a spawn does not have to wait for the pod to be scheduled and its image to be
+pulled. The pods are created from the same pod spec a user would get, minus
+everything that is specific to a user. When a user spawns, an available pod
+is claimed by labelling it with the user's key, and the user specific
+environment variables are handed to it via a Secret it has been waiting for.
+"""
+import asyncio
+import copy
+import json
+import logging
+import secrets
+import shlex
+import time
+
+from .client import KubernetesAPIError, get_client
+from .informer import KEY_LABEL, get_reflector
+
+log = logging.getLogger(__name__)
+
+POOL_LABEL = "mcks.hub.jupyter.org/warm-pool"
+STATE_LABEL = "mcks.hub.jupyter.org/warm-pool-state"
+PROFILE_ANNOTATION = "mcks.hub.jupyter.org/warm-pool-profile"
+CLAIMED_AT_ANNOTATION = "mcks.hub.jupyter.org/warm-pool-claimed-at"
+
+# Where the Secret with the user's environment variables is mounted
+ENV_DIR = "/etc/mcks-env"
+
+# Wait for the user's environment to show up, then start the user server.
+# The original command of the container is passed as arguments, and the env
+# file appends the user's args to them.
+LATE_BINDING_SCRIPT = f"""
+while [ ! -s {ENV_DIR}/env ]; do sleep 0.2 2>/dev/null || sleep 1; done
+. {ENV_DIR}/env
+exec "$@"
+"""
+
+
+def make_pool_template(pod: dict) -> tuple:
+    """
+    Split a rendered user pod into a generic pod template and the user's environment
+
+    Returns (template, env, args), where env is a dict of all the plain
+    environment variables of the notebook container and args its arguments.
+    These are removed from the template, and are instead read from a file when
+    the pod is claimed.
+
+    Raises ValueError if anything else in the pod is specific to its user,
+    like a service account of their own, as a pod created before we know who
+    it is for can not have it.
+    """
+    template = copy.deepcopy(pod)
+    metadata = template["metadata"]
+    key = metadata.pop("name", None)
+    labels = metadata.get("labels", {})
+    labels.pop(KEY_LABEL, None)
+
+    spec = template["spec"]
+    if key and spec.get("serviceAccountName") == key:
+        raise ValueError(
+            f"the pod runs as the user's own service account {key}, which a pod started before it is claimed can not have"
+        )
+    spec.setdefault("volumes", []).append(
+        {"name": "mcks-env", "secret": {"secretName": "", "optional": True}}
+    )
+
+    env = {}
+    args = []
+    for c in spec["containers"]:
+        if c["name"] != "notebook":
+            continue
+        env = {e["name"]: e["value"] for e in c.get("env", []) if "value" in e}
+        c["env"] = [e for e in c.get("env", []) if "value" not in e]
+
+        args = c.pop("args", [])
+        command = c.pop("command", [])
+        c["command"] = ["/bin/sh", "-c", LATE_BINDING_SCRIPT, "--"] + command
+        c.setdefault("volumeMounts", []).append(
+            {"name": "mcks-env", "mountPath": ENV_DIR, "readOnly": True}
+        )
+        if "readinessProbe" not in c and c.get("ports"):
+            # Waiting pods are running, but not ready until the server is up
+            c["readinessProbe"] = {
+                "tcpSocket": {"port": c["ports"][0]["containerPort"]},
+                "periodSeconds": 1,
+            }
+    if key and key in json.dumps(template):
+        raise ValueError(
+            f"the pod refers to {key} outside of the notebook container's env and args"
+        )
+    return template, env, args
+
+
+def _is_running(pod: dict) -> bool:
+    status = pod.get("status", {})
+    if status.get("phase") != "Running":
+        return False
+    return all(
+        "running" in (cs.get("state") or {})
+        for cs in status.get("containerStatuses", [])
+    )
+
+
+class WarmPool:
+    """
+    Pool of pre-started pods for one profile in a namespace of a cluster
+
+    A pool that nobody has tried to claim a pod from for idle_timeout seconds
+    deletes its pods and stops.
+    """
+
+    # Seconds between checks of the pool, if nothing triggers one sooner
+    refill_interval = 10
+
+    def __init__(
+        self,
+        context: str,
+        namespace: str,
+        profile: str,
+        pool_id: str,
+        template: dict,
+        size: int,
+        idle_timeout: int = 0,
+    ):
+        self.context = context
+        self.namespace = namespace
+        self.profile = profile
+        self.pool_id = pool_id
+        self.template = template
+        self.size = size
+        self.idle_timeout = idle_timeout
+        # When a spawn last looked for a pod in this pool
+        self.last_used = time.time()
+
+        # Names of pods we created that have not shown up in the reflector yet
+        self._creating = set()
+        self._wake = asyncio.Event()
+        self._task = None
+
+    @property
+    def client(self):
+        return get_client(self.context)
+
+    @property
+    def reflector(self):
+        return get_reflector(
+            self.context, "v1", "Pod", label_selector=POOL_LABEL, index_label=None
+        )
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def retire(self):
+        """
+        Stop refilling the pool, and delete its unclaimed pods in the background
+        """
+        if self._task is not None:
+            self._task.cancel()
+        self._task = asyncio.ensure_future(self._drain())
+
+    async def _drain(self):
+        try:
+            await self.reflector.wait_for_sync()
+            await asyncio.gather(*(self._delete_pod(p) for p in self._pods()))
+        except Exception as e:
+            log.warning(
+                f"Failed to delete pods of warm pool {self.pool_id} in {self.context}/{self.namespace}: {e}"
+            )
+
+    def _pods(self) -> list:
+        """
+        Unclaimed pods of this pool
+        """
+        return [
+            p
+            for (namespace, _), p in self.reflector.objects.items()
+            if namespace == self.namespace
+            and p["metadata"]["labels"].get(POOL_LABEL) == self.pool_id
+            and p["metadata"]["labels"].get(STATE_LABEL) == "available"
+            and not p["metadata"].get("deletionTimestamp")
+        ]
+
+    def _stale_pods(self) -> list:
+        """
+        Unclaimed pods created from an older template for the same profile
+        """
+        return [
+            p
+            for (namespace, _), p in self.reflector.objects.items()
+            if namespace == self.namespace
+            and p["metadata"]["labels"].get(POOL_LABEL) != self.pool_id
+            and p["metadata"]["labels"].get(STATE_LABEL) == "available"
+            and p["metadata"].get("annotations", {}).get(PROFILE_ANNOTATION)
+            == self.profile
+            and not p["metadata"].get("deletionTimestamp")
+        ]
+
+    async def _create_pod(self):
+        name = f"warm-{self.pool_id[:10]}-{secrets.token_hex(4)}"
+        pod = copy.deepcopy(self.template)
+        metadata = pod["metadata"]
+        metadata["name"] = name
+        metadata.setdefault("labels", {}).update(
+            {POOL_LABEL: self.pool_id, STATE_LABEL: "available"}
+        )
+        metadata.setdefault("annotations", {})[PROFILE_ANNOTATION] = self.profile
+        for volume in pod["spec"]["volumes"]:
+            if volume["name"] == "mcks-env":
+                volume["secret"]["secretName"] = f"{name}-env"
+
+        self._creating.add(name)
+        try:
+            await self.client.create(pod, namespace=self.namespace)
+        except Exception:
+            self._creating.discard(name)
+            raise
+
+    async def _delete_pod(self, pod: dict):
+        await self.client.delete("v1", "Pod", pod["metadata"]["name"], self.namespace)
+
+    async def reconcile(self):
+        """
+        Create or delete pods so the pool has `size` unclaimed pods
+        """
+        await self.reflector.wait_for_sync()
+        self._creating -= {name for _, name in self.reflector.objects}
+
+        pods = self._pods()
+        broken = [
+            p
+            for p in pods
+            if p.get("status", {}).get("phase") in ("Failed", "Succeeded")
+        ]
+        healthy = [p for p in pods if p not in broken]
+
+        to_delete = broken + self._stale_pods()
+        count = len(healthy) + len(self._creating)
+        if count > self.size:
+            # Get rid of the pods furthest from being usable first
+            healthy.sort(key=_is_running)
+            to_delete += healthy[: count - self.size]
+
+        await asyncio.gather(*(self._delete_pod(p) for p in to_delete))
+        await asyncio.gather(
+            *(self._create_pod() for _ in range(self.size - count)),
+        )
+
+    async def _run(self):
+        while True:
+            if self.idle_timeout and time.time() - self.last_used > self.idle_timeout:
+                log.info(
+                    f"Warm pool {self.pool_id} in {self.context}/{self.namespace} was not used for {self.idle_timeout}s, deleting it"
+                )
+                if _pools.get((self.context, self.profile)) is self:
+                    del _pools[(self.context, self.profile)]
+                await self._drain()
+                return
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(
+                    f"Failed to refill warm pool {self.pool_id} in {self.context}/{self.namespace}: {e}"
+                )
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def claim(self, labels: dict, env: dict, args: list):
+        """
+        Claim a running pod from the pool for a user
+
+        The pod is labelled with the user's labels so their Service routes to
+        it, and once that claim has succeeded, the user's environment variables
+        and args are written to the Secret the pod is waiting for. Returns (pod name, Secret) or None if no pod is
+        available.
+        """
+        env_file = "".join(
+            f"export {k}={shlex.quote(str(v))}\n" for k, v in env.items()
+        )
+        env_file += 'set -- "$@" ' + " ".join(shlex.quote(str(a)) for a in args)
+        env_file += "\n"
+
+        candidates = [p for p in self._pods() if _is_running(p)]
+        for pod in candidates:
+            name = pod["metadata"]["name"]
+            patch = [
+                # Fails if someone else claimed the pod before us
+                {
+                    "op": "test",
+                    "path": f"/metadata/labels/{STATE_LABEL.replace('/', '~1')}",
+                    "value": "available",
+                },
+                {
+                    "op": "replace",
+                    "path": f"/metadata/labels/{STATE_LABEL.replace('/', '~1')}",
+                    "value": "claimed",
+                },
+            ]
+            for k, v in labels.items():
+                patch.append(
+                    {
+                        "op": "add",
+                        "path": f"/metadata/labels/{k.replace('/', '~1')}",
+                        "value": v,
+                    }
+                )
+            try:
+                await self.client.patch(
+                    "v1", "Pod", name, patch, self.namespace, patch_type="json"
+                )
+            except KubernetesAPIError as e:
+                if e.status_code in (404, 409, 422):
+                    log.debug(f"Warm pod {name} was claimed by someone else: {e}")
+                    continue
+                raise
+
+            # Only written once the pod is ours, so nobody else's environment
+            # can end up in it. If this fails, the claimed pod has the user's
+            # labels, and is deleted when the server is stopped
+            secret = {
+                "apiVersion": "v1",
+                "kind": "Secret",
+                "metadata": {"name": f"{name}-env", "labels": dict(labels)},
+                "stringData": {"env": env_file},
+            }
+            await self.client.apply(secret, namespace=self.namespace)
+            # Changing the pod makes the kubelet refresh its volumes right away,
+            # rather than on its next periodic sync
+            await self.client.patch(
+                "v1",
+                "Pod",
+                name,
+                {
+                    "metadata": {
+                        "annotations": {CLAIMED_AT_ANNOTATION: str(time.time())}
+                    }
+                },
+                self.namespace,
+                patch_type="merge",
+            )
+            # Replace the pod we just took
+            self._wake.set()
+            return name, secret
+        self._wake.set()
+        return None
+
+
+# Pools by (context, profile slug)
+_pools = {}
+
+
+def get_warm_pool(
+    context: str,
+    namespace: str,
+    profile: str,
+    pool_id: str,
+    template: dict,
+    size: int,
+    idle_timeout: int = 0,
+) -> WarmPool:
+    """
+    Return the running pool for a profile, replacing it if the template or namespace changed
+    """
+    key = (context, profile)
+    pool = _pools.get(key)
+    if pool is not None and (pool.pool_id, pool.namespace) != (pool_id, namespace):
+        pool.retire()
+        pool = None
+    if pool is None:
+        pool = _pools[key] = WarmPool(
+            context, namespace, profile, pool_id, template, size, idle_timeout
+        )
+        pool.start()
+    pool.size = size
+    pool.idle_timeout = idle_timeout
+    pool.last_used = time.time()
+    return pool
@@ -6,9 +6,13 @@ setup(
     version="0.2",
     install_requires=[
         "escapism",
+        "httpx[http2]",
         "jupyterhub>=1.5",
         "jinja2",
+        "prometheus_client",
         "ruamel.yaml",
+        # Much faster YAML parsing, with a pure python fallback elsewhere
+        "ruamel.yaml.clib; platform_python_implementation == 'CPython'",
         "traitlets",
     ],
     python_requires=">=3.9",
@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+import pytest
+from multicluster_kubespawner import client as client_module
+from multicluster_kubespawner.client import KubernetesClient
+
+DISCOVERY = {
+    "kind": "APIResourceList",
+    "resources": [
+        {"name": "pods", "kind": "Pod", "namespaced": True},
+        {"name": "pods/log", "kind": "Pod", "namespaced": True},
+    ],
+}
+
+
+@pytest.fixture
+def make_client(monkeypatch):
+    """
+    Make clients for a fake cluster, whose requests are answered by handler
+    """
+
+    def make_client(handler):
+        kubeconfig = {
+            "clusters": {"c": {"server": "https://k8s.example.com"}},
+            "users": {"u": {"token": "secret"}},
+            "contexts": {"test": {"cluster": "c", "user": "u"}},
+            "current-context": "test",
+        }
+        client = KubernetesClient("test", kubeconfig)
+        requests = []
+
+        async def record(request):
+            await request.aread()
+            requests.append(request)
+            if request.url.path == "/api/v1":
+                return httpx.Response(200, json=DISCOVERY)
+            response = handler(request)
+            if asyncio.iscoroutine(response):
+                response = await response
+            return response
+
+        http = httpx.AsyncClient(
+            base_url=client.server, transport=httpx.MockTransport(record)
+        )
+        monkeypatch.setattr(client, "_http_client", lambda client_cert: http)
+        monkeypatch.setattr(client_module, "retry_delay", lambda response, attempt: 0)
+        return client, requests
+
+    return make_client
+
+
+@pytest.fixture
+def status():
+    """
+    Make Kubernetes Status responses
+    """
+
+    def status(code, reason, message=""):
+        return httpx.Response(
+            code,
+            json={"kind": "Status", "code": code, "reason": reason, "message": message},
+        )
+
+    return status
@@ -0,0 +1,50 @@
+import asyncio
+from multicluster_kubespawner.admission import AdmissionController, current_owner
+
+
+def test_admission_order_and_queue_positions():
+    admitted = []
+    positions = {}
+
+    async def request(controller, owner, name, release):
+        current_owner.set((owner, lambda p: positions.setdefault(name, []).append(p)))
+        async with controller.slot():
+            admitted.append(name)
+            await release.wait()
+
+    async def run(policy):
+        admitted.clear()
+        positions.clear()
+        controller = AdmissionController("fake", max_in_flight=2, policy=policy)
+        releases = {}
+        tasks = []
+        # a and x take both slots, then a queues two more requests before b queues one
+        for owner, name in [
+            ("a", "a1"),
+            ("x", "x1"),
+            ("a", "a2"),
+            ("a", "a3"),
+            ("b", "b1"),
+        ]:
+            releases[name] = asyncio.Event()
+            tasks.append(
+                asyncio.ensure_future(request(controller, owner, name, releases[name]))
+            )
+            await asyncio.sleep(0)
+        assert admitted == ["a1", "x1"]
+
+        releases["x1"].set()
+        await asyncio.sleep(0.01)
+        for release in releases.values():
+            release.set()
+        await asyncio.gather(*tasks)
+        assert controller.in_flight == 0
+
+    asyncio.run(run("fifo"))
+    assert admitted[:3] == ["a1", "x1", "a2"]
+    assert positions == {"a2": [1], "a3": [2, 1], "b1": [3, 2, 1]}
+
+    # b has nothing in flight while a does, so it goes first
+    asyncio.run(run("fair"))
+    assert admitted[:3] == ["a1", "x1", "b1"]
+    assert positions["b1"] == [1]
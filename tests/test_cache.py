@@ -0,0 +1,63 @@
+import asyncio
+from multicluster_kubespawner.cache import RefreshingCache
+
+
+def test_stale_values_are_served_while_refreshing():
+    cache = RefreshingCache("test")
+    calls = []
+
+    async def fetch():
+        calls.append(len(calls))
+        await asyncio.sleep(0.05)
+        if len(calls) == 3:
+            raise RuntimeError("inventory service is down")
+        return len(calls)
+
+    async def run():
+        # Callers without a value wait for a single shared fetch
+        values = await asyncio.gather(
+            *(cache.get("k", fetch, ttl=0.1, max_stale=10) for _ in range(5))
+        )
+        assert values == [1] * 5
+        assert await cache.get("k", fetch, ttl=0.1, max_stale=10) == 1
+        assert len(calls) == 1
+
+        # Once the value is stale, it is returned right away and refreshed
+        await asyncio.sleep(0.1)
+        assert await cache.get("k", fetch, ttl=0.1, max_stale=10) == 1
+        await asyncio.sleep(0.1)
+        assert await cache.get("k", fetch, ttl=0.1, max_stale=10) == 2
+
+        # A failed refresh keeps the stale value around
+        await asyncio.sleep(0.1)
+        assert await cache.get("k", fetch, ttl=0.1, max_stale=10) == 2
+        await asyncio.sleep(0.1)
+        assert await cache.get("k", fetch, ttl=0.1, max_stale=10) == 2
+        await asyncio.sleep(0)
+        assert len(calls) == 4
+
+        # Too old to be used at all
+        await asyncio.sleep(0.1)
+        assert await cache.get("k", fetch, ttl=0.01, max_stale=0) == 5
+
+    asyncio.run(run())
+
+
+def test_values_too_old_to_use_are_dropped():
+    cache = RefreshingCache("test")
+
+    async def fetch():
+        return "value"
+
+    async def run():
+        for key in ("a", "b"):
+            await cache.get(key, fetch, ttl=0.05, max_stale=0.05)
+        await cache.get("c", fetch, ttl=10)
+        assert set(cache._values) == {"a", "b", "c"}
+
+        # Fetching another value drops the ones nobody could use anymore
+        await asyncio.sleep(0.1)
+        await cache.get("d", fetch, ttl=10)
+        assert set(cache._values) == {"c", "d"}
+
+    asyncio.run(run())
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+from multicluster_kubespawner import client as client_module
+from multicluster_kubespawner.client import (
+    ExecCredentials,
+    KubernetesAPIError,
+    get_exec_credentials,
+)
+from multicluster_kubespawner.informer import ResourceReflector
+
+PLUGIN = """#!/bin/sh
+echo run >> {runs}
+sleep 0.1
+cat <<EOF
+{{"apiVersion": "client.authentication.k8s.io/v1", "kind": "ExecCredential",
+  "status": {{"token": "token-$(wc -l < {runs} | tr -d ' ')", "expirationTimestamp": "$EXPIRES"}}}}
+EOF
+"""
+
+
+def make_plugin(tmp_path, expires_in):
+    runs = tmp_path / "runs"
+    runs.touch()
+    plugin = tmp_path / "plugin"
+    plugin.write_text(PLUGIN.format(runs=runs))
+    plugin.chmod(0o755)
+    expires = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + expires_in))
+    exec_config = {
+        "apiVersion": "client.authentication.k8s.io/v1",
+        "command": str(plugin),
+        "env": [{"name": "EXPIRES", "value": expires}],
+    }
+    return exec_config, runs
+
+
+def test_exec_credentials_run_once_and_refresh_ahead(tmp_path):
+    # Expires within the refresh margin, but is still valid
+    exec_config, runs = make_plugin(tmp_path, 60)
+    credentials = ExecCredentials("fake", exec_config, {}, str(tmp_path))
+
+    async def run():
+        tokens = await asyncio.gather(*(credentials.get() for _ in range(10)))
+        assert {t for t, _ in tokens} == {"token-1"}
+
+        # The current token is handed out while a new one is fetched
+        assert (await credentials.get())[0] == "token-1"
+        assert (await credentials.get())[0] == "token-1"
+        await asyncio.sleep(0.5)
+        assert (await credentials.get())[0] == "token-2"
+        await credentials._refresh
+
+    asyncio.run(run())
+    # The second refresh was started by the get() that saw token-2
+    assert len(runs.read_text().splitlines()) == 3
+
+
+def test_exec_credentials_shared_by_plugin_config(tmp_path):
+    exec_config, _ = make_plugin(tmp_path, 3600)
+    a = get_exec_credentials("a", exec_config, {"server": "https://a"}, str(tmp_path))
+    b = get_exec_credentials("b", exec_config, {"server": "https://b"}, str(tmp_path))
+    assert a is b
+
+    exec_config = dict(exec_config, provideClusterInfo=True)
+    a = get_exec_credentials("a", exec_config, {"server": "https://a"}, str(tmp_path))
+    b = get_exec_credentials("b", exec_config, {"server": "https://b"}, str(tmp_path))
+    assert a is not b
+
+
+def test_requests_are_made_to_the_right_paths(make_client, status):
+    def handler(request):
+        if request.method == "DELETE" and request.url.path.endswith("/gone"):
+            return status(404, "NotFound")
+        return httpx.Response(200, json={"metadata": {"name": "a"}})
+
+    client, requests = make_client(handler)
+    pod = {"apiVersion": "v1", "kind": "Pod", "metadata": {"name": "a"}}
+
+    async def run():
+        await client.apply(pod, namespace="ns")
+        await client.patch("v1", "Pod", "a", [{"op": "remove"}], "ns", "json")
+        await client.delete("v1", "Pod", "a", "ns")
+        assert await client.delete("v1", "Pod", "gone", "ns") is None
+
+    asyncio.run(run())
+    # Discovery is only done once
+    assert [(r.method, r.url.path) for r in requests] == [
+        ("GET", "/api/v1"),
+        ("PATCH", "/api/v1/namespaces/ns/pods/a"),
+        ("PATCH", "/api/v1/namespaces/ns/pods/a"),
+        ("DELETE", "/api/v1/namespaces/ns/pods/a"),
+        ("DELETE", "/api/v1/namespaces/ns/pods/gone"),
+    ]
+    apply, patch = requests[1], requests[2]
+    assert apply.headers["Content-Type"] == "application/apply-patch+yaml"
+    assert apply.url.params["fieldManager"] == "multicluster-kubespawner"
+    assert apply.url.params["force"] == "true"
+    assert json.loads(apply.content) == pod
+    assert patch.headers["Content-Type"] == "application/json-patch+json"
+    assert all(r.headers["Authorization"] == "Bearer secret" for r in requests)
+
+
+def test_error_responses_raise_api_errors(make_client, status):
+    def handler(request):
+        if request.url.path.endswith("/invalid"):
+            return status(422, "Invalid", "spec.containers is required")
+        return httpx.Response(500, text="oops")
+
+    client, _ = make_client(handler)
+
+    async def get(name):
+        return await client.get("v1", "Pod", name, "ns")
+
+    with pytest.raises(KubernetesAPIError) as e:
+        asyncio.run(get("invalid"))
+    assert (e.value.status_code, e.value.reason, e.value.message) == (
+        422,
+        "Invalid",
+        "spec.containers is required",
+    )
+    # Responses that are not a Status object still raise
+    with pytest.raises(KubernetesAPIError) as e:
+        asyncio.run(get("broken"))
+    assert (e.value.status_code, e.value.message) == (500, "oops")
+
+
+def test_throttled_requests_are_retried(make_client, status):
+    responses = []
+
+    def handler(request):
+        return responses.pop(0)
+
+    client, requests = make_client(handler)
+    client.max_retries = 2
+
+    async def get():
+        return await client.get("v1", "Pod", "a", "ns")
+
+    responses[:] = [
+        status(429, "TooManyRequests"),
+        status(503, "ServiceUnavailable"),
+        httpx.Response(200, json={"metadata": {"name": "a"}}),
+    ]
+    assert asyncio.run(get()) == {"metadata": {"name": "a"}}
+    assert len(requests) == 4
+
+    # Until max_retries is reached
+    responses[:] = [status(429, "TooManyRequests")] * 3
+    with pytest.raises(KubernetesAPIError) as e:
+        asyncio.run(get())
+    assert e.value.status_code == 429
+    assert not responses
+
+
+def test_retry_delay_backs_off_and_honours_retry_after():
+    response = httpx.Response(429)
+    assert 0.5 <= client_module.retry_delay(response, 0) <= 0.75
+    assert 4 <= client_module.retry_delay(response, 3) <= 6
+    assert client_module.retry_delay(response, 20) <= 45
+    response = httpx.Response(429, headers={"Retry-After": "10"})
+    assert client_module.retry_delay(response, 0) >= 10
+
+
+def test_watches_resume_and_relist_when_expired(monkeypatch, make_client):
+    def pod(rv):
+        return {
+            "metadata": {
+                "name": "a",
+                "namespace": "ns",
+                "resourceVersion": rv,
+                "labels": {"mcks.hub.jupyter.org/key": "a"},
+            }
+        }
+
+    def lines(*events):
+        return httpx.Response(
+            200, content="".join(json.dumps(e) + "\n" for e in events).encode()
+        )
+
+    done = asyncio.Event()
+    responses = [
+        # Initial list
+        httpx.Response(200, json={"metadata": {"resourceVersion": "1"}, "items": []}),
+        # A watch that ends after an event, as they do after timeoutSeconds
+        lines({"type": "ADDED", "object": pod("2")}),
+        # Resumed from the last event, then expired
+        lines(
+            {"type": "BOOKMARK", "object": {"metadata": {"resourceVersion": "5"}}},
+            {"type": "ERROR", "object": {"code": 410, "reason": "Expired"}},
+        ),
+        # Relisted
+        httpx.Response(
+            200, json={"metadata": {"resourceVersion": "9"}, "items": [pod("9")]}
+        ),
+    ]
+
+    async def handler(request):
+        if not responses:
+            done.set()
+            # Block, like a watch with nothing happening would
+            await asyncio.sleep(3600)
+        return responses.pop(0)
+
+    client, requests = make_client(handler)
+    monkeypatch.setitem(client_module._clients, "test", client)
+
+    async def run():
+        reflector = ResourceReflector("test", "v1", "Pod", "")
+        reflector.start()
+        await asyncio.wait_for(done.wait(), 5)
+        reflector._task.cancel()
+        return reflector
+
+    reflector = asyncio.run(run())
+    params = [
+        (r.url.params.get("watch"), r.url.params.get("resourceVersion"))
+        for r in requests[1:6]
+    ]
+    assert params == [
+        (None, None),
+        ("1", "1"),
+        ("1", "2"),
+        (None, None),
+        ("1", "9"),
+    ]
+    assert reflector.get("ns", "a")["metadata"]["resourceVersion"] == "9"
@@ -0,0 +1,33 @@
+import asyncio
+from multicluster_kubespawner import health
+from multicluster_kubespawner.health import ClusterHealth
+
+
+class FakeClient:
+    def __init__(self):
+        self.up = True
+
+    async def readyz(self):
+        if not self.up:
+            raise ConnectionError("connection refused")
+
+
+def test_circuit_opens_after_failures_and_closes_on_success(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(health, "get_client", lambda context: client)
+    cluster = ClusterHealth("a", failure_threshold=2)
+
+    async def run():
+        await cluster.check()
+        assert not cluster.is_open
+        client.up = False
+        await cluster.check()
+        assert not cluster.is_open
+        await cluster.check()
+        assert cluster.is_open
+        assert cluster.last_error == "connection refused"
+        client.up = True
+        await cluster.check()
+        assert not cluster.is_open
+
+    asyncio.run(run())
@@ -0,0 +1,76 @@
+import asyncio
+from multicluster_kubespawner import client
+from multicluster_kubespawner.client import pod_is_ready
+from multicluster_kubespawner.informer import ResourceReflector
+
+
+def make_pod(name, ready, rv):
+    return {
+        "metadata": {
+            "name": name,
+            "namespace": "ns",
+            "resourceVersion": rv,
+            "labels": {"mcks.hub.jupyter.org/key": name},
+        },
+        "status": {"conditions": [{"type": "Ready", "status": ready}]},
+    }
+
+
+class FakeClient:
+    def __init__(self, pods, events):
+        self.pods = pods
+        self.events = events
+
+    async def list(self, api_version, kind, label_selector=None):
+        return {"metadata": {"resourceVersion": "1"}, "items": self.pods}
+
+    async def watch(self, api_version, kind, **kwargs):
+        for event in self.events:
+            await asyncio.sleep(0.01)
+            yield event
+        # Block, like a watch with nothing happening would
+        await asyncio.sleep(3600)
+        yield
+
+
+def test_reflector_wait_for(monkeypatch):
+    monkeypatch.setitem(
+        client._clients,
+        "fake",
+        FakeClient(
+            [make_pod("a", "True", "1"), make_pod("b", "False", "1")],
+            [{"type": "MODIFIED", "object": make_pod("b", "True", "2")}],
+        ),
+    )
+
+    async def run():
+        reflector = ResourceReflector("fake", "v1", "Pod", "mcks.hub.jupyter.org/key")
+        assert await reflector.wait_for_sync(1)
+        assert await reflector.wait_for("ns", "a", pod_is_ready, 1)
+        assert not await reflector.wait_for("ns", "missing", pod_is_ready, 1)
+        # b becomes ready through a watch event
+        assert await reflector.wait_for("ns", "b", pod_is_ready, 1)
+        reflector._task.cancel()
+
+    asyncio.run(run())
+
+
+def test_events_about_a_replaced_pod_are_ignored():
+    reflector = ResourceReflector("fake", "v1", "Pod", "mcks.hub.jupyter.org/key")
+    old = make_pod("a", "True", "1")
+    old["metadata"]["uid"] = "old"
+    new = make_pod("a", "False", "3")
+    new["metadata"]["uid"] = "new"
+    reflector._update("ADDED", old)
+    terminating = make_pod("a", "False", "2")
+    terminating["metadata"].update(uid="old", deletionTimestamp="now")
+
+    # The server is restarted before the old pod is gone
+    reflector._update("MODIFIED", terminating)
+    reflector._update("ADDED", new)
+    reflector._update("MODIFIED", terminating)
+    assert reflector.get("ns", "a") is new
+    reflector._update("DELETED", terminating)
+    assert reflector.get("ns", "a") is new
+    reflector._update("DELETED", new)
+    assert reflector.get("ns", "a") is None
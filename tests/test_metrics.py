@@ -0,0 +1,72 @@
+import asyncio
+
+import httpx
+import pytest
+from prometheus_client import REGISTRY
+from multicluster_kubespawner.metrics import time_phase
+from multicluster_kubespawner.spawner import MultiClusterKubeSpawner
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_phases_are_labelled_when_they_end():
+    labels = {"context": "", "profile": ""}
+    phase = {"operation": "start", "phase": "test", "context": "c1", "profile": "gpu"}
+    durations = sample("mcks_phase_duration_seconds_count", **phase)
+    failures = sample("mcks_phase_failures_total", **phase)
+
+    # Placement decides the context and profile while the phase runs
+    with time_phase("start", "test", lambda: labels):
+        labels.update(context="c1", profile="gpu")
+    assert sample("mcks_phase_duration_seconds_count", **phase) == durations + 1
+    assert sample("mcks_phase_failures_total", **phase) == failures
+
+    with pytest.raises(RuntimeError):
+        with time_phase("start", "test", lambda: labels):
+            raise RuntimeError("failed")
+    assert sample("mcks_phase_failures_total", **phase) == failures + 1
+    # Failed phases are timed too
+    assert sample("mcks_phase_duration_seconds_count", **phase) == durations + 2
+
+
+def test_spawner_phases_are_labelled_with_context_and_profile(user, hub):
+    spawner = MultiClusterKubeSpawner(user=user, hub=hub)
+    phase = {"operation": "stop", "phase": "test", "context": "c2", "profile": "cpu"}
+    durations = sample("mcks_phase_duration_seconds_count", **phase)
+
+    with spawner.time_phase("stop", "test"):
+        spawner.kubernetes_context = "c2"
+        spawner._profile_slug = "cpu"
+    assert sample("mcks_phase_duration_seconds_count", **phase) == durations + 1
+
+
+def test_api_requests_are_labelled_with_method_and_code(make_client, status):
+    responses = [
+        status(429, "TooManyRequests"),
+        status(503, "ServiceUnavailable"),
+        httpx.Response(200, json={"metadata": {"name": "a"}}),
+    ]
+    client, requests = make_client(lambda request: responses.pop(0))
+    counts = {
+        code: sample("mcks_api_requests_total", context="test", method="GET", code=code)
+        for code in ("200", "429", "503")
+    }
+    retries = {
+        reason: sample("mcks_api_retries_total", context="test", reason=reason)
+        for reason in ("throttled", "unavailable")
+    }
+
+    asyncio.run(client.get("v1", "Pod", "a", "ns"))
+    # Discovery is counted as well
+    counts["200"] += sum(r.url.path == "/api/v1" for r in requests)
+    for code, count in counts.items():
+        assert (
+            sample("mcks_api_requests_total", context="test", method="GET", code=code)
+            == count + 1
+        )
+    for reason, count in retries.items():
+        assert (
+            sample("mcks_api_retries_total", context="test", reason=reason) == count + 1
+        )
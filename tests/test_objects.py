@@ -1,25 +1,24 @@
+import asyncio
+import httpx
 import pytest
 from unittest.mock import MagicMock
-from multicluster_kubespawner.spawner import MultiClusterKubeSpawner
+from traitlets import TraitError
+from traitlets.config import Config
+from multicluster_kubespawner import health
+from multicluster_kubespawner import spawner as spawner_module
+from multicluster_kubespawner.informer import KEY_LABEL, ResourceReflector
+from multicluster_kubespawner.metrics import ROUTE_PROBE_RETRIES
+from multicluster_kubespawner.spawner import (
+    DELETE_ON_STOP_LABEL,
+    MultiClusterKubeSpawner,
+    is_deleted_on_stop,
+    normalize_delete_on_stop,
+)
 
 
 @pytest.fixture
-def spawner():
-    sp = MultiClusterKubeSpawner()
-    user = MagicMock()
-    user.name = "mock_name"
-    user.id = "mock_id"
-    user.url = "mock_url"
-    sp.user = user
-
-    hub = MagicMock()
-    hub.public_host = "mock_public_host"
-    hub.url = "mock_url"
-    hub.base_url = "mock_base_url"
-    hub.api_url = "mock_api_url"
-    sp.hub = hub
-
-    return sp
+def spawner(user, hub):
+    return MultiClusterKubeSpawner(user=user, hub=hub)
 
 
 def test_key(spawner):
@@ -32,9 +31,9 @@ def test_key(spawner):
         spec:
             containers:
             - name: nginx
-            image: nginx:1.14.2
-            ports:
-                - containerPort: 80
+              image: nginx:1.14.2
+              ports:
+              - containerPort: 80
         """,
         "02-b": """
         apiVersion: v1
@@ -43,4 +42,602 @@ def test_key(spawner):
             name: {{key}}
         """,
     }
-    print(spawner.get_resources_specs())
+    assert spawner.key == "jupyter-mock-5fname"
+    resources = spawner.get_resources_spec()
+    # Every resource is named after the key, and labelled with it
+    for resource in resources:
+        assert resource["metadata"]["name"] == spawner.key
+        assert resource["metadata"]["labels"][KEY_LABEL] == spawner.key
+    assert {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": spawner.key, "labels": {KEY_LABEL: spawner.key}},
+        "spec": {
+            "containers": [
+                {
+                    "name": "nginx",
+                    "image": "nginx:1.14.2",
+                    "ports": [{"containerPort": 80}],
+                }
+            ]
+        },
+    } in resources
+    assert {
+        "apiVersion": "v1",
+        "kind": "ServiceAccount",
+        "metadata": {"name": spawner.key, "labels": {KEY_LABEL: spawner.key}},
+    } in resources
+
+
+def test_invalid_templates_are_reported_when_the_hub_loads(
+    user, hub, monkeypatch, caplog
+):
+    monkeypatch.setitem(spawner_module._templates_checked, "done", False)
+    profile_list = [
+        {"slug": "ok", "display_name": "OK"},
+        {
+            "slug": "broken",
+            "display_name": "Broken",
+            "spawner_override": {"resources": {"09-broken": "name: {{key}"}},
+        },
+    ]
+    spawner = MultiClusterKubeSpawner(user=user, hub=hub, profile_list=profile_list)
+    # Servers can still be restored, polled and stopped
+    spawner.load_state({})
+    errors = [r.getMessage() for r in caplog.records if r.levelname == "ERROR"]
+    assert len(errors) == 1
+    assert errors[0].startswith("Invalid templates in profile Broken")
+
+    # Only once per process
+    caplog.clear()
+    MultiClusterKubeSpawner(user=user, hub=hub, profile_list=profile_list).load_state(
+        {}
+    )
+    assert not [r for r in caplog.records if r.levelname == "ERROR"]
+
+
+def test_invalid_templates_fail_the_start(user, hub):
+    broken = {
+        "01-broken": """
+        kind: Pod
+        metadata:
+            name: {{key}
+        """
+    }
+    profile_list = [
+        {"slug": "ok", "display_name": "OK"},
+        {
+            "slug": "broken",
+            "display_name": "Broken",
+            "spawner_override": {"patches": broken},
+        },
+    ]
+    # Only starting with the broken profile fails, stop and poll never render
+    for slug in ("ok", "broken"):
+        spawner = MultiClusterKubeSpawner(user=user, hub=hub, profile_list=profile_list)
+        spawner.user_options = {"profile": slug}
+        if slug == "ok":
+            asyncio.run(spawner.load_user_options())
+        else:
+            with pytest.raises(ValueError, match="Invalid patch template"):
+                asyncio.run(spawner.load_user_options())
+
+
+def test_warm_pools_need_a_shared_namespace(spawner, monkeypatch):
+    assert not spawner._namespace_is_shared()
+    pod = {"kind": "Pod", "metadata": {"name": spawner.key}, "spec": {}}
+    monkeypatch.setattr(
+        spawner_module, "get_warm_pool", MagicMock(side_effect=AssertionError)
+    )
+    assert asyncio.run(spawner.adopt_warm_pod([pod])) == [pod]
+
+    spawner.namespace_template = "jupyterhub"
+    assert spawner._namespace_is_shared()
+
+
+def test_health_checks_are_off_by_default(spawner):
+    profiles = [{"slug": "a", "spawner_override": {"kubernetes_context": "unchecked"}}]
+    assert spawner._degraded_profiles(profiles) == ()
+    assert "unchecked" not in health._health
+
+
+def test_prepull_images_by_context(user, hub):
+    spawner = MultiClusterKubeSpawner(user=user, hub=hub)
+    spawner._profile_list = [
+        {
+            "slug": "a",
+            "display_name": "A",
+            "spawner_override": {"kubernetes_context": "a"},
+        },
+        {
+            "slug": "b",
+            "display_name": "B",
+            "spawner_override": {"kubernetes_context": "b", "image": "b:1"},
+        },
+        {
+            "slug": "c",
+            "display_name": "C",
+            "spawner_override": {
+                "kubernetes_context": "b",
+                "patches": {
+                    "01-image": """
+                    kind: Pod
+                    metadata:
+                        name: {{key}}
+                    spec:
+                        containers:
+                        - name: notebook
+                          image: c:1
+                    """
+                },
+            },
+        },
+    ]
+    images = asyncio.run(spawner.get_prepull_images())
+    assert images == {"a": ["pangeo/pangeo-notebook:latest"], "b": ["b:1", "c:1"]}
+
+
+def test_state_is_compact_and_old_state_is_migrated(spawner, user, hub):
+    pod = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": spawner.key},
+        "spec": {"containers": [{"env": [{"name": "JUPYTERHUB_API_TOKEN"}]}]},
+    }
+    rid = spawner.resource_id(pod)
+    old_state = {
+        "key": spawner.key,
+        "kubernetes_context": "a",
+        "ingress_public_url ": "https://a.example.com",
+        "created_resources": [pod],
+        "resource_hashes": {rid: "abc"},
+    }
+    spawner.load_state(old_state)
+    state = spawner.get_state()
+    assert state["ingress_public_url"] == "https://a.example.com"
+    assert "JUPYTERHUB_API_TOKEN" not in str(state)
+    assert state["resources"] == [
+        {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "name": spawner.key,
+            "namespace": spawner.namespace,
+            "uid": None,
+            "hash": "abc",
+        }
+    ]
+
+    restored = MultiClusterKubeSpawner(user=user, hub=hub)
+    restored.load_state(state)
+    assert restored.get_state() == state
+    assert restored.resource_hashes == {rid: "abc"}
+
+
+def test_poll_keeps_servers_when_pods_can_not_be_listed(spawner, monkeypatch):
+    class UnsyncedReflector:
+        async def wait_for_sync(self, timeout):
+            return False
+
+    monkeypatch.setattr(MultiClusterKubeSpawner, "pod_reflector", UnsyncedReflector())
+    rechecks = []
+
+    async def recheck():
+        rechecks.append(spawner.key)
+
+    spawner._recheck_restored = recheck
+    spawner.load_state(
+        {
+            "key": spawner.key,
+            "resources": [
+                {
+                    "apiVersion": "v1",
+                    "kind": "Pod",
+                    "name": spawner.key,
+                    "namespace": "a",
+                }
+            ],
+        }
+    )
+
+    async def poll_twice():
+        assert await spawner.poll() is None
+        assert await spawner.poll() is None
+        await asyncio.sleep(0)
+
+    asyncio.run(poll_twice())
+    # Only the first poll after the hub restarted is checked again
+    assert rechecks == [spawner.key]
+
+
+def test_poll_answers_from_the_cache_right_away(spawner, monkeypatch):
+    reflector = ResourceReflector("a", "v1", "Pod", KEY_LABEL)
+    reflector.synced.set()
+    monkeypatch.setattr(MultiClusterKubeSpawner, "pod_reflector", reflector)
+
+    def pod(phase, ready="False", **metadata):
+        return {
+            "metadata": dict(
+                name=spawner.key,
+                namespace=spawner.namespace,
+                labels={KEY_LABEL: spawner.key},
+                **metadata,
+            ),
+            "status": {
+                "phase": phase,
+                "conditions": [{"type": "Ready", "status": ready}],
+            },
+        }
+
+    async def poll(obj):
+        reflector.objects.clear()
+        if obj is not None:
+            reflector._update("ADDED", obj)
+        # Nothing is waited for, even when the pod is not ready
+        return await asyncio.wait_for(spawner.poll(), 0.5)
+
+    async def run():
+        assert await poll(pod("Pending")) is None
+        assert await poll(pod("Running", "True")) is None
+        assert await poll(pod("Running")) == 1
+        assert await poll(pod("Failed")) == 1
+        assert await poll(pod("Running", "True", deletionTimestamp="now")) == 1
+        assert await poll(None) == 1
+
+    asyncio.run(run())
+
+
+def test_pod_events_are_reported_as_progress(spawner, monkeypatch):
+    pod = {"apiVersion": "v1", "kind": "Pod", "metadata": {"name": spawner.key}}
+    spawner.created_resources = [pod]
+    spawner.resource_uids[spawner.resource_id(pod)] = "pod-uid"
+
+    def event(name, reason, message, count=1, event_type="Normal"):
+        return {
+            "type": "ADDED" if count == 1 else "MODIFIED",
+            "object": {
+                "metadata": {"name": name},
+                "type": event_type,
+                "reason": reason,
+                "message": message,
+                "count": count,
+            },
+        }
+
+    class FakeClient:
+        async def watch(self, api_version, kind, namespace, field_selector, timeout):
+            assert field_selector == "involvedObject.uid=pod-uid"
+            yield event("a", "Scheduled", "Assigned to node-1")
+            yield event("b", "BackOff", "Back-off pulling", event_type="Warning")
+            yield event("b", "BackOff", "Back-off pulling", event_type="Warning")
+            yield event("b", "BackOff", "Back-off pulling", 2, "Warning")
+            yield event("c", "Started", "Started container notebook")
+
+    monkeypatch.setattr(MultiClusterKubeSpawner, "client", FakeClient())
+    asyncio.run(spawner._report_pod_events())
+    assert spawner._progress_events == [
+        {"message": "[Normal] Assigned to node-1", "progress": 40},
+        {"message": "[Warning] Back-off pulling"},
+        {"message": "[Warning] Back-off pulling"},
+        {"message": "[Normal] Started container notebook", "progress": 70},
+    ]
+
+
+def test_events_of_adopted_warm_pods_are_reported(spawner, monkeypatch):
+    class StartedReflector(ResourceReflector):
+        def start(self):
+            self.synced.set()
+
+    reflector = StartedReflector("a", "v1", "Pod", "")
+    monkeypatch.setattr(MultiClusterKubeSpawner, "pod_reflector", reflector)
+    # Claimed from the warm pool, so the name differs from the key
+    spawner.created_resources = [
+        {"apiVersion": "v1", "kind": "Pod", "metadata": {"name": "warm-abc"}}
+    ]
+    reflector._update(
+        "ADDED",
+        {
+            "metadata": {
+                "name": "warm-abc",
+                "namespace": spawner.namespace,
+                "uid": "warm-uid",
+                "labels": {KEY_LABEL: spawner.key},
+            }
+        },
+    )
+
+    class FakeClient:
+        async def watch(self, api_version, kind, namespace, field_selector, timeout):
+            assert field_selector == "involvedObject.uid=warm-uid"
+            yield {
+                "type": "ADDED",
+                "object": {
+                    "metadata": {"name": "a"},
+                    "type": "Normal",
+                    "reason": "Started",
+                    "message": "Started container notebook",
+                },
+            }
+
+    monkeypatch.setattr(MultiClusterKubeSpawner, "client", FakeClient())
+    asyncio.run(spawner._report_pod_events())
+    assert spawner._progress_events == [
+        {"message": "[Normal] Started container notebook", "progress": 70}
+    ]
+
+
+def test_profiles_can_override_the_namespace(user, hub):
+    spawner = MultiClusterKubeSpawner(
+        user=user,
+        hub=hub,
+        profile_list=[
+            {
+                "display_name": "Shared",
+                "slug": "shared",
+                "spawner_override": {"namespace_template": "jupyterhub"},
+            }
+        ],
+    )
+    spawner.user_options = {"profile": "shared"}
+    asyncio.run(spawner.load_user_options())
+    assert spawner.namespace == "jupyterhub"
+
+    # Servers are found in the same namespace after the hub restarts
+    restored = MultiClusterKubeSpawner(user=user, hub=hub)
+    restored.load_state(spawner.get_state())
+    assert restored.namespace == "jupyterhub"
+
+
+def test_stop_keeps_resources_not_deleted_on_stop(spawner, monkeypatch):
+    def resource(kind, name, label=None):
+        r = {"apiVersion": "v1", "kind": kind, "metadata": {"name": name}}
+        if label is not None:
+            r["metadata"]["labels"] = {DELETE_ON_STOP_LABEL: label}
+        normalize_delete_on_stop(r)
+        return r
+
+    deleted = resource("Pod", spawner.key)
+    kept = resource("PersistentVolumeClaim", "home", "FALSE")
+    other = resource("ConfigMap", "other", "no")
+    assert kept["metadata"]["labels"][DELETE_ON_STOP_LABEL] == "false"
+    assert other["metadata"]["labels"][DELETE_ON_STOP_LABEL] == "false"
+    spawner.created_resources = [deleted, kept, other]
+    for r in spawner.created_resources:
+        spawner.resource_hashes[spawner.resource_id(r)] = "abc"
+
+    class FakeClient:
+        def __init__(self):
+            self.deleted = []
+
+        async def delete_collection(self, api_version, kind, namespace, label_selector):
+            self.deleted.append((kind, label_selector))
+
+    client = FakeClient()
+    monkeypatch.setattr(MultiClusterKubeSpawner, "client", client)
+    monkeypatch.setattr(
+        MultiClusterKubeSpawner, "_wait_for_stopped", lambda self: asyncio.sleep(0)
+    )
+    asyncio.run(spawner.stop())
+    assert client.deleted == [
+        (
+            "Pod",
+            f"mcks.hub.jupyter.org/key={spawner.key},{DELETE_ON_STOP_LABEL}!=false",
+        )
+    ]
+    # Kept objects can still be skipped when the server starts again
+    assert list(spawner.resource_hashes) == [
+        spawner.resource_id(kept),
+        spawner.resource_id(other),
+    ]
+
+    # Which objects are kept is remembered across hub restarts
+    state = spawner.get_state()
+    spawner.load_state(state)
+    assert [is_deleted_on_stop(r) for r in spawner.created_resources] == [
+        True,
+        False,
+        False,
+    ]
+
+
+def test_start_fails_when_the_server_does_not_become_ready(spawner, monkeypatch):
+    async def not_ready(self, timeout):
+        return False
+
+    monkeypatch.setattr(MultiClusterKubeSpawner, "wait_for_pod_ready", not_ready)
+    with pytest.raises(TimeoutError, match="did not become ready"):
+        asyncio.run(spawner.wait_for_ready(1))
+
+
+def test_routing_mode_is_checked(spawner):
+    spawner.routing_mode = "HTTPProxy"
+    assert spawner.routing_mode == "httpproxy"
+    assert (
+        spawner.get_resource_templates()["04-ingress"]
+        == spawner.default_httpproxy_route
+    )
+    with pytest.raises(TraitError):
+        spawner.routing_mode = "gateway"
+
+
+def test_start_waits_for_a_pod_stop_deleted(spawner, monkeypatch):
+    reflector = ResourceReflector("a", "v1", "Pod", KEY_LABEL)
+    reflector.synced.set()
+    monkeypatch.setattr(MultiClusterKubeSpawner, "pod_reflector", reflector)
+    pod = {
+        "metadata": {
+            "name": spawner.key,
+            "namespace": spawner.namespace,
+            "labels": {KEY_LABEL: spawner.key},
+        }
+    }
+    reflector._update("ADDED", pod)
+
+    async def run():
+        # A pod nobody deleted is not waited for
+        await asyncio.wait_for(spawner.wait_for_old_pod(1), 0.5)
+        # The delete stop() sent has not shown up as a deletionTimestamp yet
+        spawner._deleted_pod = True
+        waiting = asyncio.ensure_future(spawner.wait_for_old_pod(1))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        reflector._update("DELETED", pod)
+        await waiting
+        assert not spawner._deleted_pod
+
+    asyncio.run(run())
+
+
+def test_background_failures_are_logged(spawner, caplog):
+    async def fail():
+        raise RuntimeError("boom")
+
+    async def run():
+        task = spawner.run_in_background(fail(), "do something")
+        assert task in spawner_module._background_tasks
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        assert task not in spawner_module._background_tasks
+
+    asyncio.run(run())
+    assert "Failed to do something" in caplog.text
+    assert "boom" in caplog.text
+
+
+def test_admission_policy_is_checked(spawner):
+    spawner.admission_policy = "FIFO"
+    assert spawner.admission_policy == "fifo"
+    with pytest.raises(TraitError):
+        spawner.admission_policy = "lifo"
+
+
+def test_queue_position_is_reported_coarsely(spawner):
+    for position in range(40, 0, -1):
+        spawner._report_queue_position(position)
+    assert [e["message"].split(": ")[-1] for e in spawner._progress_events] == [
+        f"{position} in queue" for position in (40, 20, 10, 5, 2, 1)
+    ]
+
+
+def test_route_probe_retries_until_routed(spawner, monkeypatch):
+    responses = [httpx.Response(404), httpx.Response(503), httpx.Response(302)]
+    clients = []
+    async_client = httpx.AsyncClient
+
+    def make_http(**kwargs):
+        clients.append(kwargs)
+        return async_client(
+            transport=httpx.MockTransport(lambda request: responses.pop(0))
+        )
+
+    monkeypatch.setattr(spawner_module.httpx, "AsyncClient", make_http)
+    spawner.ingress_public_url = "https://hub.example.com"
+    spawner.ready_check_http_probe_verify = "/etc/ca.pem"
+    retries = ROUTE_PROBE_RETRIES.labels(context=spawner.kubernetes_context)
+    before = retries._value.get()
+
+    assert asyncio.run(spawner.probe_route(5))
+    assert not responses
+    assert clients[0]["verify"] == "/etc/ca.pem"
+    assert retries._value.get() == before + 2
+
+
+class FakeApplyClient:
+    """
+    Records applied objects, and answers metadata requests from them
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.applied = []
+
+    async def apply(self, obj, namespace=None):
+        name = obj["metadata"]["name"]
+        self.applied.append(name)
+        metadata = dict(obj["metadata"], uid=f"uid-{name}")
+        self.objects[name] = {"metadata": metadata}
+        return self.objects[name]
+
+    async def get_metadata(self, api_version, kind, name, namespace=None):
+        return self.objects.get(name)
+
+
+def config_map(name, data):
+    return {
+        "apiVersion": "v1",
+        "kind": "ConfigMap",
+        "metadata": {"name": name},
+        "data": data,
+    }
+
+
+def test_unchanged_resources_are_not_applied_again(spawner, monkeypatch):
+    client = FakeApplyClient()
+    monkeypatch.setattr(MultiClusterKubeSpawner, "client", client)
+
+    def apply(*resources):
+        client.applied = []
+        asyncio.run(spawner.apply_resources(list(resources)))
+        return client.applied
+
+    assert apply(config_map("a", {"x": "1"}), config_map("b", {"x": "1"})) == [
+        "a",
+        "b",
+    ]
+    assert apply(config_map("a", {"x": "1"}), config_map("b", {"x": "1"})) == []
+    # Skipped objects still get their uid recorded
+    assert set(spawner.resource_uids.values()) == {"uid-a", "uid-b"}
+    # Changed in our templates
+    assert apply(config_map("a", {"x": "2"}), config_map("b", {"x": "1"})) == ["a"]
+    # Changed, or deleted, in the cluster by someone else
+    client.objects["a"]["metadata"]["annotations"] = {}
+    del client.objects["b"]
+    assert apply(config_map("a", {"x": "2"}), config_map("b", {"x": "1"})) == [
+        "a",
+        "b",
+    ]
+
+
+def test_namespace_resources_are_applied_once_per_namespace(user, hub, monkeypatch):
+    client = FakeApplyClient()
+    monkeypatch.setattr(MultiClusterKubeSpawner, "client", client)
+    monkeypatch.setattr(spawner_module, "_namespace_resources_applied", {})
+    monkeypatch.setattr(spawner_module, "_namespace_resources_locks", {})
+    config = Config()
+    config.MultiClusterKubeSpawner.namespace_resources = {
+        "01-cm": """
+        apiVersion: v1
+        kind: ConfigMap
+        metadata:
+            name: settings
+        """
+    }
+
+    def named_spawner(name):
+        orm_spawner = MagicMock()
+        orm_spawner.name = name
+        orm_spawner.server = None
+        return MultiClusterKubeSpawner(
+            user=user, hub=hub, config=config, orm_spawner=orm_spawner
+        )
+
+    # The user's default server and two named servers, all in the user's namespace
+    spawners = [named_spawner(name) for name in ("", "second", "third")]
+    assert len({s.key for s in spawners}) == 3
+    assert {s.namespace for s in spawners} == {"jupyter-mock-5fname"}
+
+    async def ensure_all():
+        await asyncio.gather(*(s.ensure_namespace_resources() for s in spawners))
+
+    # Only the first server to get the lock applies them
+    asyncio.run(ensure_all())
+    assert client.applied == ["jupyter-mock-5fname", "settings"]
+    # They belong to the namespace, not to any one server
+    assert all(s.resource_uids == {} for s in spawners)
+
+    # Namespaces nobody used in a while are forgotten
+    key = ("", "jupyter-mock-5fname")
+    assert key in spawner_module._namespace_resources_locks
+    spawner_module._namespace_resources_applied[key]["checked_at"] -= 7200
+    spawner_module._forget_idle_namespaces(3600)
+    assert spawner_module._namespace_resources_applied == {}
+    assert spawner_module._namespace_resources_locks == {}
@@ -0,0 +1,138 @@
+import pytest
+from multicluster_kubespawner.patch import strategic_merge_patch
+
+
+@pytest.fixture
+def pod():
+    return {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {"name": "jupyter-a", "labels": {"a": "b"}},
+        "spec": {
+            "containers": [
+                {
+                    "name": "notebook",
+                    "image": "pangeo/pangeo-notebook:latest",
+                    "args": ["jupyterhub-singleuser"],
+                    "ports": [{"containerPort": 8888}],
+                    "env": [
+                        {"name": "A", "value": "1"},
+                        {"name": "B", "value": "2"},
+                    ],
+                    "resources": {"limits": {}, "requests": {}},
+                }
+            ]
+        },
+    }
+
+
+def test_merge_container_by_name(pod):
+    patched = strategic_merge_patch(
+        pod,
+        {
+            "kind": "Pod",
+            "metadata": {"name": "jupyter-a"},
+            "spec": {
+                "containers": [
+                    {"name": "notebook", "resources": {"requests": {"cpu": "10m"}}}
+                ]
+            },
+        },
+    )
+    (container,) = patched["spec"]["containers"]
+    assert container["image"] == "pangeo/pangeo-notebook:latest"
+    assert container["resources"] == {"limits": {}, "requests": {"cpu": "10m"}}
+    # Original is not modified
+    assert pod["spec"]["containers"][0]["resources"]["requests"] == {}
+
+
+def test_merge_env_and_ports(pod):
+    patched = strategic_merge_patch(
+        pod,
+        {
+            "spec": {
+                "containers": [
+                    {
+                        "name": "notebook",
+                        "env": [{"name": "B", "value": "3"}, {"name": "C"}],
+                        "ports": [{"containerPort": 9999}],
+                    }
+                ]
+            },
+        },
+    )
+    container = patched["spec"]["containers"][0]
+    assert container["env"] == [
+        {"name": "A", "value": "1"},
+        {"name": "B", "value": "3"},
+        {"name": "C"},
+    ]
+    assert container["ports"] == [{"containerPort": 8888}, {"containerPort": 9999}]
+
+
+def test_new_container_appended(pod):
+    patched = strategic_merge_patch(
+        pod, {"spec": {"containers": [{"name": "sidecar", "image": "nginx"}]}}
+    )
+    assert [c["name"] for c in patched["spec"]["containers"]] == [
+        "notebook",
+        "sidecar",
+    ]
+
+
+def test_lists_without_strategy_are_replaced(pod):
+    patched = strategic_merge_patch(
+        pod,
+        {"spec": {"containers": [{"name": "notebook", "args": ["jupyter-lab"]}]}},
+    )
+    assert patched["spec"]["containers"][0]["args"] == ["jupyter-lab"]
+
+
+def test_directives(pod):
+    patched = strategic_merge_patch(
+        pod,
+        {
+            "metadata": {"labels": {"a": None, "c": "d"}},
+            "spec": {
+                "containers": [
+                    {
+                        "name": "notebook",
+                        "env": [{"name": "A", "$patch": "delete"}],
+                        "resources": {"$patch": "replace", "limits": {"cpu": "1"}},
+                    }
+                ]
+            },
+        },
+    )
+    assert patched["metadata"]["labels"] == {"c": "d"}
+    container = patched["spec"]["containers"][0]
+    assert container["env"] == [{"name": "B", "value": "2"}]
+    assert container["resources"] == {"limits": {"cpu": "1"}}
+
+
+def test_service_ports_merged_by_port():
+    service = {
+        "apiVersion": "v1",
+        "kind": "Service",
+        "metadata": {"name": "s"},
+        "spec": {"ports": [{"port": 8888, "targetPort": 8888}]},
+    }
+    patched = strategic_merge_patch(
+        service, {"spec": {"ports": [{"port": 8888, "name": "http"}]}}
+    )
+    assert patched["spec"]["ports"] == [
+        {"port": 8888, "targetPort": 8888, "name": "http"}
+    ]
+
+
+def test_custom_resources_use_merge_patch():
+    proxy = {
+        "apiVersion": "projectcontour.io/v1",
+        "kind": "HTTPProxy",
+        "metadata": {"name": "p"},
+        "spec": {"routes": [{"services": [{"name": "a"}]}]},
+    }
+    patched = strategic_merge_patch(
+        proxy, {"spec": {"routes": [{"services": [{"name": "b"}]}]}}
+    )
+    assert patched["spec"]["routes"] == [{"services": [{"name": "b"}]}]
@@ -0,0 +1,117 @@
+import asyncio
+import time
+from multicluster_kubespawner import placement
+from multicluster_kubespawner.placement import (
+    ClusterCapacity,
+    choose_target,
+    parse_quantity,
+    pod_requests,
+)
+
+
+def test_parse_quantity():
+    assert parse_quantity("500m") == 0.5
+    assert parse_quantity(2) == 2
+    assert parse_quantity("1Gi") == 2**30
+    assert parse_quantity("1G") == 1e9
+
+
+def test_pod_requests():
+    pod = {
+        "spec": {
+            "initContainers": [{"resources": {"requests": {"cpu": "2"}}}],
+            "containers": [
+                {"resources": {"requests": {"cpu": "500m", "memory": "1Gi"}}},
+                {"resources": {"requests": {"cpu": "500m"}}},
+                {},
+            ],
+        }
+    }
+    assert pod_requests(pod) == (2, 2**30)
+
+
+def make_capacity(context, nodes):
+    capacity = ClusterCapacity(context)
+    capacity.nodes = nodes
+    capacity.updated_at = time.time()
+    return capacity
+
+
+def test_choose_target(monkeypatch):
+    targets = [
+        {"kubernetes_context": "a", "cost": 2},
+        {"kubernetes_context": "b", "cost": 1},
+    ]
+
+    def choose(cpu, strategy):
+        monkeypatch.setattr(
+            placement,
+            "_capacities",
+            {
+                # Half full, with room for a big pod
+                "a": make_capacity("a", {"n": [8, 32e9, 4, 16e9]}),
+                # Nearly empty, but only small nodes
+                "b": make_capacity("b", {"n1": [2, 8e9, 0, 0], "n2": [2, 8e9, 1, 0]}),
+            },
+        )
+        target = asyncio.run(
+            choose_target(targets, cpu, 1e9, placement.SCORERS[strategy], 60)
+        )
+        return target["kubernetes_context"]
+
+    assert choose(1, "spread") == "b"
+    assert choose(1, "bin-pack") == "a"
+    assert choose(1, "cheapest") == "b"
+    # Only a has a node the pod fits onto
+    assert choose(3, "spread") == "a"
+
+
+def test_placed_pods_are_counted_until_the_next_refresh(monkeypatch):
+    a = make_capacity("a", {"n": [4, 16e9, 0, 0]})
+    b = make_capacity("b", {"n": [4, 16e9, 1, 0]})
+    monkeypatch.setattr(placement, "_capacities", {"a": a, "b": b})
+    targets = [{"kubernetes_context": "a"}, {"kubernetes_context": "b"}]
+
+    async def burst():
+        return [
+            (await choose_target(targets, 1, 1e9, placement.spread, 60))[
+                "kubernetes_context"
+            ]
+            for _ in range(5)
+        ]
+
+    # Spread over both clusters, instead of all onto the emptiest one
+    assert asyncio.run(burst()) == ["a", "a", "b", "a", "b"]
+    assert a.requested == (3, 3e9)
+    assert b.requested == (3, 2e9)
+
+    class FakeClient:
+        async def list(self, api_version, kind, field_selector=None):
+            if kind == "Node":
+                return {
+                    "items": [
+                        {
+                            "metadata": {"name": "n"},
+                            "spec": {},
+                            "status": {
+                                "allocatable": {"cpu": "4", "memory": "16G"},
+                                "conditions": [{"type": "Ready", "status": "True"}],
+                            },
+                        }
+                    ]
+                }
+            # The pods placed earlier show up in the list from now on
+            return {
+                "items": [
+                    {
+                        "spec": {
+                            "nodeName": "n",
+                            "containers": [{"resources": {"requests": {"cpu": "1"}}}],
+                        }
+                    }
+                ]
+            }
+
+    monkeypatch.setattr(placement, "get_client", lambda context: FakeClient())
+    asyncio.run(a.refresh())
+    assert a.requested == (1, 0)
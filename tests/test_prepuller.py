@@ -0,0 +1,103 @@
+import asyncio
+import copy
+from multicluster_kubespawner import prepuller
+from multicluster_kubespawner.informer import ResourceReflector
+from multicluster_kubespawner.prepuller import PREPULLER_LABEL, ImagePrepuller
+
+
+class FakeClient:
+    def __init__(self, reflector=None):
+        self.calls = []
+        self.reflector = reflector
+
+    async def apply(self, obj, namespace=None):
+        self.calls.append(("apply", namespace, obj["metadata"]["name"]))
+        obj = copy.deepcopy(obj)
+        obj["metadata"].update(namespace=namespace, uid="uid-1", generation=1)
+        if self.reflector is not None:
+            self.reflector._update("ADDED", obj)
+        return obj
+
+    async def delete(self, api_version, kind, name, namespace=None):
+        self.calls.append(("delete", namespace, name))
+
+
+def daemonset(name="prepuller", images=("a:1",), grace_period=0):
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name},
+        "spec": {
+            "template": {
+                "spec": {
+                    "terminationGracePeriodSeconds": grace_period,
+                    "initContainers": [{"image": image} for image in images],
+                }
+            }
+        },
+    }
+
+
+def test_prepuller_is_updated_when_the_daemonset_changes(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(prepuller, "get_client", lambda context: client)
+    # Never synced, so only changes to the config count
+    monkeypatch.setattr(ImagePrepuller, "reflector", ResourceReflector("a", "", "", ""))
+    pp = ImagePrepuller("a", "default")
+    # Keep the progress reporting out of this
+    pp._task = object()
+
+    async def run():
+        await pp.update(daemonset(), ["a:1"])
+        await pp.update(daemonset(), ["a:1"])
+        assert client.calls == [("apply", "default", "prepuller")]
+
+        # Same images, but prepuller_template changed
+        await pp.update(daemonset(grace_period=5), ["a:1"])
+        assert client.calls[1:] == [("apply", "default", "prepuller")]
+
+        # prepuller_namespace changed
+        await pp.update(daemonset(grace_period=5), ["a:1"], "prepull")
+        assert client.calls[2:] == [
+            ("apply", "prepull", "prepuller"),
+            ("delete", "default", "prepuller"),
+        ]
+        assert pp.namespace == "prepull"
+
+        await pp.update(daemonset(grace_period=5), ["a:1"], "prepull")
+        assert len(client.calls) == 4
+
+    asyncio.run(run())
+
+
+def test_prepuller_is_applied_again_when_deleted_or_changed(monkeypatch):
+    reflector = ResourceReflector(
+        "a", "apps/v1", "DaemonSet", PREPULLER_LABEL, index_label=None
+    )
+    reflector.synced.set()
+    client = FakeClient(reflector)
+    monkeypatch.setattr(prepuller, "get_client", lambda context: client)
+    monkeypatch.setattr(ImagePrepuller, "reflector", reflector)
+    pp = ImagePrepuller("a", "default")
+    pp.recheck_interval = 0.05
+
+    async def run():
+        await pp.update(daemonset(), ["a:1"])
+        await pp.update(daemonset(), ["a:1"])
+        assert len(client.calls) == 1
+
+        # Someone else deletes it: the same config is applied again
+        live = reflector.get("default", "prepuller")
+        reflector._update("DELETED", live)
+        await asyncio.sleep(0.2)
+        assert len(client.calls) == 2
+
+        # Someone else changes its spec
+        changed = copy.deepcopy(reflector.get("default", "prepuller"))
+        changed["metadata"]["generation"] = 2
+        reflector._update("MODIFIED", changed)
+        await asyncio.sleep(0.2)
+        assert len(client.calls) == 3
+        pp._task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+import asyncio
+import copy
+from multicluster_kubespawner import routes
+from multicluster_kubespawner.client import KubernetesAPIError
+from multicluster_kubespawner.routes import RouteTable
+
+
+class FakeClient:
+    def __init__(self):
+        self.root = None
+        self.writes = 0
+        # Changes someone else makes right before our next write
+        self.interference = []
+
+    def _interfere(self):
+        for change in self.interference:
+            change(self.root)
+            self.root["metadata"]["resourceVersion"] += "+"
+        self.interference = []
+
+    async def get(self, api_version, kind, name, namespace=None):
+        return copy.deepcopy(self.root)
+
+    async def create(self, obj, namespace=None):
+        if self.root is not None:
+            raise KubernetesAPIError(409, "AlreadyExists", "")
+        self.writes += 1
+        self.root = copy.deepcopy(obj)
+        self.root["metadata"]["resourceVersion"] = "1"
+        return copy.deepcopy(self.root)
+
+    async def replace(self, obj, namespace=None):
+        self._interfere()
+        if (
+            obj["metadata"]["resourceVersion"]
+            != self.root["metadata"]["resourceVersion"]
+        ):
+            raise KubernetesAPIError(409, "Conflict", "")
+        self.writes += 1
+        self.root = copy.deepcopy(obj)
+        self.root["metadata"]["resourceVersion"] += "1"
+        return copy.deepcopy(self.root)
+
+
+def prefixes(root):
+    return sorted(i["conditions"][0]["prefix"] for i in root["spec"]["includes"])
+
+
+def test_routes_are_written_in_batches_and_retried_on_conflict(monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(routes, "get_client", lambda context: client)
+    table = RouteTable("a", "default", "users", "hub.example.com")
+
+    async def run():
+        await asyncio.gather(
+            *(table.add(f"/user/{i}/", f"jupyter-{i}", f"user-{i}") for i in range(10))
+        )
+        assert client.writes == 1
+        assert client.root["spec"]["virtualhost"] == {"fqdn": "hub.example.com"}
+        assert len(client.root["spec"]["includes"]) == 10
+
+        # Someone else adds an include of their own while we remove some
+        client.interference.append(
+            lambda root: root["spec"]["includes"].append(
+                {
+                    "name": "other",
+                    "namespace": "other",
+                    "conditions": [{"prefix": "/other/"}],
+                }
+            )
+        )
+        await asyncio.gather(*(table.remove(f"/user/{i}/") for i in range(1, 10)))
+        assert prefixes(client.root) == ["/other/", "/user/0/"]
+
+    asyncio.run(run())
@@ -0,0 +1,127 @@
+import random
+from textwrap import dedent
+from types import SimpleNamespace
+
+import pytest
+from ruamel.yaml.error import YAMLError
+from multicluster_kubespawner.skeleton import Skeleton, render_yaml
+from multicluster_kubespawner.templating import get_template, load_yaml
+
+TEMPLATE = """
+apiVersion: v1
+kind: Pod
+metadata:
+    name: {{key}}
+    annotations:
+        path: {{proxy_spec}}
+spec:
+    containers:
+    - name: notebook
+      image: {{spawner.image}}
+      args: {{spawner.get_args()|tojson}}
+      ports:
+      - containerPort: {{spawner.port}}
+      env:
+      {% for k, v in spawner.get_env().items() -%}
+      - name: {{k}}
+        value: {{v|tojson}}
+      {% endfor %}
+"""
+
+
+def make_params(key, image="image:1", env=None, args=("--debug",)):
+    spawner = SimpleNamespace(
+        image=image,
+        port=8888,
+        get_args=lambda: list(args),
+        get_env=lambda: env if env is not None else {"USER": key, "QUOTE": '"'},
+    )
+    return {"key": key, "proxy_spec": f"/user/{key}/", "spawner": spawner}
+
+
+def rendered(source, params):
+    return load_yaml(get_template(source).render(**params))
+
+
+def test_skeleton_matches_rendering():
+    cases = [
+        make_params("user-1"),
+        make_params("user-2", image="registry/image@sha256:abc"),
+        # Values YAML would read as something other than the same string
+        make_params("123"),
+        make_params("true"),
+        make_params("a#b"),
+        make_params("user-3", env={"EMOJI": "😀", "N": "1"}),
+        # A different number of environment variables changes the structure
+        make_params("user-4", env={}),
+        make_params("user-5", args=()),
+    ]
+    for params in cases:
+        assert render_yaml(TEMPLATE, params) == rendered(TEMPLATE, params)
+
+    skeleton = Skeleton(TEMPLATE)
+    assert skeleton.simple
+    skeleton.fill(make_params("user-1"))
+    skeleton.fill(make_params("user-2"))
+    assert len(skeleton.variants) == 1
+    skeleton.fill(make_params("user-4", env={}))
+    assert len(skeleton.variants) == 2
+
+
+def test_templates_looking_at_values_are_rendered():
+    source = """
+    name: {{key}}
+    {% if key == "admin" %}
+    admin: true
+    {% endif %}
+    upper: {{key|upper}}
+    """
+    assert not Skeleton(source).simple
+    for key in ("admin", "user"):
+        params = {"key": key}
+        assert render_yaml(source, params, dedent_source=True) == rendered(
+            source.replace("\n    ", "\n"), params
+        )
+
+
+def test_quoted_values_are_filled_in():
+    # Inside quotes, values that would otherwise be read as null or a number are fine
+    skeleton = Skeleton('name: "{{name}}"\n')
+    for name in ("", "123", "true"):
+        assert skeleton.fill({"name": name}) == {"name": name}
+    assert len(skeleton.variants) == 1
+
+
+def test_invalid_yaml_is_not_read_leniently():
+    # The pure python parser would read this image as null
+    with pytest.raises(YAMLError):
+        render_yaml(TEMPLATE, make_params("user-1", image="&GF&RU~V"))
+    with pytest.raises(YAMLError):
+        load_yaml("image: &GF&RU~V\n")
+    # Only documents libyaml can not read at all are left to the pure parser
+    assert load_yaml('a: "\\ud83d\\ude00"\n') == {"a": "\ud83d\ude00"}
+    assert load_yaml("%YAML 1.2\n---\na: 1\n") == {"a": 1}
+
+
+def test_skeleton_matches_rendering_for_awkward_values():
+    source = """
+    a: {{username}}
+    b: prefix-{{username}}
+    c: "{{username}}"
+    d: [{{username}}]
+    e: {a: {{username}}}
+    f: [x, {b: "{{username}}"}, {{username|tojson}}]
+    """
+    values = ["a:b", "12:30:00", ":", "a: b", "a:", "-1", "1e3", "true", "~", "[a]"]
+    rng = random.Random(0)
+    alphabet = "aZ09:-./@ #'\"[]{},&*!|>%=+_~"
+    values += ["".join(rng.choices(alphabet, k=rng.randint(0, 8))) for _ in range(300)]
+    for username in values:
+        params = {"username": username}
+        try:
+            expected = rendered(dedent(source), params)
+        except YAMLError:
+            with pytest.raises(YAMLError):
+                render_yaml(source, params, dedent_source=True)
+        else:
+            assert render_yaml(source, params, dedent_source=True) == expected
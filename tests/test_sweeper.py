@@ -0,0 +1,62 @@
+import asyncio
+import time
+from multicluster_kubespawner import client
+from multicluster_kubespawner.sweeper import OrphanSweeper
+
+OLD = "2020-01-01T00:00:00Z"
+
+
+def make_pod(name, key, created=OLD, labels=None):
+    return {
+        "metadata": {
+            "name": name,
+            "namespace": "ns",
+            "creationTimestamp": created,
+            "labels": {"mcks.hub.jupyter.org/key": key, **(labels or {})},
+        }
+    }
+
+
+class FakeClient:
+    def __init__(self, pods):
+        self.pods = pods
+        self.deleted = []
+
+    async def list(self, api_version, kind, label_selector=None):
+        return {"metadata": {"resourceVersion": "1"}, "items": self.pods}
+
+    async def delete(self, api_version, kind, name, namespace=None):
+        self.deleted.append(name)
+
+
+def test_sweeper_deletes_orphans_after_grace_period(monkeypatch):
+    now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    fake = FakeClient(
+        [
+            make_pod("running", "a"),
+            make_pod("orphan", "b"),
+            make_pod("young", "c", created=now),
+            make_pod(
+                "kept", "d", labels={"mcks.hub.jupyter.org/delete-on-stop": "false"}
+            ),
+        ]
+    )
+    monkeypatch.setitem(client._clients, "fake", fake)
+
+    sweeper = OrphanSweeper(lambda: {("fake", "a")})
+    sweeper.targets = {"fake": {("v1", "Pod")}}
+    sweeper.grace_period = 60
+
+    # Orphans are only deleted once they have been seen for the grace period
+    asyncio.run(sweeper.sweep())
+    assert fake.deleted == []
+
+    for oid in sweeper._first_seen:
+        sweeper._first_seen[oid] -= 120
+    sweeper.dry_run = True
+    asyncio.run(sweeper.sweep())
+    assert fake.deleted == []
+
+    sweeper.dry_run = False
+    asyncio.run(sweeper.sweep())
+    assert fake.deleted == ["orphan"]
@@ -0,0 +1,162 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from multicluster_kubespawner import warmpool
+from multicluster_kubespawner.client import KubernetesAPIError
+from multicluster_kubespawner.warmpool import (
+    POOL_LABEL,
+    STATE_LABEL,
+    WarmPool,
+    get_warm_pool,
+    make_pool_template,
+)
+
+
+def test_pool_template_strips_user_specifics():
+    pod = {
+        "apiVersion": "v1",
+        "kind": "Pod",
+        "metadata": {
+            "name": "jupyter-a",
+            "labels": {"mcks.hub.jupyter.org/key": "jupyter-a", "team": "x"},
+        },
+        "spec": {
+            "serviceAccountName": "notebook",
+            "containers": [
+                {
+                    "name": "notebook",
+                    "image": "pangeo/pangeo-notebook:latest",
+                    "command": ["jupyterhub-singleuser"],
+                    "args": ["--debug"],
+                    "ports": [{"containerPort": 8888}],
+                    "env": [
+                        {"name": "MEM_LIMIT", "valueFrom": {"resourceFieldRef": {}}},
+                        {"name": "JUPYTERHUB_API_TOKEN", "value": "secret"},
+                    ],
+                }
+            ],
+        },
+    }
+    template, env, args = make_pool_template(pod)
+    assert env == {"JUPYTERHUB_API_TOKEN": "secret"}
+    assert args == ["--debug"]
+    assert "name" not in template["metadata"]
+    assert template["metadata"]["labels"] == {"team": "x"}
+    assert template["spec"]["serviceAccountName"] == "notebook"
+    (container,) = template["spec"]["containers"]
+    assert container["command"][-1] == "jupyterhub-singleuser"
+    assert "args" not in container
+    assert [e["name"] for e in container["env"]] == ["MEM_LIMIT"]
+    assert container["readinessProbe"]["tcpSocket"] == {"port": 8888}
+    # The original is untouched
+    assert pod["metadata"]["name"] == "jupyter-a"
+
+    # Pods started before they are claimed can't have the user's service account
+    pod["spec"]["serviceAccountName"] = "jupyter-a"
+    with pytest.raises(ValueError, match="service account"):
+        make_pool_template(pod)
+    pod["spec"]["serviceAccountName"] = "notebook"
+    pod["spec"]["hostname"] = "jupyter-a"
+    with pytest.raises(ValueError, match="jupyter-a"):
+        make_pool_template(pod)
+
+
+def test_secret_is_only_written_for_a_claimed_pod(monkeypatch):
+    def running_pod(name):
+        return {
+            "metadata": {
+                "name": name,
+                "labels": {POOL_LABEL: "pool", STATE_LABEL: "available"},
+            },
+            "status": {"phase": "Running", "containerStatuses": []},
+        }
+
+    class FakeClient:
+        def __init__(self):
+            self.calls = []
+
+        async def patch(self, api_version, kind, name, patch, namespace, patch_type):
+            self.calls.append(("patch", name, patch_type))
+            if name == "warm-taken":
+                raise KubernetesAPIError(422, "Invalid", "test failed")
+
+        async def apply(self, obj, namespace=None):
+            self.calls.append(("apply", obj["metadata"]["name"], None))
+
+    client = FakeClient()
+    monkeypatch.setattr(warmpool, "get_client", lambda context: client)
+    monkeypatch.setattr(
+        WarmPool,
+        "reflector",
+        SimpleNamespace(
+            objects={
+                ("ns", "warm-taken"): running_pod("warm-taken"),
+                ("ns", "warm-free"): running_pod("warm-free"),
+            }
+        ),
+    )
+    pool = WarmPool("a", "ns", "profile", "pool", {}, 2)
+
+    async def claim():
+        return await pool.claim({"key": "user"}, {"TOKEN": "t"}, [])
+
+    name, secret = asyncio.run(claim())
+    assert name == "warm-free"
+    assert client.calls == [
+        ("patch", "warm-taken", "json"),
+        ("patch", "warm-free", "json"),
+        ("apply", "warm-free-env", None),
+        ("patch", "warm-free", "merge"),
+    ]
+
+
+def test_pools_are_replaced_and_removed_when_idle(monkeypatch):
+    deleted = []
+
+    class FakeClient:
+        async def create(self, obj, namespace=None):
+            pass
+
+        async def delete(self, api_version, kind, name, namespace=None):
+            deleted.append((namespace, name))
+
+    def pool_pod(namespace, name, pool_id):
+        return {
+            "metadata": {
+                "name": name,
+                "namespace": namespace,
+                "labels": {POOL_LABEL: pool_id, STATE_LABEL: "available"},
+            },
+            "status": {"phase": "Running"},
+        }
+
+    async def synced():
+        return True
+
+    reflector = SimpleNamespace(objects={}, wait_for_sync=synced)
+    monkeypatch.setattr(warmpool, "get_client", lambda context: FakeClient())
+    monkeypatch.setattr(WarmPool, "reflector", reflector)
+    monkeypatch.setattr(warmpool, "_pools", {})
+    template = {"metadata": {}, "spec": {"volumes": []}}
+
+    async def run():
+        pool = get_warm_pool("a", "ns-1", "gpu", "p1", template, 0, 3600)
+        assert warmpool._pools == {("a", "gpu"): pool}
+        reflector.objects[("ns-1", "warm-1")] = pool_pod("ns-1", "warm-1", "p1")
+
+        # Moving the pool to another namespace deletes the pods of the old one
+        moved = get_warm_pool("a", "ns-2", "gpu", "p1", template, 0, 3600)
+        assert moved is not pool
+        await pool._task
+        assert deleted == [("ns-1", "warm-1")]
+
+        # Once nobody has used it for idle_timeout seconds, the pool goes away
+        reflector.objects[("ns-2", "warm-2")] = pool_pod("ns-2", "warm-2", "p1")
+        moved.last_used -= 3601
+        moved._wake.set()
+        await asyncio.wait_for(moved._task, 1)
+        assert deleted[1:] == [("ns-2", "warm-2")]
+        assert warmpool._pools == {}
+
+    asyncio.run(run())